@@ -14,7 +14,6 @@ interface Message {
 // Define the expected structure of the request body for your backend
 interface BackendRequestBody {
   user_text: string;
-  history: Message[]; // Send the simple message history
   notebookID: string; // Send the notebook ID
   excluded_files: string[]; // Send the excluded files original names
 }
@@ -27,7 +26,6 @@ interface BackendSuccessResponse {
 // --- Function to Call Backend API ---
 async function getBotResponseFromBackend(
   userText: string,
-  currentHistory: Message[],
   excludedFiles: string[],
 ): Promise<string> {
   const backendUrl = `${
@@ -42,7 +40,6 @@ async function getBotResponseFromBackend(
   }
   const requestBody: BackendRequestBody = {
     user_text: userText,
-    history: currentHistory,
     notebookID: notebookID,
     excluded_files: excludedFiles,
   };
@@ -132,7 +129,6 @@ export default function ChatWindow(props: {
       setError(null);
 
       const userMessage: Message = { role: "user", text };
-      const historyForBackend = [...messages];
 
       setMessages((prevMessages) => [...prevMessages, userMessage]);
 
@@ -147,7 +143,6 @@ export default function ChatWindow(props: {
       try {
         const replyText = await getBotResponseFromBackend(
           text,
-          historyForBackend,
           currentExcludedFiles, // Use the current value
         );
         const modelMessage: Message = {
@@ -168,7 +163,7 @@ export default function ChatWindow(props: {
         setIsLoading(false);
       }
     },
-    [isLoading, messages, props.excludedFiles], // Keep the dependency
+    [isLoading, props.excludedFiles], // Keep the dependency
   );
 
   return (
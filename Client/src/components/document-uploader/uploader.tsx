@@ -45,9 +45,21 @@ export default function Uploader(props: {
           console.log("Files uploaded successfully:", response.data);
           // Dismiss loading toast and show success
           toast.dismiss(loadingToast);
-          toast.success("Files uploaded successfully");
-
-          const size = files.length;
+          // 207: some files were stored, the others are listed with their error
+          const uploaded = response.data.files
+            ? response.data.files.filter(
+                (file: { status_code: number }) => file.status_code === 200,
+              ).length
+            : files.length;
+          if (response.status === 207) {
+            toast.error(
+              `${files.length - uploaded} of ${files.length} file(s) could not be uploaded`,
+            );
+          } else {
+            toast.success("Files uploaded successfully");
+          }
+
+          const size = uploaded;
           const form = new FormData();
           form.append("source", size.toString());
           form.append("notebookID", notebookID);
@@ -0,0 +1,201 @@
+import asyncio
+import io
+import mimetypes
+import os
+import posixpath
+import tarfile
+import threading
+import zipfile
+
+# --- Archive Configuration ---
+ARCHIVE_MAX_BYTES = int(os.getenv("ARCHIVE_MAX_BYTES", str(1024 * 1024 * 1024)))
+# Members past these limits are skipped, they bound decompression as well
+ARCHIVE_MAX_MEMBER_BYTES = int(
+    os.getenv("ARCHIVE_MAX_MEMBER_BYTES", str(2 * 1024 * 1024))
+)
+ARCHIVE_MAX_MEMBERS = int(os.getenv("ARCHIVE_MAX_MEMBERS", "50000"))
+ARCHIVE_MAX_TOTAL_BYTES = int(
+    os.getenv("ARCHIVE_MAX_TOTAL_BYTES", str(2 * 1024 * 1024 * 1024))
+)
+# Members stored and extracted at the same time
+ARCHIVE_WORKERS = int(os.getenv("ARCHIVE_WORKERS", "8"))
+# Members read ahead of the workers
+ARCHIVE_QUEUE_SIZE = int(os.getenv("ARCHIVE_QUEUE_SIZE", "64"))
+# Members whose metadata and index entries are written together
+ARCHIVE_BATCH_SIZE = int(os.getenv("ARCHIVE_BATCH_SIZE", "200"))
+# Comma separated directory names and file extensions that are never ingested
+ARCHIVE_SKIP_DIRS = set(
+    os.getenv(
+        "ARCHIVE_SKIP_DIRS",
+        ".git,.hg,.svn,node_modules,bower_components,vendor,third_party,"
+        "__pycache__,.venv,venv,env,site-packages,.tox,.mypy_cache,"
+        ".pytest_cache,dist,build,target,out,.next,.nuxt,.gradle,.idea,.vscode",
+    ).split(",")
+)
+ARCHIVE_SKIP_EXTENSIONS = set(
+    os.getenv(
+        "ARCHIVE_SKIP_EXTENSIONS",
+        "png,jpg,jpeg,gif,bmp,ico,webp,tiff,psd,mp3,mp4,wav,ogg,mov,avi,webm,"
+        "zip,gz,tgz,bz2,xz,7z,rar,tar,jar,war,ear,whl,egg,class,pyc,pyo,so,dll,"
+        "dylib,exe,o,a,lib,obj,bin,dat,db,sqlite,woff,woff2,ttf,otf,eot,lock,map",
+    ).split(",")
+)
+
+# Text types extract_text handles as they are, other text is sent as text/plain
+TEXT_TYPES = {"application/pdf", "application/json", "text/markdown"}
+
+
+def should_skip(path: str) -> bool:
+    """
+    Check a member path against the skipped directories and extensions.
+    """
+    parts = path.split("/")
+    if any(part in ARCHIVE_SKIP_DIRS for part in parts[:-1]):
+        return True
+    name = parts[-1]
+    if name.endswith(".min.js") or name.endswith(".min.css"):
+        return True
+    return "." in name and name.rsplit(".", 1)[-1].lower() in ARCHIVE_SKIP_EXTENSIONS
+
+
+def member_type(path: str, data: bytes):
+    """
+    Get the content type of a member, or None for binary content.
+    """
+    guessed, _ = mimetypes.guess_type(path)
+    if guessed == "application/pdf":
+        return guessed
+    # Text never contains NUL bytes
+    if b"\0" in data[:8192]:
+        return None
+    if path.lower().endswith(".md"):
+        return "text/markdown"
+    return guessed if guessed in TEXT_TYPES else "text/plain"
+
+
+def clean_member_path(path: str) -> str:
+    return posixpath.normpath("/" + path.replace("\\", "/")).lstrip("/")
+
+
+def iter_zip(source):
+    with zipfile.ZipFile(source) as archive:
+        for info in archive.infolist():
+            if info.is_dir():
+                continue
+            yield (
+                info.filename,
+                info.file_size,
+                lambda info=info: read_bounded(archive.open(info)),
+            )
+
+
+def iter_tar(source):
+    # Stream mode reads the archive front to back, without seeking
+    with tarfile.open(fileobj=source, mode="r|*") as archive:
+        for info in archive:
+            if not info.isfile():
+                continue
+            yield (
+                info.name,
+                info.size,
+                lambda info=info: read_bounded(archive.extractfile(info)),
+            )
+
+
+def read_bounded(member) -> bytes:
+    with member:
+        return member.read(ARCHIVE_MAX_MEMBER_BYTES + 1)
+
+
+def iter_archive(source, archive_name: str, stats: dict):
+    """
+    Read the members of a zip or tar archive, given as bytes or as a file
+    path, skipping the ones the rules exclude.
+    Yields (path, data, content_type) tuples.
+    """
+    if isinstance(source, str):
+        archive_file = open(source, "rb")
+    else:
+        archive_file = io.BytesIO(source)
+    with archive_file:
+        if archive_name.lower().endswith(".zip") or zipfile.is_zipfile(archive_file):
+            archive_file.seek(0)
+            members = iter_zip(archive_file)
+        else:
+            archive_file.seek(0)
+            members = iter_tar(archive_file)
+        total = 0
+        for path, size, read in members:
+            path = clean_member_path(path)
+            if stats["members"] >= ARCHIVE_MAX_MEMBERS:
+                print(f"{archive_name} has more than {ARCHIVE_MAX_MEMBERS} files")
+                stats["truncated"] = True
+                break
+            if should_skip(path) or size > ARCHIVE_MAX_MEMBER_BYTES:
+                stats["skipped"] += 1
+                continue
+            data = read()
+            total += len(data)
+            if total > ARCHIVE_MAX_TOTAL_BYTES:
+                print(f"{archive_name} expands past {ARCHIVE_MAX_TOTAL_BYTES} bytes")
+                stats["truncated"] = True
+                break
+            content_type = member_type(path, data)
+            if len(data) > ARCHIVE_MAX_MEMBER_BYTES or content_type is None:
+                stats["skipped"] += 1
+                continue
+            stats["members"] += 1
+            yield path, data, content_type
+
+
+async def process_archive(source, archive_name: str, handle_member):
+    """
+    Read an archive in a thread and hand its members to ARCHIVE_WORKERS
+    concurrent handle_member(path, data, content_type) calls. The archive is
+    read at most ARCHIVE_QUEUE_SIZE members ahead of the workers.
+    Returns counts of the members handled, skipped and failed.
+    """
+    loop = asyncio.get_running_loop()
+    queue = asyncio.Queue(maxsize=ARCHIVE_QUEUE_SIZE)
+    stop = threading.Event()
+    stats = {"members": 0, "skipped": 0, "failed": 0, "truncated": False}
+    done = object()
+
+    def read_members():
+        try:
+            for member in iter_archive(source, archive_name, stats):
+                if stop.is_set():
+                    break
+                # Blocks while the queue is full, which keeps reading bounded
+                asyncio.run_coroutine_threadsafe(queue.put(member), loop).result()
+        except Exception as e:
+            print(f"Error reading archive {archive_name}: {e}")
+            stats["error"] = str(e)
+        finally:
+            # Once stopped no worker is left to wait for the marker
+            if not stop.is_set():
+                asyncio.run_coroutine_threadsafe(queue.put(done), loop).result()
+
+    async def work():
+        while True:
+            member = await queue.get()
+            if member is done:
+                # Leave the marker for the other workers
+                queue.put_nowait(done)
+                return
+            try:
+                await handle_member(*member)
+            except Exception as e:
+                print(f"Error ingesting {member[0]} from {archive_name}: {e}")
+                stats["failed"] += 1
+
+    reader = asyncio.create_task(asyncio.to_thread(read_members))
+    try:
+        await asyncio.gather(*(work() for _ in range(ARCHIVE_WORKERS)))
+    finally:
+        stop.set()
+        # Unblock a reader waiting on a full queue
+        while not queue.empty():
+            queue.get_nowait()
+        await reader
+    return stats
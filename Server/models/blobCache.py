@@ -0,0 +1,189 @@
+import fcntl
+import hashlib
+import mmap
+import os
+import shutil
+import tempfile
+import time
+
+# --- Blob Cache Configuration ---
+# Shared by every uvicorn worker on the host, entries are written atomically
+BLOB_CACHE_DIR = os.getenv(
+    "BLOB_CACHE_DIR", os.path.join(tempfile.gettempdir(), "codelm-blob-cache")
+)
+# Total size of the cache, 0 disables it
+BLOB_CACHE_MAX_BYTES = int(os.getenv("BLOB_CACHE_MAX_BYTES", str(2 * 1024**3)))
+# Entries read more recently than this are never evicted, they may still be open
+BLOB_CACHE_EVICTION_GRACE_SECONDS = float(
+    os.getenv("BLOB_CACHE_EVICTION_GRACE_SECONDS", "60")
+)
+
+blob_cache_stats = {
+    "hits": 0,
+    "misses": 0,
+    "stores": 0,
+    "evictions": 0,
+    "evicted_bytes": 0,
+    "size_bytes": 0,
+}
+
+
+def get_blob_cache_stats():
+    """
+    Get the hit, miss and eviction counters of this worker's view of the cache.
+    """
+    stats = dict(blob_cache_stats)
+    stats["max_bytes"] = BLOB_CACHE_MAX_BYTES
+    return stats
+
+
+def cache_key(object_path: str, content_hash: str) -> str:
+    return hashlib.sha256(f"{object_path}:{content_hash}".encode("utf-8")).hexdigest()
+
+
+def entry_path(key: str) -> str:
+    return os.path.join(BLOB_CACHE_DIR, key[:2], key)
+
+
+def lookup(object_path: str, content_hash: str):
+    """
+    Get the path of a cached object, or None on a miss.
+    A hit refreshes the entry's modification time, which orders the LRU.
+    """
+    if BLOB_CACHE_MAX_BYTES <= 0 or not content_hash:
+        return None
+    path = entry_path(cache_key(object_path, content_hash))
+    try:
+        os.utime(path)
+    except OSError:
+        blob_cache_stats["misses"] += 1
+        return None
+    blob_cache_stats["hits"] += 1
+    return path
+
+
+def store(spool, object_path: str, content_hash: str):
+    """
+    Copy a finished SpooledBuffer into the cache and evict old entries if
+    the cache grew past BLOB_CACHE_MAX_BYTES. Returns the entry path or None.
+    """
+    if BLOB_CACHE_MAX_BYTES <= 0 or not content_hash:
+        return None
+    if spool.content_hash != content_hash or spool.size > BLOB_CACHE_MAX_BYTES:
+        return None
+    path = entry_path(cache_key(object_path, content_hash))
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Write to a temporary name and rename, readers never see partial entries
+        handle, temp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix=".tmp-")
+        with os.fdopen(handle, "wb") as entry:
+            if isinstance(spool.source, str):
+                with open(spool.source, "rb") as spooled:
+                    shutil.copyfileobj(spooled, entry)
+            else:
+                entry.write(spool.source)
+        os.replace(temp_path, path)
+    except OSError as e:
+        print(f"Error caching {object_path}: {e}")
+        return None
+    blob_cache_stats["stores"] += 1
+    evict()
+    return path
+
+
+def evict():
+    """
+    Remove the least recently used entries until the cache fits its budget.
+    Only one process evicts at a time, the others skip while it runs.
+    """
+    try:
+        lock = open(os.path.join(BLOB_CACHE_DIR, ".lock"), "w")
+    except OSError as e:
+        print(f"Error opening the blob cache lock: {e}")
+        return
+    with lock:
+        try:
+            fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            return
+        now = time.time()
+        entries = []
+        total = 0
+        for directory, _, names in os.walk(BLOB_CACHE_DIR):
+            for name in names:
+                if name == ".lock":
+                    continue
+                path = os.path.join(directory, name)
+                try:
+                    info = os.stat(path)
+                except OSError:
+                    continue
+                if name.startswith(".tmp-"):
+                    # Left behind by a worker that died while writing
+                    if now - info.st_mtime > 3600:
+                        remove_entry(path, info.st_size)
+                    continue
+                entries.append((info.st_mtime, info.st_size, path))
+                total += info.st_size
+        if total > BLOB_CACHE_MAX_BYTES:
+            entries.sort()
+            for modified, size, path in entries:
+                if total <= BLOB_CACHE_MAX_BYTES:
+                    break
+                if now - modified < BLOB_CACHE_EVICTION_GRACE_SECONDS:
+                    break
+                if remove_entry(path, size):
+                    total -= size
+        blob_cache_stats["size_bytes"] = total
+
+
+def remove_entry(path: str, size: int) -> bool:
+    try:
+        os.remove(path)
+    except OSError:
+        return False
+    blob_cache_stats["evictions"] += 1
+    blob_cache_stats["evicted_bytes"] += size
+    return True
+
+
+def open_mapped(path: str):
+    """
+    Map a file into memory read-only. Empty files map to b"".
+    """
+    with open(path, "rb") as entry:
+        if os.fstat(entry.fileno()).st_size == 0:
+            return b""
+        return mmap.mmap(entry.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+class CachedBlob:
+    """
+    A cache hit, usable wherever download_file's SpooledBuffer is.
+    The bytes are read through mmap, so hot objects stay in the page cache.
+    """
+
+    def __init__(self, path: str, content_hash: str):
+        self.path = path
+        self.content_hash = content_hash
+        self.size = os.path.getsize(path)
+
+    @property
+    def source(self):
+        return self.path
+
+    def finish(self):
+        pass
+
+    async def iter_chunks(self, chunk_size: int = 64 * 1024):
+        mapped = open_mapped(self.path)
+        try:
+            for start in range(0, len(mapped), chunk_size):
+                yield mapped[start : start + chunk_size]
+        finally:
+            if isinstance(mapped, mmap.mmap):
+                mapped.close()
+
+    def close(self):
+        # The entry belongs to the cache
+        pass
@@ -0,0 +1,140 @@
+import datetime
+
+from models.contextCache import fingerprint_files
+from models.notebookModel import db, get_files
+
+BRIEFING_UPDATE_PROMPT = """Here is the current briefing of a set of documents, followed by the content
+of documents that were just added to the set. Update the briefing so that it also
+covers the new documents: add their key points and findings, and revise the points
+they change. Keep it concise and reply with the updated briefing only.
+
+Current briefing:
+{briefing}
+
+New documents:
+{source_content}
+
+Updated briefing:
+"""
+
+# One document per notebook: its latest briefing and the file versions it covers
+briefings_collection = db["notebook_briefings"]
+
+# Notebooks whose briefing this worker is updating, and the ones whose
+# sources changed again in the meantime
+updating = set()
+pending = set()
+
+
+def file_versions(files: list) -> dict:
+    return {
+        file_meta["file_name"]: file_meta.get("content_hash")
+        or file_meta.get("file_size")
+        for file_meta in files
+    }
+
+
+async def get_briefing(notebook_id: str):
+    return await briefings_collection.find_one({"notebook_id": notebook_id})
+
+
+def is_fresh(briefing: dict, files: list) -> bool:
+    """
+    Check whether a briefing covers exactly the given files.
+    """
+    return briefing is not None and briefing["fingerprint"] == fingerprint_files(files)
+
+
+async def save_briefing(notebook_id: str, content: str, files: list, mode: str):
+    """
+    Store the briefing of a notebook along with the files it covers.
+    """
+    updated_at = datetime.datetime.utcnow()
+    await briefings_collection.update_one(
+        {"notebook_id": notebook_id},
+        {
+            "$set": {
+                "content": content,
+                "fingerprint": fingerprint_files(files),
+                "files": file_versions(files),
+                "mode": mode,
+                "updated_at": updated_at,
+            },
+            "$inc": {"version": 1},
+        },
+        upsert=True,
+    )
+    return updated_at
+
+
+async def refresh_briefing(notebook_id: str, build, extend):
+    """
+    Bring an existing briefing up to date with the notebook's files. When
+    files were only added, extend(notebook_id, briefing, added_files) folds
+    them into the previous briefing; after deletions or changes
+    build(notebook_id, files) starts over. Both return the new text.
+    Meant to run in the background after sources are added.
+    """
+    if notebook_id in updating:
+        # The running update goes around once more
+        pending.add(notebook_id)
+        return
+    updating.add(notebook_id)
+    try:
+        while True:
+            pending.discard(notebook_id)
+            briefing = await get_briefing(notebook_id)
+            if briefing is None:
+                # Only briefings that were asked for are maintained
+                return
+            files = await get_files(notebook_id)
+            if not is_fresh(briefing, files):
+                versions = file_versions(files)
+                covered = briefing.get("files", {})
+                added = [
+                    file_meta
+                    for file_meta in files
+                    if file_meta["file_name"] not in covered
+                ]
+                changed = any(
+                    versions.get(file_name) != version
+                    for file_name, version in covered.items()
+                )
+                if changed or not added:
+                    print(f"Rebuilding the briefing of notebook {notebook_id}")
+                    content = await build(notebook_id, files)
+                    mode = "full"
+                else:
+                    print(
+                        f"Adding {len(added)} sources to the briefing of notebook {notebook_id}"
+                    )
+                    content = await extend(notebook_id, briefing["content"], added)
+                    mode = "incremental"
+                if content:
+                    await save_briefing(notebook_id, content, files, mode)
+            if notebook_id not in pending:
+                return
+    except Exception as e:
+        print(f"Error updating the briefing of notebook {notebook_id}: {e}")
+    finally:
+        updating.discard(notebook_id)
+
+
+async def delete_briefing(notebook_id: str):
+    """
+    Delete the briefing of a notebook.
+    """
+    try:
+        await briefings_collection.delete_many({"notebook_id": notebook_id})
+    except Exception as e:
+        print(f"Error deleting the briefing of notebook {notebook_id}: {e}")
+
+
+async def ensure_briefing_indexes():
+    """
+    Create the MongoDB index briefing lookups rely on.
+    """
+    try:
+        await briefings_collection.create_index("notebook_id", unique=True)
+    except Exception as e:
+        print(f"Error creating briefing indexes: {e}")
@@ -0,0 +1,409 @@
+import ast
+import bisect
+import os
+import re
+
+# --- Chunking Configuration ---
+CHUNK_CHARS = int(os.getenv("CHUNK_CHARS", "1500"))
+CHUNK_OVERLAP = int(os.getenv("CHUNK_OVERLAP", "200"))
+# A definition whose body does not open within this many characters of its
+# name is taken for a declaration, so that a match is never scanned to the end
+DEFINITION_HEADER_MAX_CHARS = 2000
+
+TOKEN_PATTERN = re.compile(r"[a-z0-9_]{2,}")
+
+
+def tokenize(text: str) -> list:
+    """
+    Split text into lowercase terms for lexical search.
+    """
+    return TOKEN_PATTERN.findall(text.lower())
+
+
+def chunk_text(text: str, chunk_chars: int = CHUNK_CHARS, overlap: int = CHUNK_OVERLAP):
+    """
+    Split text into chunks of about chunk_chars characters, overlapping by
+    overlap characters. Chunks end on a paragraph, line or word boundary
+    when one is found in their second half.
+    Returns a list of dicts with the chunk text and its start offset.
+    """
+    chunks = []
+    start = 0
+    length = len(text)
+    while start < length:
+        end = min(start + chunk_chars, length)
+        if end < length:
+            for separator in ("\n\n", "\n", " "):
+                cut = text.rfind(separator, start + chunk_chars // 2, end)
+                if cut != -1:
+                    end = cut + len(separator)
+                    break
+        chunk = text[start:end]
+        if chunk.strip():
+            chunks.append({"text": chunk, "start": start})
+        if end >= length:
+            break
+        start = max(end - overlap, start + 1)
+    return chunks
+
+
+# Languages split on definitions, by file extension
+CODE_LANGUAGES = {
+    "py": "python",
+    "pyi": "python",
+    "js": "javascript",
+    "jsx": "javascript",
+    "mjs": "javascript",
+    "cjs": "javascript",
+    "ts": "javascript",
+    "tsx": "javascript",
+    "java": "java",
+    "kt": "java",
+    "cs": "java",
+    "go": "go",
+    "c": "c",
+    "h": "c",
+    "cc": "c",
+    "cpp": "c",
+    "hpp": "c",
+    "rs": "rust",
+}
+
+# (kind, pattern) pairs, each pattern captures the definition's name
+DEFINITION_PATTERNS = {
+    "javascript": [
+        (
+            "class",
+            r"^[ \t]*(?:export\s+)?(?:default\s+)?(?:abstract\s+)?class\s+(?P<name>[A-Za-z_$][\w$]*)",
+        ),
+        (
+            "interface",
+            r"^[ \t]*(?:export\s+)?(?:interface|enum)\s+(?P<name>[A-Za-z_$][\w$]*)",
+        ),
+        (
+            "function",
+            r"^[ \t]*(?:export\s+)?(?:default\s+)?(?:async\s+)?function\s*\*?\s*(?P<name>[A-Za-z_$][\w$]*)",
+        ),
+        (
+            "function",
+            r"^[ \t]*(?:export\s+)?(?:const|let|var)\s+(?P<name>[A-Za-z_$][\w$]*)\s*=\s*(?:async\s+)?(?:function\b|\([^)]*\)\s*(?::[^=]+)?=>|[A-Za-z_$][\w$]*\s*=>)",
+        ),
+        (
+            "method",
+            r"^[ \t]+(?:(?:public|private|protected|static|async|readonly|override|get|set)\s+)*(?P<name>[A-Za-z_$][\w$]*)\s*\([^;{\n]*\)\s*(?::\s*[^;{\n]+)?\{[ \t]*$",
+        ),
+    ],
+    "java": [
+        (
+            "class",
+            r"^[ \t]*(?:(?:public|private|protected|internal|static|final|abstract|sealed|partial|data|open)\s+)*(?:class|interface|enum|record|struct|object)\s+(?P<name>\w+)",
+        ),
+        (
+            "method",
+            r"^[ \t]*(?:(?:public|private|protected|internal|static|final|abstract|synchronized|override|virtual|async|suspend|open)\s+)+(?:fun\s+)?[\w<>\[\],.? ]*?(?P<name>\w+)\s*\(",
+        ),
+    ],
+    "go": [
+        ("function", r"^func\s+(?:\([^)]*\)\s*)?(?P<name>\w+)"),
+        ("type", r"^type\s+(?P<name>\w+)\s+(?:struct|interface)\b"),
+    ],
+    "c": [
+        (
+            "type",
+            r"^(?:typedef\s+)?(?:struct|class|enum|union|namespace)\s+(?P<name>\w+)[^;\n]*$",
+        ),
+        (
+            "function",
+            r"^(?!(?:if|for|while|switch|return|else|do)\b)[A-Za-z_][\w \t\*&:<>,]*?\b(?P<name>[A-Za-z_~]\w*(?:::~?\w+)*)\s*\([^;\n]*$",
+        ),
+    ],
+    "rust": [
+        (
+            "function",
+            r"^[ \t]*(?:pub(?:\([^)]*\))?\s+)?(?:const\s+)?(?:async\s+)?(?:unsafe\s+)?(?:extern\s+\"[^\"]*\"\s+)?fn\s+(?P<name>\w+)",
+        ),
+        (
+            "type",
+            r"^[ \t]*(?:pub(?:\([^)]*\))?\s+)?(?:struct|enum|trait|mod|union)\s+(?P<name>\w+)",
+        ),
+        (
+            "impl",
+            r"^[ \t]*impl\b(?:\s*<[^>]*>)?\s+(?:[\w:<>, ]+\s+for\s+)?(?P<name>\w+)",
+        ),
+    ],
+}
+
+COMPILED_PATTERNS = {
+    language: [(kind, re.compile(pattern, re.MULTILINE)) for kind, pattern in patterns]
+    for language, patterns in DEFINITION_PATTERNS.items()
+}
+
+# Control flow that the method patterns would otherwise take for definitions
+NOT_DEFINITIONS = {
+    "if",
+    "for",
+    "while",
+    "switch",
+    "catch",
+    "return",
+    "with",
+    "new",
+    "else",
+}
+
+
+def detect_language(file_name: str):
+    """
+    Get the language of a source file from its extension, or None for prose.
+    """
+    if "." not in file_name:
+        return None
+    return CODE_LANGUAGES.get(file_name.rsplit(".", 1)[-1].lower())
+
+
+def line_offsets(text: str) -> list:
+    """
+    Get the offset at which each line of text starts.
+    """
+    return [0] + [match.end() for match in re.finditer("\n", text)]
+
+
+def line_start(text: str, offset: int) -> int:
+    return text.rfind("\n", 0, offset) + 1
+
+
+def line_end(text: str, offset: int) -> int:
+    end = text.find("\n", offset)
+    return len(text) if end == -1 else end + 1
+
+
+def python_definitions(text: str) -> list:
+    """
+    Find the classes, functions and methods of Python source with ast.
+    Returns None if the source does not parse.
+    """
+    try:
+        tree = ast.parse(text)
+    except (SyntaxError, ValueError):
+        return None
+    starts = line_offsets(text) + [len(text)]
+
+    definitions = []
+
+    def visit(body, prefix):
+        for node in body:
+            if not isinstance(
+                node, (ast.FunctionDef, ast.AsyncFunctionDef, ast.ClassDef)
+            ):
+                continue
+            first_line = min([node.lineno] + [d.lineno for d in node.decorator_list])
+            qualified_name = f"{prefix}{node.name}"
+            if isinstance(node, ast.ClassDef):
+                kind = "class"
+            else:
+                kind = "method" if prefix else "function"
+            definitions.append(
+                {
+                    "name": node.name,
+                    "qualified_name": qualified_name,
+                    "kind": kind,
+                    "start": starts[first_line - 1],
+                    "end": starts[min(node.end_lineno, len(starts) - 1)],
+                }
+            )
+            if isinstance(node, ast.ClassDef):
+                visit(node.body, qualified_name + ".")
+
+    visit(tree.body, "")
+    return definitions
+
+
+# The header of a definition up to the first ";", "{" or "}" that is not in a
+# string or a comment. Quotes left open, as in Rust lifetimes, are skipped
+BLOCK_HEADER_PATTERN = re.compile(
+    r"""(?:[^;{}"'`/]+|"(?:\\.|[^"\\\n])*"|'(?:\\.|[^'\\\n])*'|`(?:\\.|[^`\\])*`|["'`]|//[^\n]*|/\*.*?\*/|/)*""",
+    re.DOTALL,
+)
+
+
+def block_end(text: str, offset: int):
+    """
+    Find the end of the first brace block after offset, skipping strings and
+    comments. Returns None for declarations without a body.
+    """
+    length = len(text)
+    header = BLOCK_HEADER_PATTERN.match(
+        text, offset, min(offset + DEFINITION_HEADER_MAX_CHARS, length)
+    )
+    index = header.end()
+    if index >= length or text[index] != "{":
+        return None
+    depth = 0
+    while index < length:
+        char = text[index]
+        if char in "\"'`":
+            closing = index + 1
+            while closing < length and text[closing] != char:
+                if text[closing] == "\\":
+                    closing += 1
+                elif text[closing] == "\n" and char != "`":
+                    break
+                closing += 1
+            index = closing
+        elif text.startswith("//", index):
+            index = line_end(text, index) - 1
+        elif text.startswith("/*", index):
+            closing = text.find("*/", index + 2)
+            index = length if closing == -1 else closing + 1
+        elif char == "{":
+            depth += 1
+        elif char == "}":
+            depth -= 1
+            if depth == 0:
+                return line_end(text, index)
+        index += 1
+    return None
+
+
+def brace_definitions(text: str, language: str) -> list:
+    """
+    Find the definitions of brace-delimited source with the language's patterns.
+    """
+    found = {}
+    for kind, pattern in COMPILED_PATTERNS[language]:
+        for match in pattern.finditer(text):
+            name = match.group("name")
+            start = line_start(text, match.start())
+            if name in NOT_DEFINITIONS or start in found:
+                continue
+            end = block_end(text, match.start("name"))
+            if end is not None:
+                found[start] = {"name": name, "kind": kind, "start": start, "end": end}
+
+    # Qualify nested definitions with the names of the blocks enclosing them
+    definitions = sorted(found.values(), key=lambda item: (item["start"], -item["end"]))
+    enclosing = []
+    for definition in definitions:
+        while enclosing and enclosing[-1]["end"] <= definition["start"]:
+            enclosing.pop()
+        prefix = enclosing[-1]["qualified_name"] + "." if enclosing else ""
+        definition["qualified_name"] = prefix + definition["name"]
+        enclosing.append(definition)
+    return definitions
+
+
+def find_definitions(text: str, language: str) -> list:
+    """
+    Get the definitions of source code as dicts with "name", "qualified_name",
+    "kind" and their "start" and "end" offsets, or None if they can't be found.
+    """
+    if language == "python":
+        return python_definitions(text)
+    return brace_definitions(text, language)
+
+
+def definition_pieces(definitions: list, start: int, end: int, chunk_chars: int):
+    """
+    Split start..end into contiguous (start, end, symbols) pieces on the
+    outermost definitions within it. A definition larger than chunk_chars is
+    split on the definitions it contains. definitions are sorted by start.
+    """
+    pieces = []
+    cursor = start
+    index = 0
+    while index < len(definitions):
+        definition = definitions[index]
+        index += 1
+        # The definitions that follow it and start before it ends are nested in it
+        inner = []
+        while (
+            index < len(definitions) and definitions[index]["start"] < definition["end"]
+        ):
+            if definitions[index]["end"] <= definition["end"]:
+                inner.append(definitions[index])
+            index += 1
+        if definition["start"] < cursor:
+            continue
+        if definition["start"] > cursor:
+            pieces.append((cursor, definition["start"], []))
+        if definition["end"] - definition["start"] > chunk_chars and inner:
+            for piece_start, piece_end, symbols in definition_pieces(
+                inner, definition["start"], definition["end"], chunk_chars
+            ):
+                # The class header and fields belong to the class
+                pieces.append(
+                    (piece_start, piece_end, symbols or [definition["qualified_name"]])
+                )
+        else:
+            pieces.append(
+                (definition["start"], definition["end"], [definition["qualified_name"]])
+            )
+        cursor = definition["end"]
+    if cursor < end:
+        pieces.append((cursor, end, []))
+    return pieces
+
+
+def chunk_definitions(text: str, definitions: list, chunk_chars: int, overlap: int):
+    """
+    Chunk code on its definitions. Neighbouring small definitions share a chunk,
+    definitions too large for one are chunked as plain text.
+    """
+    merged = []
+    for piece in definition_pieces(definitions, 0, len(text), chunk_chars):
+        if merged and piece[1] - merged[-1][0] <= chunk_chars:
+            previous = merged[-1]
+            symbols = previous[2] + [
+                name for name in piece[2] if name not in previous[2]
+            ]
+            merged[-1] = (previous[0], piece[1], symbols)
+        else:
+            merged.append(piece)
+
+    chunks = []
+    for piece_start, piece_end, symbols in merged:
+        for chunk in chunk_text(text[piece_start:piece_end], chunk_chars, overlap):
+            chunk["start"] += piece_start
+            chunk["symbols"] = symbols
+            chunks.append(chunk)
+    return chunks
+
+
+def chunk_source(
+    text: str,
+    file_name: str,
+    chunk_chars: int = CHUNK_CHARS,
+    overlap: int = CHUNK_OVERLAP,
+):
+    """
+    Chunk a source, code files on their functions, classes and methods.
+    Returns (chunks, symbols): chunks are chunk_text dicts with their
+    "start_line" and "end_line" and, for code, the "symbols" defined in them.
+    symbols are the definitions of code files with their line span.
+    """
+    language = detect_language(file_name)
+    definitions = find_definitions(text, language) if language else None
+    if definitions:
+        chunks = chunk_definitions(text, definitions, chunk_chars, overlap)
+    else:
+        chunks = chunk_text(text, chunk_chars, overlap)
+
+    starts = line_offsets(text)
+
+    def line_of(offset: int) -> int:
+        return bisect.bisect_right(starts, offset)
+
+    for chunk in chunks:
+        chunk["start_line"] = line_of(chunk["start"])
+        chunk["end_line"] = line_of(chunk["start"] + max(len(chunk["text"]) - 1, 0))
+    symbols = [
+        {
+            "name": definition["name"],
+            "qualified_name": definition["qualified_name"],
+            "kind": definition["kind"],
+            "start_line": line_of(definition["start"]),
+            "end_line": line_of(max(definition["end"] - 1, definition["start"])),
+        }
+        for definition in definitions or []
+    ]
+    return chunks, symbols
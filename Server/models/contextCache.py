@@ -0,0 +1,208 @@
+import hashlib
+import os
+import time
+
+from cachetools import LRUCache
+from google.genai.types import Part, UserContent
+
+from models.contextPacker import CONTEXT_MAX_TOKENS, estimate_tokens
+from models.ingestion import load_source_texts
+from models.llmGateway import create_cache, delete_cache
+from models.singleflight import coalesce
+
+# --- Context Cache Configuration ---
+# Characters of assembled source text kept in memory, across notebooks
+SOURCE_CONTEXT_CACHE_CHARS = int(
+    os.getenv("SOURCE_CONTEXT_CACHE_CHARS", str(256 * 1024 * 1024))
+)
+# Sources smaller than this are cheaper to resend than to cache on the provider
+PROVIDER_CACHE_MIN_TOKENS = int(os.getenv("PROVIDER_CACHE_MIN_TOKENS", "32768"))
+# Sources up to this size are sent whole through the provider cache instead
+# of being narrowed down by retrieval, the rest of the budget is left to the
+# history and the question
+PROVIDER_CACHE_MAX_TOKENS = int(
+    os.getenv("PROVIDER_CACHE_MAX_TOKENS", str(CONTEXT_MAX_TOKENS * 3 // 4))
+)
+PROVIDER_CACHE_TTL_SECONDS = int(os.getenv("PROVIDER_CACHE_TTL_SECONDS", "600"))
+# Explicit caching needs a pinned model version
+PROVIDER_CACHE_MODEL = os.getenv("PROVIDER_CACHE_MODEL", "gemini-2.0-flash-001")
+
+# (notebook_id, fingerprint) -> assembled sources, sized by their characters,
+# held twice: as separate texts and as the assembled preamble
+source_contexts = LRUCache(
+    maxsize=SOURCE_CONTEXT_CACHE_CHARS,
+    getsizeof=lambda entry: 2 * entry["chars"] + 1,
+)
+
+# (notebook_id, fingerprint) -> {"name", "expires_at"} of the provider-side
+# cache of those sources, kept apart from source_contexts so that it is found
+# even when the sources are too large to be kept in memory
+provider_caches = {}
+
+context_cache_stats = {
+    "hits": 0,
+    "misses": 0,
+    "invalidations": 0,
+    "provider_hits": 0,
+    "provider_creates": 0,
+    "provider_errors": 0,
+}
+
+
+def get_context_cache_stats():
+    """
+    Get the counters of the source context cache.
+    """
+    stats = dict(context_cache_stats)
+    stats["entries"] = len(source_contexts)
+    stats["chars"] = source_contexts.currsize
+    stats["provider_caches"] = len(provider_caches)
+    return stats
+
+
+def fingerprint_files(files: list, excluded_files=()) -> str:
+    """
+    Fingerprint a notebook's file set. Any upload, deletion or change of
+    content of a file, or of the excluded files, gives a new fingerprint.
+    """
+    parts = sorted(
+        f"{file_meta.get('file_name')}:{file_meta.get('content_hash') or file_meta.get('file_size')}"
+        for file_meta in files
+    )
+    parts.append("excluded:" + ",".join(sorted(excluded_files or [])))
+    return hashlib.sha256("\n".join(parts).encode("utf-8")).hexdigest()
+
+
+def format_sources(files_content: list) -> str:
+    """
+    Assemble the "File Name / Content" preamble of the chat prompt.
+    """
+    preamble = ""
+    for file in files_content:
+        preamble += f"File Name: {file['file_name']}\n"
+        preamble += f"Content: {file['content']}\n\n"
+    return preamble
+
+
+async def get_source_context(notebook_id: str, files: list, excluded_files=()):
+    """
+    Get the texts of a notebook's files, assembled once per file set.
+    files are the notebook_files records already filtered by excluded_files.
+    Returns a dict with the "fingerprint", the (file_meta, text) "sources"
+    of load_source_texts, the readable "files_content", their "chars",
+    their assembled "preamble" and whether every source could be read, as
+    "complete".
+    """
+    fingerprint = fingerprint_files(files, excluded_files)
+    key = (notebook_id, fingerprint)
+    entry = source_contexts.get(key)
+    if entry is not None:
+        context_cache_stats["hits"] += 1
+        return entry
+    context_cache_stats["misses"] += 1
+
+    sources = await load_source_texts(notebook_id, files)
+    files_content = [
+        {"file_name": file_meta["file_original_name"], "content": text}
+        for file_meta, text in sources
+        if text is not None
+    ]
+    entry = {
+        "notebook_id": notebook_id,
+        "fingerprint": fingerprint,
+        "sources": sources,
+        "files_content": files_content,
+        "chars": sum(len(file["content"]) for file in files_content),
+        "preamble": format_sources(files_content),
+        "complete": all(text is not None for _, text in sources),
+    }
+    # Sources that could not be read are retried on the next request
+    if entry["complete"]:
+        try:
+            source_contexts[key] = entry
+        except ValueError:
+            # Larger than the whole cache
+            pass
+    return entry
+
+
+def is_provider_cacheable(entry: dict) -> bool:
+    """
+    Check whether the entry's sources are in the size range cached whole on
+    the provider.
+    """
+    tokens = estimate_tokens(entry["preamble"])
+    return PROVIDER_CACHE_MIN_TOKENS <= tokens <= PROVIDER_CACHE_MAX_TOKENS
+
+
+async def get_provider_cache(entry: dict):
+    """
+    Get the name of a provider-side cache holding the entry's source preamble,
+    creating it if needed, so that repeated turns do not resend the sources.
+    Returns None when the sources are too small to be worth caching, too
+    large to leave room for the rest of the prompt, could not all be read,
+    or the cache can't be created. Requests using it must use
+    PROVIDER_CACHE_MODEL.
+    """
+    if not entry["complete"] or not is_provider_cacheable(entry):
+        return None
+    key = (entry["notebook_id"], entry["fingerprint"])
+    cached = provider_caches.get(key)
+    # Leave a margin so that the cache does not expire during the request
+    if cached is not None and cached["expires_at"] - time.time() > 60:
+        context_cache_stats["provider_hits"] += 1
+        return cached["name"]
+    # Concurrent turns on the same sources share one creation
+    return await coalesce(
+        ("provider_cache",) + key, lambda: create_provider_cache(entry)
+    )
+
+
+async def create_provider_cache(entry: dict):
+    key = (entry["notebook_id"], entry["fingerprint"])
+    try:
+        cache = await create_cache(
+            PROVIDER_CACHE_MODEL,
+            [UserContent(parts=[Part(text=entry["preamble"])])],
+            PROVIDER_CACHE_TTL_SECONDS,
+            f"notebook-{entry['notebook_id']}",
+        )
+    except Exception as e:
+        print(f"Error creating the provider cache of {entry['notebook_id']}: {e}")
+        context_cache_stats["provider_errors"] += 1
+        return None
+    context_cache_stats["provider_creates"] += 1
+    now = time.time()
+    # Expired caches are already gone from the provider
+    expired = [
+        cached_key
+        for cached_key, cached in provider_caches.items()
+        if cached["expires_at"] <= now
+    ]
+    for cached_key in expired:
+        del provider_caches[cached_key]
+    provider_caches[key] = {
+        "name": cache.name,
+        "expires_at": now + PROVIDER_CACHE_TTL_SECONDS,
+    }
+    return cache.name
+
+
+async def invalidate_source_context(notebook_id: str):
+    """
+    Drop the cached contexts of a notebook after its files changed, and
+    delete their provider-side caches instead of waiting for them to expire.
+    """
+    keys = [key for key in list(source_contexts.keys()) if key[0] == notebook_id]
+    for key in keys:
+        source_contexts.pop(key, None)
+        context_cache_stats["invalidations"] += 1
+    keys = [key for key in list(provider_caches) if key[0] == notebook_id]
+    for key in keys:
+        cached = provider_caches.pop(key, None)
+        if cached is None:
+            continue
+        try:
+            await delete_cache(cached["name"])
+        except Exception as e:
+            print(f"Error deleting provider cache {cached['name']}: {e}")
@@ -0,0 +1,180 @@
+import math
+import os
+
+# --- Context Configuration ---
+# Input budget of a single model call, well under the model's own limit so
+# that oversized notebooks stay fast
+CONTEXT_MAX_TOKENS = int(os.getenv("CONTEXT_MAX_TOKENS", "200000"))
+# Rough size of a token, close enough for English prose and code
+CHARS_PER_TOKEN = float(os.getenv("CONTEXT_CHARS_PER_TOKEN", "4"))
+# Share of the remaining budget history may take when sources need the rest
+CONTEXT_HISTORY_SHARE = float(os.getenv("CONTEXT_HISTORY_SHARE", "0.2"))
+# A source cut below this is dropped instead, it would carry too little
+CONTEXT_MIN_SOURCE_TOKENS = int(os.getenv("CONTEXT_MIN_SOURCE_TOKENS", "256"))
+
+TRUNCATION_MARKER = "\n[... truncated to fit the context budget]"
+
+
+def estimate_tokens(text: str) -> int:
+    """
+    Estimate the number of tokens of a text without calling the model.
+    """
+    if not text:
+        return 0
+    return math.ceil(len(text) / CHARS_PER_TOKEN)
+
+
+def truncate_to_tokens(text: str, tokens: int) -> str:
+    """
+    Cut a text to about the given number of tokens, on a line or word boundary.
+    """
+    if estimate_tokens(text) <= tokens:
+        return text
+    limit = max(int(tokens * CHARS_PER_TOKEN) - len(TRUNCATION_MARKER), 0)
+    cut = text.rfind("\n", limit // 2, limit)
+    if cut == -1:
+        cut = text.rfind(" ", limit // 2, limit)
+    return text[: cut if cut != -1 else limit] + TRUNCATION_MARKER
+
+
+def fit_history(history: list, budget: int, dropped: list):
+    """
+    Keep the most recent messages of history that fit in budget tokens.
+    history is a list of dicts with "role" and "text", oldest first.
+    """
+    kept = []
+    used = 0
+    for index in range(len(history) - 1, -1, -1):
+        tokens = estimate_tokens(history[index]["text"])
+        if used + tokens > budget:
+            # Older messages are worth less than the ones after them
+            for older in range(index, -1, -1):
+                dropped.append(
+                    {
+                        "part": "history",
+                        "item": older,
+                        "action": "dropped",
+                        "tokens": estimate_tokens(history[older]["text"]),
+                    }
+                )
+            break
+        kept.append(history[index])
+        used += tokens
+    kept.reverse()
+    return kept, used
+
+
+def fit_sources(sources: list, budget: int, dropped: list):
+    """
+    Fit sources in budget tokens. Small sources are kept whole and large ones
+    cut to an equal share of what is left. When shares get too small to be
+    useful, the last sources, which are the least relevant, are dropped.
+    sources is a list of dicts with "file_name" and "content", best first.
+    """
+    sizes = [estimate_tokens(source["content"]) for source in sources]
+    count = len(sources)
+    while count:
+        remaining = budget
+        pending = sorted(range(count), key=lambda index: sizes[index])
+        share = remaining
+        for position, index in enumerate(pending):
+            share = remaining // (count - position)
+            if sizes[index] > share:
+                break
+            remaining -= sizes[index]
+        else:
+            share = None
+        if share is None or share >= CONTEXT_MIN_SOURCE_TOKENS:
+            break
+        count -= 1
+        dropped.append(
+            {
+                "part": "sources",
+                "item": sources[count]["file_name"],
+                "action": "dropped",
+                "tokens": sizes[count],
+            }
+        )
+
+    kept = []
+    used = 0
+    for index in range(count):
+        content = sources[index]["content"]
+        if share is not None and sizes[index] > share:
+            content = truncate_to_tokens(content, share)
+            dropped.append(
+                {
+                    "part": "sources",
+                    "item": sources[index]["file_name"],
+                    "action": "truncated",
+                    "tokens": sizes[index] - estimate_tokens(content),
+                }
+            )
+        kept.append({**sources[index], "content": content})
+        used += estimate_tokens(content)
+    return kept, used
+
+
+def pack_context(
+    question: str,
+    sources: list,
+    history: list = None,
+    system: str = "",
+    max_output_tokens: int = 0,
+    max_tokens: int = CONTEXT_MAX_TOKENS,
+):
+    """
+    Fit the parts of a model call in max_tokens, leaving room for the reply.
+    The system text and question are kept, history and sources share the
+    rest: history gets up to CONTEXT_HISTORY_SHARE of it unless sources
+    leave more unused. The oldest messages and least relevant sources go first.
+    Returns a dict with the kept "question", "sources" and "history" and a
+    "report" of the tokens of each part and of what was dropped or truncated.
+    """
+    history = history or []
+    dropped = []
+    system_tokens = estimate_tokens(system)
+    available = max(max_tokens - max_output_tokens - system_tokens, 0)
+    question_tokens = estimate_tokens(question)
+    if question_tokens > available:
+        question = truncate_to_tokens(question, available)
+        dropped.append(
+            {
+                "part": "question",
+                "item": None,
+                "action": "truncated",
+                "tokens": question_tokens - estimate_tokens(question),
+            }
+        )
+        question_tokens = estimate_tokens(question)
+    available -= question_tokens
+
+    source_tokens = sum(estimate_tokens(source["content"]) for source in sources)
+    history_budget = max(
+        int(available * CONTEXT_HISTORY_SHARE), available - source_tokens
+    )
+    kept_history, history_tokens = fit_history(history, history_budget, dropped)
+    kept_sources, used_source_tokens = fit_sources(
+        sources, available - history_tokens, dropped
+    )
+
+    report = {
+        "max_tokens": max_tokens,
+        "system_tokens": system_tokens,
+        "question_tokens": question_tokens,
+        "history_tokens": history_tokens,
+        "source_tokens": used_source_tokens,
+        "reserved_output_tokens": max_output_tokens,
+        "dropped": dropped,
+    }
+    if dropped:
+        print(
+            f"Context packed into {max_tokens} tokens, "
+            f"{len(dropped)} parts dropped or truncated"
+        )
+    return {
+        "question": question,
+        "sources": kept_sources,
+        "history": kept_history,
+        "report": report,
+    }
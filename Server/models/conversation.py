@@ -0,0 +1,159 @@
+import datetime
+import os
+
+from models.contextPacker import truncate_to_tokens
+from models.notebookModel import db
+
+# --- Conversation Configuration ---
+# Most recent messages sent to the model as they are
+HISTORY_WINDOW_MESSAGES = int(os.getenv("HISTORY_WINDOW_MESSAGES", "12"))
+# Messages that fell out of the window before the summary is brought up to date
+SUMMARY_BATCH_MESSAGES = int(os.getenv("SUMMARY_BATCH_MESSAGES", "6"))
+# Each message is cut to this size in the summarization prompt
+SUMMARY_MESSAGE_TOKENS = int(os.getenv("SUMMARY_MESSAGE_TOKENS", "1000"))
+
+SUMMARY_PROMPT = """Update the running summary of a conversation about a notebook's sources.
+Keep the facts, decisions and open questions, and the names of the files, functions
+and terms that were discussed. Reply with the updated summary only, in at most 300 words.
+
+Current summary:
+{summary}
+
+New messages:
+{messages}
+
+Updated summary:
+"""
+
+messages_collection = db["notebook_messages"]
+# One document per notebook: the summary of every message up to summarized_until
+summaries_collection = db["notebook_summaries"]
+
+# Notebooks whose summary this worker is refreshing
+refreshing = set()
+
+
+def message_role(message: dict) -> str:
+    # "by" is reliable, "role" depends on whether the user had a cookie
+    return "user" if message.get("by") == "user" else "model"
+
+
+async def get_summary(notebook_id: str):
+    return await summaries_collection.find_one({"notebook_id": notebook_id})
+
+
+async def get_messages_after(notebook_id: str, after, limit: int = 0):
+    """
+    Get the messages of a notebook created after a time, oldest first.
+    With a limit, only the most recent ones are returned.
+    """
+    query = {"notebook_id": notebook_id}
+    if after is not None:
+        query["metadata.created_at"] = {"$gt": after}
+    cursor = messages_collection.find(
+        query, {"text": 1, "by": 1, "metadata.created_at": 1}
+    ).sort("metadata.created_at", -1)
+    if limit:
+        cursor = cursor.limit(limit)
+    messages = await cursor.to_list(length=None)
+    messages.reverse()
+    return messages
+
+
+async def load_history(notebook_id: str):
+    """
+    Rebuild the conversation of a notebook from notebook_messages: the summary
+    of older turns, and the messages the summary does not cover yet, at most
+    twice the window while a refresh is pending.
+    Returns a dict with the "summary" text, the "messages" as dicts with
+    "role" and "text", oldest first, and whether the summary is "stale".
+    """
+    summary = await get_summary(notebook_id)
+    messages = await get_messages_after(
+        notebook_id,
+        summary["summarized_until"] if summary else None,
+        2 * HISTORY_WINDOW_MESSAGES,
+    )
+    return {
+        "summary": summary["summary"] if summary else "",
+        "messages": [
+            {"role": message_role(message), "text": message["text"]}
+            for message in messages
+        ],
+        "stale": len(messages) >= HISTORY_WINDOW_MESSAGES + SUMMARY_BATCH_MESSAGES,
+    }
+
+
+def format_messages(messages: list) -> str:
+    lines = []
+    for message in messages:
+        speaker = "User" if message_role(message) == "user" else "Assistant"
+        text = truncate_to_tokens(message["text"], SUMMARY_MESSAGE_TOKENS)
+        lines.append(f"{speaker}: {text}")
+    return "\n\n".join(lines)
+
+
+async def refresh_summary(notebook_id: str, generate):
+    """
+    Fold the messages that fell out of the history window into the notebook's
+    summary. generate is an async function sending a prompt to the model.
+    Meant to run in the background after a chat turn.
+    """
+    if notebook_id in refreshing:
+        return
+    refreshing.add(notebook_id)
+    try:
+        summary = await get_summary(notebook_id)
+        summarized_until = summary["summarized_until"] if summary else None
+        messages = await get_messages_after(notebook_id, summarized_until)
+        older = messages[: max(len(messages) - HISTORY_WINDOW_MESSAGES, 0)]
+        if len(older) < SUMMARY_BATCH_MESSAGES:
+            return
+        print(f"Summarizing {len(older)} older messages of notebook {notebook_id}")
+        updated = await generate(
+            SUMMARY_PROMPT.format(
+                summary=summary["summary"] if summary else "(none yet)",
+                messages=format_messages(older),
+            )
+        )
+        # Only moves forward from the summary that was read, another worker
+        # may have refreshed it in the meantime
+        await summaries_collection.update_one(
+            {"notebook_id": notebook_id, "summarized_until": summarized_until},
+            {
+                "$set": {
+                    "summary": updated.strip(),
+                    "summarized_until": older[-1]["metadata"]["created_at"],
+                    "updated_at": datetime.datetime.utcnow(),
+                },
+                "$inc": {"message_count": len(older)},
+            },
+            upsert=summary is None,
+        )
+    except Exception as e:
+        print(f"Error refreshing the summary of notebook {notebook_id}: {e}")
+    finally:
+        refreshing.discard(notebook_id)
+
+
+async def delete_summary(notebook_id: str):
+    """
+    Delete the conversation summary of a notebook.
+    """
+    try:
+        await summaries_collection.delete_many({"notebook_id": notebook_id})
+    except Exception as e:
+        print(f"Error deleting the summary of notebook {notebook_id}: {e}")
+
+
+async def ensure_conversation_indexes():
+    """
+    Create the MongoDB indexes history rebuilding relies on.
+    """
+    try:
+        await messages_collection.create_index(
+            [("notebook_id", 1), ("metadata.created_at", -1)]
+        )
+        await summaries_collection.create_index("notebook_id", unique=True)
+    except Exception as e:
+        print(f"Error creating conversation indexes: {e}")
@@ -0,0 +1,327 @@
+import asyncio
+import hashlib
+import mmap
+import multiprocessing
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from contextlib import aclosing
+
+import fitz
+
+from models.blobCache import open_mapped
+
+# --- Extraction Engine Configuration ---
+# Worker processes that parse PDF pages
+EXTRACTION_WORKERS = int(os.getenv("EXTRACTION_WORKERS", str(os.cpu_count() or 2)))
+# Documents being extracted at the same time, the rest wait in the queue
+EXTRACTION_MAX_JOBS = int(os.getenv("EXTRACTION_MAX_JOBS", "4"))
+# Pages handed to a single worker task, larger documents are split across workers
+EXTRACTION_PAGES_PER_TASK = int(os.getenv("EXTRACTION_PAGES_PER_TASK", "32"))
+# Pages beyond this limit are not parsed at all
+EXTRACTION_MAX_PAGES = int(os.getenv("EXTRACTION_MAX_PAGES", "2000"))
+# Extracted text is cut off once it reaches this many characters
+EXTRACTION_MAX_TEXT_CHARS = int(
+    os.getenv("EXTRACTION_MAX_TEXT_CHARS", str(8 * 1024 * 1024))
+)
+# and once it reaches this many bytes of UTF-8, so that non-ASCII text still
+# fits in a MongoDB document, which is limited to 16 MB
+EXTRACTION_MAX_TEXT_BYTES = int(
+    os.getenv("EXTRACTION_MAX_TEXT_BYTES", str(12 * 1024 * 1024))
+)
+
+process_pool: ProcessPoolExecutor = None
+job_semaphore = asyncio.Semaphore(EXTRACTION_MAX_JOBS)
+
+extraction_stats = {
+    "queued_jobs": 0,
+    "running_jobs": 0,
+    "completed_jobs": 0,
+    "failed_jobs": 0,
+    "pages_parsed": 0,
+    "parse_seconds": 0.0,
+    "truncated_documents": 0,
+    "pool_restarts": 0,
+}
+
+
+def get_process_pool() -> ProcessPoolExecutor:
+    """
+    Get the shared process pool used for PDF parsing.
+    """
+    global process_pool
+    if process_pool is None:
+        # spawn avoids forking the event loop and its threads into the workers
+        process_pool = ProcessPoolExecutor(
+            max_workers=EXTRACTION_WORKERS,
+            mp_context=multiprocessing.get_context("spawn"),
+        )
+    return process_pool
+
+
+def shutdown_process_pool():
+    """
+    Stop the extraction worker processes.
+    """
+    global process_pool
+    if process_pool is not None:
+        process_pool.shutdown(wait=False, cancel_futures=True)
+    process_pool = None
+
+
+def discard_broken_pool(pool: ProcessPoolExecutor):
+    """
+    Drop a pool one of whose workers died, the next call starts a new one.
+    """
+    global process_pool
+    if process_pool is pool:
+        print("A PDF worker process died, restarting the process pool")
+        extraction_stats["pool_restarts"] += 1
+        pool.shutdown(wait=False, cancel_futures=True)
+        process_pool = None
+
+
+async def parse_pdf_range(source, start: int, stop: int):
+    """
+    Parse the pages [start, stop) of a PDF in the process pool. A range whose
+    worker died, from a crash or an out of memory kill, is retried once on a
+    new pool.
+    """
+    loop = asyncio.get_running_loop()
+    pool = get_process_pool()
+    try:
+        return await loop.run_in_executor(pool, parse_pdf_pages, source, start, stop)
+    except BrokenProcessPool:
+        discard_broken_pool(pool)
+    return await loop.run_in_executor(
+        get_process_pool(), parse_pdf_pages, source, start, stop
+    )
+
+
+def get_extraction_stats():
+    """
+    Get the queue depth and parse timings of the extraction engine.
+    """
+    stats = dict(extraction_stats)
+    stats["workers"] = EXTRACTION_WORKERS
+    stats["max_jobs"] = EXTRACTION_MAX_JOBS
+    stats["seconds_per_page"] = (
+        stats["parse_seconds"] / stats["pages_parsed"] if stats["pages_parsed"] else 0.0
+    )
+    return stats
+
+
+def open_pdf(source):
+    """
+    Open a PDF from its bytes or from the path of a spooled file.
+    """
+    if isinstance(source, str):
+        return fitz.open(source, filetype="pdf")
+    return fitz.open(stream=source, filetype="pdf")
+
+
+def iter_pdf_pages(doc, start: int, stop: int):
+    """
+    Yield the text of the pages [start, stop) one page at a time.
+    """
+    for number in range(start, min(stop, doc.page_count)):
+        page = doc.load_page(number)
+        yield page.get_text("text")
+
+
+def parse_pdf_pages(source, start: int, stop: int):
+    """
+    Parse the pages [start, stop) of a PDF. Runs inside a worker process.
+    Returns the page texts, the total page count and the parse time in seconds.
+    """
+    began = time.perf_counter()
+    doc = open_pdf(source)
+    try:
+        page_count = doc.page_count
+        pages = list(iter_pdf_pages(doc, start, stop))
+    finally:
+        doc.close()
+    return pages, page_count, time.perf_counter() - began
+
+
+async def stream_pdf_pages(source):
+    """
+    Yield the text of every page of a PDF, in order, as the process pool
+    parses them. The first task also reports the page count, the remaining
+    page ranges of a large document are then parsed in parallel with at most
+    EXTRACTION_WORKERS ranges waiting to be consumed, so memory stays bounded.
+    source is either the bytes of the PDF or the path of a spooled file.
+    """
+    extraction_stats["queued_jobs"] += 1
+    try:
+        await job_semaphore.acquire()
+    finally:
+        extraction_stats["queued_jobs"] -= 1
+
+    extraction_stats["running_jobs"] += 1
+    pending = []
+    try:
+        pages, page_count, seconds = await parse_pdf_range(
+            source, 0, min(EXTRACTION_PAGES_PER_TASK, EXTRACTION_MAX_PAGES)
+        )
+        extraction_stats["pages_parsed"] += len(pages)
+        extraction_stats["parse_seconds"] += seconds
+        for page_text in pages:
+            yield page_text
+
+        last_page = min(page_count, EXTRACTION_MAX_PAGES)
+        if page_count > last_page:
+            print(f"PDF has {page_count} pages, only the first {last_page} are read")
+            extraction_stats["truncated_documents"] += 1
+        starts = iter(
+            range(EXTRACTION_PAGES_PER_TASK, last_page, EXTRACTION_PAGES_PER_TASK)
+        )
+
+        def submit_next():
+            start = next(starts, None)
+            if start is not None:
+                pending.append(
+                    asyncio.ensure_future(
+                        parse_pdf_range(
+                            source,
+                            start,
+                            min(start + EXTRACTION_PAGES_PER_TASK, last_page),
+                        )
+                    )
+                )
+
+        for _ in range(EXTRACTION_WORKERS):
+            submit_next()
+        while pending:
+            # Ranges are consumed in order, a new one is submitted for each one done
+            pages, _, seconds = await pending.pop(0)
+            submit_next()
+            extraction_stats["pages_parsed"] += len(pages)
+            extraction_stats["parse_seconds"] += seconds
+            for page_text in pages:
+                yield page_text
+
+        extraction_stats["completed_jobs"] += 1
+    except Exception:
+        extraction_stats["failed_jobs"] += 1
+        raise
+    finally:
+        for future in pending:
+            future.cancel()
+        extraction_stats["running_jobs"] -= 1
+        job_semaphore.release()
+
+
+def map_source(source):
+    """
+    Get a bytes-like view of a source given as bytes or as a file path.
+    Files are mapped read-only instead of being read into memory.
+    """
+    if isinstance(source, str):
+        return open_mapped(source)
+    return source
+
+
+def decode_source(source) -> str:
+    """
+    Decode a text source given as bytes or as a file path.
+    """
+    mapped = map_source(source)
+    try:
+        return str(mapped, "utf-8", "replace")
+    finally:
+        if isinstance(mapped, mmap.mmap):
+            mapped.close()
+
+
+def encoded_size(text: str) -> int:
+    return len(text.encode("utf-8", "surrogatepass"))
+
+
+def cap_text(text: str) -> str:
+    """
+    Cut a text to EXTRACTION_MAX_TEXT_CHARS characters and
+    EXTRACTION_MAX_TEXT_BYTES bytes of UTF-8, on a character boundary.
+    """
+    capped = text[:EXTRACTION_MAX_TEXT_CHARS]
+    encoded = capped.encode("utf-8", "surrogatepass")
+    if len(encoded) > EXTRACTION_MAX_TEXT_BYTES:
+        capped = encoded[:EXTRACTION_MAX_TEXT_BYTES].decode("utf-8", "ignore")
+    if len(capped) < len(text):
+        print("Extracted text reached its limit, the rest is dropped")
+        extraction_stats["truncated_documents"] += 1
+    return capped
+
+
+def hash_source(source) -> str:
+    """
+    Hash a source given as bytes or as a file path.
+    """
+    mapped = map_source(source)
+    try:
+        return hashlib.sha256(mapped).hexdigest()
+    finally:
+        if isinstance(mapped, mmap.mmap):
+            mapped.close()
+
+
+async def extract_text(source, file_type: str):
+    """
+    Extract the text of a downloaded file.
+    Returns a (text, page_offsets) tuple, or None if the type is not supported.
+    page_offsets holds the character offset at which each page starts.
+    """
+    # Handle document files that need conversion to markdown
+    if file_type == "application/pdf":
+        pages = []
+        page_offsets = []
+        offset = 0
+        size = 0
+        async with aclosing(stream_pdf_pages(source)) as page_stream:
+            async for page_text in page_stream:
+                page_size = encoded_size(page_text)
+                if (
+                    offset + len(page_text) > EXTRACTION_MAX_TEXT_CHARS
+                    or size + page_size > EXTRACTION_MAX_TEXT_BYTES
+                ):
+                    print("Extracted text reached its limit, the rest is dropped")
+                    extraction_stats["truncated_documents"] += 1
+                    break
+                page_offsets.append(offset)
+                pages.append(page_text)
+                offset += len(page_text)
+                size += page_size
+        return "".join(pages), page_offsets
+
+    # Handle text-based files
+    elif file_type in [
+        "text/plain",
+        "application/json",
+        "text/markdown",
+    ] or file_type.startswith("text/"):
+        return cap_text(decode_source(source)), [0]
+    else:
+        print(f"Unsupported file type: {file_type}")
+        return None
+
+
+async def extract_source(source, file_type: str, content_hash: str = None):
+    """
+    Extract a source once so it can be stored next to its metadata.
+    source is either the raw bytes or the path of a spooled file.
+    Returns a dict with the text, page offsets and content hash, or None.
+    """
+    try:
+        extracted = await extract_text(source, file_type)
+    except Exception as e:
+        print(f"Error converting document to markdown: {e}")
+        return None
+    if extracted is None:
+        return None
+    text, page_offsets = extracted
+    return {
+        "text": text,
+        "page_offsets": page_offsets,
+        "content_hash": content_hash or hash_source(source),
+    }
@@ -0,0 +1,99 @@
+import datetime
+import hashlib
+
+from models.notebookModel import db
+
+# One document per notebook and kind of generation: the last generated text,
+# reused while the template and the notebook's sources are unchanged
+generations_collection = db["notebook_generations"]
+
+generation_cache_stats = {"hits": 0, "misses": 0, "errors": 0}
+
+
+def get_generation_cache_stats():
+    """
+    Get the counters of the generation cache.
+    """
+    return dict(generation_cache_stats)
+
+
+def template_version(*parts) -> str:
+    """
+    Version a prompt template, with anything else that changes its output
+    such as the model name, so that editing it retires older generations.
+    """
+    return hashlib.sha256("\n".join(map(str, parts)).encode("utf-8")).hexdigest()[:16]
+
+
+async def get_generation(notebook_id: str, kind: str, version: str, fingerprint: str):
+    """
+    Get the cached generation of a notebook for a template version and
+    source fingerprint, or None.
+    """
+    try:
+        entry = await generations_collection.find_one(
+            {
+                "notebook_id": notebook_id,
+                "kind": kind,
+                "template_version": version,
+                "fingerprint": fingerprint,
+            }
+        )
+    except Exception as e:
+        print(f"Error reading the {kind} generation of notebook {notebook_id}: {e}")
+        generation_cache_stats["errors"] += 1
+        return None
+    generation_cache_stats["hits" if entry else "misses"] += 1
+    return entry
+
+
+async def store_generation(
+    notebook_id: str,
+    kind: str,
+    version: str,
+    fingerprint: str,
+    content: str,
+    context: dict = None,
+):
+    """
+    Store a generation, replacing the previous one of the same kind.
+    """
+    try:
+        await generations_collection.update_one(
+            {"notebook_id": notebook_id, "kind": kind},
+            {
+                "$set": {
+                    "template_version": version,
+                    "fingerprint": fingerprint,
+                    "content": content,
+                    "context": context,
+                    "created_at": datetime.datetime.utcnow(),
+                }
+            },
+            upsert=True,
+        )
+    except Exception as e:
+        print(f"Error storing the {kind} generation of notebook {notebook_id}: {e}")
+        generation_cache_stats["errors"] += 1
+
+
+async def delete_generations(notebook_id: str):
+    """
+    Delete the cached generations of a notebook.
+    """
+    try:
+        await generations_collection.delete_many({"notebook_id": notebook_id})
+    except Exception as e:
+        print(f"Error deleting the generations of notebook {notebook_id}: {e}")
+
+
+async def ensure_generation_indexes():
+    """
+    Create the MongoDB index generation lookups rely on.
+    """
+    try:
+        await generations_collection.create_index(
+            [("notebook_id", 1), ("kind", 1)], unique=True
+        )
+    except Exception as e:
+        print(f"Error creating generation indexes: {e}")
@@ -0,0 +1,285 @@
+import asyncio
+import datetime
+import os
+
+from models.notebookModel import (
+    acquire_blob_reference,
+    claim_file_migration,
+    delete_source_text,
+    forget_blob_reference,
+    get_registered_file_names,
+    get_source_texts,
+    release_blob_reference,
+    release_file_migration,
+    set_file_blob,
+    upsert_source_text,
+)
+from models.extraction import extract_source
+from models.retrieval import index_source, unindex_source
+from models.storage import (
+    copy_file,
+    delete_file,
+    download_file,
+    get_file_size,
+    upload_stream,
+)
+
+BUCKET_NAME = "files"
+# How many sources a single request reads at the same time
+SOURCE_READ_CONCURRENCY = int(os.getenv("SOURCE_READ_CONCURRENCY", "8"))
+# Content that could not be extracted is tried again after this many seconds
+SOURCE_EXTRACTION_RETRY_SECONDS = int(
+    os.getenv("SOURCE_EXTRACTION_RETRY_SECONDS", str(24 * 60 * 60))
+)
+
+
+def blob_path_for(content_hash: str) -> str:
+    """
+    Storage path of the content-addressed blob shared by identical files.
+    """
+    return f"blobs/{content_hash}"
+
+
+def source_path(notebook_id: str, file_meta: dict) -> str:
+    """
+    Storage path of a file: its blob, or its own object for files stored
+    before deduplication.
+    """
+    return file_meta.get("blob_path") or f"{notebook_id}/{file_meta.get('file_name')}"
+
+
+async def store_blob(spool, content_type: str = None):
+    """
+    Upload spooled bytes to their content-addressed blob, unless an identical
+    file is already stored. Returns the blob path, or None on failure.
+    On success the blob holds a reference for the notebook_files record about
+    to be inserted, release it with release_content if that record never is.
+    """
+    blob_path = blob_path_for(spool.content_hash)
+    # Taken first, so that the blob can't be released between the check and
+    # the insert of the record
+    await acquire_blob_reference(spool.content_hash)
+    if await get_file_size(blob_path, BUCKET_NAME) is not None:
+        print(f"Blob {blob_path} already stored, skipping the upload")
+        return blob_path
+    # upsert, an identical file may be uploaded concurrently
+    public_url = await upload_stream(
+        spool.iter_chunks(),
+        blob_path,
+        BUCKET_NAME,
+        content_type,
+        spool.size,
+        upsert=True,
+    )
+    if public_url is None:
+        await release_content(spool.content_hash, blob_path)
+        return None
+    return blob_path
+
+
+def is_settled(stored: dict) -> bool:
+    """
+    Check whether a source_texts row can be used as is: it holds a text, or a
+    failed extraction that is not due to be tried again.
+    """
+    if stored.get("text") is not None:
+        return True
+    failed_at = stored.get("metadata", {}).get("updated_at")
+    return failed_at is not None and datetime.datetime.utcnow() - failed_at < (
+        datetime.timedelta(seconds=SOURCE_EXTRACTION_RETRY_SECONDS)
+    )
+
+
+async def ingest_source(source, file_type: str, content_hash: str = None):
+    """
+    Extract the text of a source once and store it under its content hash.
+    Content that was already extracted, in any notebook, is not extracted
+    again, nor is content that recently failed to be.
+    source is either the raw bytes or the path of a spooled file.
+    Returns the extracted source, or None if it could not be extracted.
+    """
+    if content_hash is not None:
+        stored = (await get_source_texts([content_hash])).get(content_hash)
+        if stored is not None and is_settled(stored):
+            if stored["text"] is None:
+                return None
+            return {
+                "text": stored["text"],
+                "page_offsets": stored["page_offsets"],
+                "content_hash": content_hash,
+            }
+    extracted = await extract_source(source, file_type, content_hash)
+    if extracted is None:
+        print(f"Could not extract text for content {content_hash}")
+        if content_hash is not None:
+            try:
+                await upsert_source_text(
+                    content_hash, None, [], f"Could not extract {file_type}"
+                )
+            except Exception as e:
+                print(f"Error storing the failed extraction of {content_hash}: {e}")
+        return None
+    try:
+        await upsert_source_text(
+            extracted["content_hash"], extracted["text"], extracted["page_offsets"]
+        )
+    except Exception as e:
+        # The text is still returned, it will simply be extracted again later
+        print(f"Error storing extracted text for {content_hash}: {e}")
+    return extracted
+
+
+async def ingest_stored_source(notebook_id: str, file_meta: dict):
+    """
+    Download a source that is already in storage and extract and store its text.
+    A source still kept under its notebook is moved to its content-addressed
+    blob, and notebook_files is updated to point at it.
+    """
+    file_name = file_meta.get("file_name")
+    path = source_path(notebook_id, file_meta)
+    spool = await download_file(path, BUCKET_NAME, file_meta.get("content_hash"))
+    if spool is None:
+        return None
+    try:
+        extracted = await ingest_source(
+            spool.source, file_meta.get("file_type"), spool.content_hash
+        )
+    finally:
+        spool.close()
+
+    # Concurrent first reads of the file all extract it, one of them moves it
+    if not file_meta.get("blob_path") and await claim_file_migration(
+        file_name, notebook_id
+    ):
+        blob_path = blob_path_for(spool.content_hash)
+        await acquire_blob_reference(spool.content_hash)
+        # The notebook object is only removed once the record points at the blob
+        if await get_file_size(blob_path, BUCKET_NAME) is None:
+            blob_path = await copy_file(path, blob_path, BUCKET_NAME)
+        if blob_path is not None and await set_file_blob(
+            file_name, notebook_id, spool.content_hash, blob_path
+        ):
+            await delete_file(path, BUCKET_NAME)
+        else:
+            await release_content(spool.content_hash, blob_path)
+            await release_file_migration(file_name, notebook_id)
+    return extracted
+
+
+async def ingest_stored_sources(notebook_id: str, records: list):
+    """
+    Extract every given notebook_files record, at most SOURCE_READ_CONCURRENCY at a time.
+    """
+    semaphore = asyncio.Semaphore(SOURCE_READ_CONCURRENCY)
+
+    async def ingest_bounded(record: dict):
+        async with semaphore:
+            extracted = await ingest_stored_source(notebook_id, record)
+            if extracted is not None:
+                await index_source(notebook_id, record["file_name"], extracted["text"])
+
+    await asyncio.gather(
+        *(ingest_bounded(record) for record in records), return_exceptions=True
+    )
+
+
+async def release_source(notebook_id: str, file_meta: dict):
+    """
+    Delete the blob and extracted text of a file once no notebook_files record
+    references its content any more. Call it after deleting the file's metadata.
+    """
+    content_hash = file_meta.get("content_hash")
+    if not file_meta.get("blob_path"):
+        # Files stored before deduplication own their object
+        await delete_file(source_path(notebook_id, file_meta), BUCKET_NAME)
+    if content_hash:
+        await release_content(content_hash, file_meta.get("blob_path"))
+
+
+async def release_unregistered(notebook_id: str, records: list) -> int:
+    """
+    Release the content and index rows of built records whose insert failed.
+    Records a partial bulk insert did write keep theirs.
+    Returns how many of the records are not registered, all of them when
+    that can't be checked.
+    """
+    try:
+        registered = await get_registered_file_names(
+            notebook_id, [record["file_name"] for record in records]
+        )
+    except Exception as e:
+        # Leaking a reference is safer than deleting referenced content
+        print(f"Error releasing unregistered files of {notebook_id}: {e}")
+        return len(records)
+    unregistered = [
+        record for record in records if record["file_name"] not in registered
+    ]
+    for record in unregistered:
+        if not record.get("content_hash"):
+            continue
+        await unindex_source(notebook_id, record["file_name"])
+        await release_content(record["content_hash"], record.get("blob_path"))
+    return len(unregistered)
+
+
+async def release_content(content_hash: str, blob_path: str = None):
+    """
+    Drop one reference on a content hash, and delete its extracted text and
+    blob if it was the last one.
+    """
+    if not await release_blob_reference(content_hash):
+        print(f"Content {content_hash} is still referenced")
+        return
+    await delete_source_text(content_hash)
+    if blob_path:
+        await delete_file(blob_path, BUCKET_NAME)
+    await forget_blob_reference(content_hash)
+
+
+async def load_source_text(notebook_id: str, file_meta: dict, stored_texts: dict):
+    """
+    Get the text of a single source, preferring the stored extraction.
+    Files uploaded before ingestion existed are extracted and stored on first use.
+    Returns None if it could not be extracted.
+    """
+    stored = stored_texts.get(file_meta.get("content_hash"))
+    if stored is not None and is_settled(stored):
+        return stored["text"]
+
+    print(f"No stored text for {file_meta.get('file_name')}, extracting it now")
+    extracted = await ingest_stored_source(notebook_id, file_meta)
+    if extracted is None:
+        return None
+    return extracted["text"]
+
+
+async def load_source_texts(notebook_id: str, files: list):
+    """
+    Get the text of every given source, in the order of the given files.
+    Sources are read concurrently, at most SOURCE_READ_CONCURRENCY at a time.
+    Returns a list of (file_meta, text) pairs, text is None if it could not be read.
+    """
+    stored_texts = await get_source_texts(
+        {
+            file_meta["content_hash"]
+            for file_meta in files
+            if file_meta.get("content_hash")
+        }
+    )
+    semaphore = asyncio.Semaphore(SOURCE_READ_CONCURRENCY)
+
+    async def load_bounded(file_meta: dict):
+        async with semaphore:
+            return await load_source_text(notebook_id, file_meta, stored_texts)
+
+    # gather keeps the results in the order of the files
+    texts = await asyncio.gather(
+        *(load_bounded(file_meta) for file_meta in files), return_exceptions=True
+    )
+    sources = []
+    for file_meta, text in zip(files, texts):
+        if isinstance(text, BaseException):
+            print(f"Error reading source {file_meta.get('file_name')}: {text}")
+            text = None
+        sources.append((file_meta, text))
+    return sources
@@ -0,0 +1,340 @@
+import asyncio
+import datetime
+import json
+import os
+import uuid
+
+from pymongo import ReturnDocument
+from pymongo.errors import DuplicateKeyError
+
+from models.notebookModel import db
+
+# --- Job Queue Configuration ---
+# Jobs run at the same time by each server process
+JOB_WORKERS = int(os.getenv("JOB_WORKERS", "4"))
+# How often idle workers look for jobs queued by other processes or re-queued
+JOB_POLL_SECONDS = float(os.getenv("JOB_POLL_SECONDS", "2"))
+# Running jobs refresh heartbeat_at this often, and are re-queued once it is
+# older than JOB_STALE_SECONDS because their process went away
+JOB_HEARTBEAT_SECONDS = float(os.getenv("JOB_HEARTBEAT_SECONDS", "10"))
+JOB_STALE_SECONDS = float(os.getenv("JOB_STALE_SECONDS", "60"))
+# Jobs interrupted this many times, by crashes or restarts, are failed
+# instead of being re-queued again
+JOB_MAX_ATTEMPTS = int(os.getenv("JOB_MAX_ATTEMPTS", "3"))
+# Finished jobs are deleted after this many hours
+JOB_TTL_HOURS = int(os.getenv("JOB_TTL_HOURS", "24"))
+
+# One document per job. "active" is only set while a job is queued or
+# running, the unique index on dedup_key only covers active jobs
+jobs_collection = db["generation_jobs"]
+
+workers = []
+# Ids of the jobs this process is running
+running = set()
+# Set when a job is submitted in this process, so that idle workers do not
+# wait for the next poll
+wakeup = asyncio.Event()
+# job_id -> events of its watchers, set when a job of this process changes
+# state
+job_updates = {}
+last_requeue = 0.0
+
+job_stats = {"submitted": 0, "deduplicated": 0, "done": 0, "failed": 0, "requeued": 0}
+
+
+def get_job_stats():
+    """
+    Get the submission and completion counters of the job queue.
+    """
+    stats = dict(job_stats)
+    stats["workers"] = len(workers)
+    return stats
+
+
+def now():
+    return datetime.datetime.utcnow()
+
+
+def public_job(job: dict) -> dict:
+    """
+    The fields of a job document returned to clients.
+    """
+    return {
+        "job_id": job["_id"],
+        "notebook_id": job["notebook_id"],
+        "kind": job["kind"],
+        "status": job["status"],
+        "attempts": job.get("attempts", 0),
+        "result": job.get("result"),
+        "error": job.get("error"),
+        "created_at": job.get("created_at"),
+        "started_at": job.get("started_at"),
+        "finished_at": job.get("finished_at"),
+    }
+
+
+def notify(job_id: str):
+    for event in job_updates.get(job_id, ()):
+        event.set()
+
+
+async def submit_job(notebook_id: str, kind: str, params: dict = None, user_id=None):
+    """
+    Queue a job, unless the same kind of job with the same params is already
+    queued or running for the notebook, in which case that job is returned
+    instead.
+    """
+    params = params or {}
+    job = {
+        "_id": str(uuid.uuid4()),
+        "notebook_id": notebook_id,
+        "kind": kind,
+        "params": params,
+        "user_id": user_id,
+        "status": "queued",
+        "active": True,
+        "dedup_key": f"{notebook_id}:{kind}:{json.dumps(params, sort_keys=True)}",
+        "attempts": 0,
+        "created_at": now(),
+    }
+    while True:
+        try:
+            await jobs_collection.insert_one(job)
+            break
+        except DuplicateKeyError:
+            existing = await jobs_collection.find_one(
+                {"dedup_key": job["dedup_key"], "active": True}
+            )
+            if existing is not None:
+                job_stats["deduplicated"] += 1
+                return existing
+            # Finished in the meantime, another submission may win the retry
+    job_stats["submitted"] += 1
+    wakeup.set()
+    return job
+
+
+async def get_job(job_id: str):
+    return await jobs_collection.find_one({"_id": job_id})
+
+
+async def watch_job(job_id: str):
+    """
+    Yield a job each time its status changes, until it is finished. Jobs of
+    this process are reported right away, others at the next poll.
+    """
+    # Each watcher has its own event, so that one finishing does not leave
+    # the others to the poll
+    event = asyncio.Event()
+    job_updates.setdefault(job_id, set()).add(event)
+    status = None
+    try:
+        while True:
+            job = await get_job(job_id)
+            if job is None:
+                return
+            if job["status"] != status:
+                status = job["status"]
+                yield job
+            if status in ("done", "failed"):
+                return
+            try:
+                await asyncio.wait_for(event.wait(), JOB_POLL_SECONDS)
+            except asyncio.TimeoutError:
+                pass
+            event.clear()
+    finally:
+        events = job_updates.get(job_id)
+        if events is not None:
+            events.discard(event)
+            if not events:
+                del job_updates[job_id]
+
+
+async def claim_job():
+    """
+    Take the oldest queued job and mark it as running. Jobs are only
+    re-queued while they have attempts left, see requeue_jobs.
+    """
+    return await jobs_collection.find_one_and_update(
+        {"status": "queued"},
+        {
+            "$set": {
+                "status": "running",
+                "started_at": now(),
+                "heartbeat_at": now(),
+            },
+            "$inc": {"attempts": 1},
+        },
+        sort=[("created_at", 1)],
+        return_document=ReturnDocument.AFTER,
+    )
+
+
+async def finish_job(job_id: str, result: dict = None, error: dict = None):
+    await jobs_collection.update_one(
+        {"_id": job_id},
+        {
+            "$set": {
+                "status": "failed" if error else "done",
+                "result": result,
+                "error": error,
+                "finished_at": now(),
+            },
+            "$unset": {"active": ""},
+        },
+    )
+    job_stats["failed" if error else "done"] += 1
+    notify(job_id)
+
+
+async def requeue_jobs(query: dict, reason: str) -> int:
+    """
+    Put the running jobs matching query back in the queue after reason
+    interrupted them, or fail with it the ones that used up JOB_MAX_ATTEMPTS.
+    Returns the number of jobs re-queued.
+    """
+    error = {"status_code": 500, "detail": reason}
+    failed = await jobs_collection.update_many(
+        {**query, "status": "running", "attempts": {"$gte": JOB_MAX_ATTEMPTS}},
+        {
+            "$set": {
+                "status": "failed",
+                "result": None,
+                "error": error,
+                "finished_at": now(),
+            },
+            "$unset": {"active": ""},
+        },
+    )
+    if failed.modified_count:
+        print(f"Failed {failed.modified_count} jobs after {JOB_MAX_ATTEMPTS} attempts")
+        job_stats["failed"] += failed.modified_count
+    requeued = await jobs_collection.update_many(
+        {**query, "status": "running"},
+        {"$set": {"status": "queued", "last_error": error}},
+    )
+    job_stats["requeued"] += requeued.modified_count
+    return requeued.modified_count
+
+
+async def requeue_stale_jobs():
+    """
+    Put back in the queue the running jobs whose process stopped sending
+    heartbeats, after a restart or a crash.
+    """
+    global last_requeue
+    last_requeue = asyncio.get_running_loop().time()
+    stale_before = now() - datetime.timedelta(seconds=JOB_STALE_SECONDS)
+    requeued = await requeue_jobs(
+        {"heartbeat_at": {"$lt": stale_before}},
+        "The server running the job stopped responding",
+    )
+    if requeued:
+        print(f"Re-queued {requeued} interrupted jobs")
+        wakeup.set()
+
+
+async def heartbeat(job_id: str):
+    while True:
+        await asyncio.sleep(JOB_HEARTBEAT_SECONDS)
+        await jobs_collection.update_one(
+            {"_id": job_id, "status": "running"},
+            {"$set": {"heartbeat_at": now()}},
+        )
+
+
+async def run_job(job: dict, handler):
+    """
+    Run a claimed job with handler(job), which returns its result as a dict
+    or raises. Exceptions with a status_code and detail, such as
+    HTTPException, are stored as they are.
+    """
+    notify(job["_id"])
+    running.add(job["_id"])
+    beating = asyncio.create_task(heartbeat(job["_id"]))
+    try:
+        result = await handler(job)
+    except Exception as e:
+        print(f"Job {job['_id']} ({job['kind']}) failed: {e}")
+        await finish_job(
+            job["_id"],
+            error={
+                "status_code": getattr(e, "status_code", 500),
+                "detail": getattr(e, "detail", str(e)),
+            },
+        )
+    else:
+        await finish_job(job["_id"], result=result)
+    finally:
+        running.discard(job["_id"])
+        beating.cancel()
+
+
+async def work(handler):
+    while True:
+        try:
+            if asyncio.get_running_loop().time() - last_requeue > JOB_STALE_SECONDS:
+                await requeue_stale_jobs()
+            job = await claim_job()
+            if job is None:
+                try:
+                    await asyncio.wait_for(wakeup.wait(), JOB_POLL_SECONDS)
+                except asyncio.TimeoutError:
+                    pass
+                wakeup.clear()
+                continue
+            await run_job(job, handler)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            print(f"Error in job worker: {e}")
+            await asyncio.sleep(JOB_POLL_SECONDS)
+
+
+async def start_job_workers(handler):
+    """
+    Start JOB_WORKERS workers running queued jobs with handler(job), after
+    re-queueing the jobs a previous run of the server left unfinished.
+    """
+    try:
+        await jobs_collection.create_index(
+            "dedup_key",
+            unique=True,
+            partialFilterExpression={"active": {"$exists": True}},
+        )
+        await jobs_collection.create_index([("status", 1), ("created_at", 1)])
+        await jobs_collection.create_index(
+            "finished_at", expireAfterSeconds=JOB_TTL_HOURS * 3600
+        )
+        await requeue_stale_jobs()
+    except Exception as e:
+        print(f"Error preparing the job queue: {e}")
+    workers.extend(asyncio.create_task(work(handler)) for _ in range(JOB_WORKERS))
+
+
+async def stop_job_workers():
+    """
+    Stop the workers and put the jobs they were running back in the queue.
+    Jobs of a process that crashed are re-queued once stale instead.
+    """
+    interrupted = list(running)
+    for worker in workers:
+        worker.cancel()
+    await asyncio.gather(*workers, return_exceptions=True)
+    workers.clear()
+    if interrupted:
+        requeued = await requeue_jobs(
+            {"_id": {"$in": interrupted}}, "The server shut down during the job"
+        )
+        print(f"Re-queued {requeued} jobs on shutdown")
+
+
+async def delete_notebook_jobs(notebook_id: str):
+    """
+    Delete the jobs of a notebook.
+    """
+    try:
+        await jobs_collection.delete_many({"notebook_id": notebook_id})
+    except Exception as e:
+        print(f"Error deleting the jobs of notebook {notebook_id}: {e}")
@@ -0,0 +1,183 @@
+import asyncio
+import os
+import time
+from contextlib import aclosing, asynccontextmanager
+
+import google.genai as genai
+from dotenv import load_dotenv
+from fastapi import HTTPException, status
+from google.genai.types import CreateCachedContentConfig, HttpOptions
+
+from models import scheduler
+
+load_dotenv()
+# --- LLM Gateway Configuration ---
+GEMINI_API_KEY = os.getenv("GEMINI_API_KEY")
+# Model calls in flight across the whole worker, the rest wait their turn
+LLM_MAX_CONCURRENT_CALLS = int(os.getenv("LLM_MAX_CONCURRENT_CALLS", "16"))
+LLM_TIMEOUT_SECONDS = float(os.getenv("LLM_TIMEOUT_SECONDS", "120"))
+# How long a call may wait for a free slot before it is refused
+LLM_QUEUE_TIMEOUT_SECONDS = float(os.getenv("LLM_QUEUE_TIMEOUT_SECONDS", "30"))
+
+scheduler.configure(LLM_MAX_CONCURRENT_CALLS)
+client = None
+
+llm_stats = {
+    "calls": 0,
+    "in_flight": 0,
+    "waiting": 0,
+    "timeouts": 0,
+    "rejected": 0,
+    "errors": 0,
+    "total_wait_seconds": 0.0,
+    "total_call_seconds": 0.0,
+}
+
+
+def get_llm_stats():
+    """
+    Get the call, timeout and wait counters of the gateway.
+    """
+    stats = dict(llm_stats)
+    stats["max_concurrent_calls"] = LLM_MAX_CONCURRENT_CALLS
+    return stats
+
+
+def get_client() -> genai.Client:
+    """
+    Get the worker's shared Gemini client, its connections are reused across calls.
+    """
+    global client
+    if client is None:
+        client = genai.Client(
+            api_key=GEMINI_API_KEY,
+            # Milliseconds, a backstop behind the per-call asyncio timeout
+            http_options=HttpOptions(timeout=int(LLM_TIMEOUT_SECONDS * 1000) + 5000),
+        )
+    return client
+
+
+@asynccontextmanager
+async def model_slot():
+    """
+    Hold one of the LLM_MAX_CONCURRENT_CALLS slots, handed out by the
+    scheduler in fair order between users.
+    Raises a 429 HTTPException when the scheduler's queue is full and a 503
+    when no slot frees up in time.
+    """
+    queued_at = time.monotonic()
+    llm_stats["waiting"] += 1
+    try:
+        await scheduler.acquire(LLM_QUEUE_TIMEOUT_SECONDS)
+    except asyncio.TimeoutError:
+        llm_stats["rejected"] += 1
+        raise HTTPException(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            detail="The AI service is busy, please try again.",
+        )
+    finally:
+        llm_stats["waiting"] -= 1
+    started_at = time.monotonic()
+    llm_stats["total_wait_seconds"] += started_at - queued_at
+    llm_stats["calls"] += 1
+    llm_stats["in_flight"] += 1
+    try:
+        yield
+    except asyncio.TimeoutError:
+        llm_stats["timeouts"] += 1
+        raise HTTPException(
+            status_code=status.HTTP_504_GATEWAY_TIMEOUT,
+            detail="The AI service took too long to answer.",
+        )
+    except HTTPException:
+        raise
+    except Exception:
+        llm_stats["errors"] += 1
+        raise
+    finally:
+        llm_stats["in_flight"] -= 1
+        llm_stats["total_call_seconds"] += time.monotonic() - started_at
+        scheduler.release(time.monotonic() - started_at)
+
+
+async def call_model(call, timeout: float = None):
+    """
+    Run one model call, given as a coroutine function, within the global
+    concurrency limit and a timeout.
+    Raises a 503 HTTPException when no slot frees up in time and a 504 when
+    the call itself times out.
+    """
+    async with model_slot():
+        return await asyncio.wait_for(call(), timeout or LLM_TIMEOUT_SECONDS)
+
+
+async def generate_content(model: str, contents, config=None, timeout: float = None):
+    """
+    Send a single prompt to the model.
+    """
+    return await call_model(
+        lambda: get_client().aio.models.generate_content(
+            model=model, contents=contents, config=config
+        ),
+        timeout,
+    )
+
+
+async def send_chat_message(
+    model: str, history: list, message, config=None, timeout: float = None
+):
+    """
+    Send a message on top of a chat history.
+    """
+    chat_session = get_client().aio.chats.create(
+        model=model, history=history, config=config
+    )
+    return await call_model(lambda: chat_session.send_message(message), timeout)
+
+
+async def stream_chat_message(
+    model: str, history: list, message, config=None, timeout: float = None
+):
+    """
+    Send a message on top of a chat history and yield the reply in chunks.
+    The slot is held for the whole stream, and timeout applies to the wait
+    for each chunk. Closing the generator cancels the upstream request.
+    """
+    chat_session = get_client().aio.chats.create(
+        model=model, history=history, config=config
+    )
+    timeout = timeout or LLM_TIMEOUT_SECONDS
+    async with model_slot():
+        stream = await asyncio.wait_for(
+            chat_session.send_message_stream(message), timeout
+        )
+        async with aclosing(stream):
+            while True:
+                try:
+                    chunk = await asyncio.wait_for(stream.__anext__(), timeout)
+                except StopAsyncIteration:
+                    return
+                yield chunk
+
+
+async def create_cache(model: str, contents: list, ttl_seconds: int, display_name: str):
+    """
+    Store contents on the provider for later calls to reference.
+    """
+    return await call_model(
+        lambda: get_client().aio.caches.create(
+            model=model,
+            config=CreateCachedContentConfig(
+                contents=contents,
+                ttl=f"{ttl_seconds}s",
+                display_name=display_name,
+            ),
+        )
+    )
+
+
+async def delete_cache(name: str):
+    """
+    Delete a provider-side cache.
+    """
+    return await call_model(lambda: get_client().aio.caches.delete(name=name))
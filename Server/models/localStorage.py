@@ -0,0 +1,125 @@
+import hashlib
+import hmac
+import os
+import secrets
+import shutil
+import tempfile
+import time
+
+# --- Local Storage Configuration ---
+# Directory holding one subdirectory per bucket when STORAGE_BACKEND is
+# "filesystem"
+STORAGE_DIR = os.getenv(
+    "STORAGE_DIR", os.path.join(tempfile.gettempdir(), "codelm-storage")
+)
+# Base URL of this server, local objects are uploaded and served through it
+STORAGE_PUBLIC_URL = os.getenv("STORAGE_PUBLIC_URL", "http://localhost:8000").rstrip(
+    "/"
+)
+# Key signing the upload URLs, every server process must use the same one
+STORAGE_SIGNING_KEY = os.getenv(
+    "STORAGE_SIGNING_KEY", os.getenv("SECRET_KEY") or secrets.token_hex(32)
+)
+# Signed upload URLs expire after this many seconds, as Supabase's do
+STORAGE_SIGNED_URL_SECONDS = int(os.getenv("STORAGE_SIGNED_URL_SECONDS", "7200"))
+
+
+def object_path(file_path: str, bucket_name: str) -> str:
+    """
+    Get the local path of an object.
+    Raises ValueError for paths that would leave the bucket's directory.
+    """
+    root = os.path.realpath(os.path.join(STORAGE_DIR, bucket_name))
+    path = os.path.realpath(os.path.join(root, file_path))
+    if path == root or os.path.commonpath([root, path]) != root:
+        raise ValueError(f"Invalid object path {bucket_name}/{file_path}")
+    return path
+
+
+def get_public_url(file_path: str, bucket_name: str) -> str:
+    return f"{STORAGE_PUBLIC_URL}/storage/v1/object/public/{bucket_name}/{file_path}"
+
+
+def sign(file_path: str, bucket_name: str, expires: int) -> str:
+    message = f"{bucket_name}/{file_path}:{expires}".encode("utf-8")
+    return hmac.new(
+        STORAGE_SIGNING_KEY.encode("utf-8"), message, hashlib.sha256
+    ).hexdigest()
+
+
+def create_signed_upload_url(file_path: str, bucket_name: str) -> dict:
+    """
+    Create a URL a client can upload an object to, in the shape
+    storage.create_signed_upload_url returns.
+    """
+    expires = int(time.time()) + STORAGE_SIGNED_URL_SECONDS
+    token = f"{expires}.{sign(file_path, bucket_name, expires)}"
+    return {
+        "signed_url": f"{STORAGE_PUBLIC_URL}/storage/v1/object/upload/sign/"
+        f"{bucket_name}/{file_path}?token={token}",
+        "token": token,
+        "path": file_path,
+    }
+
+
+def verify_upload_token(file_path: str, bucket_name: str, token: str) -> bool:
+    """
+    Check that a token was issued for this object and has not expired.
+    """
+    expires, _, signature = token.partition(".")
+    if not expires.isdigit() or int(expires) < time.time():
+        return False
+    return hmac.compare_digest(signature, sign(file_path, bucket_name, int(expires)))
+
+
+async def write_object(chunks, file_path: str, bucket_name: str, upsert: bool):
+    """
+    Write an object from an async iterator of bytes. The object only appears
+    once complete, so readers never see a partial one.
+    Returns False when it exists and upsert is not set.
+    """
+    path = object_path(file_path, bucket_name)
+    if not upsert and os.path.exists(path):
+        return False
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    handle, temporary = tempfile.mkstemp(dir=os.path.dirname(path), prefix=".tmp-")
+    try:
+        with os.fdopen(handle, "wb") as object_file:
+            async for chunk in chunks:
+                object_file.write(chunk)
+        os.replace(temporary, path)
+    except BaseException:
+        os.remove(temporary)
+        raise
+    return True
+
+
+def get_file_size(file_path: str, bucket_name: str):
+    try:
+        return os.path.getsize(object_path(file_path, bucket_name))
+    except (OSError, ValueError):
+        return None
+
+
+def copy_file(source_path: str, destination_path: str, bucket_name: str):
+    destination = object_path(destination_path, bucket_name)
+    os.makedirs(os.path.dirname(destination), exist_ok=True)
+    handle, temporary = tempfile.mkstemp(
+        dir=os.path.dirname(destination), prefix=".tmp-"
+    )
+    os.close(handle)
+    try:
+        shutil.copyfile(object_path(source_path, bucket_name), temporary)
+        os.replace(temporary, destination)
+    except BaseException:
+        os.remove(temporary)
+        raise
+    return destination_path
+
+
+def delete_file(file_path: str, bucket_name: str) -> bool:
+    try:
+        os.remove(object_path(file_path, bucket_name))
+        return True
+    except FileNotFoundError:
+        return False
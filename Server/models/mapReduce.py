@@ -0,0 +1,232 @@
+import asyncio
+import datetime
+import hashlib
+import os
+
+from models.contextPacker import estimate_tokens, truncate_to_tokens
+from models.notebookModel import db
+
+# --- Map-Reduce Configuration ---
+# Notebooks whose sources are past this size are condensed before generating
+MAP_REDUCE_MIN_TOKENS = int(os.getenv("MAP_REDUCE_MIN_TOKENS", "150000"))
+# Size of the pieces of a source summarized by one map call
+MAP_CHUNK_TOKENS = int(os.getenv("MAP_CHUNK_TOKENS", "24000"))
+# Map and reduce calls of a single generation in flight at the same time
+MAP_CONCURRENCY = int(os.getenv("MAP_CONCURRENCY", "8"))
+# Notes merged by one reduce call, and the size the final notes are reduced to
+REDUCE_INPUT_TOKENS = int(os.getenv("REDUCE_INPUT_TOKENS", "48000"))
+# Unused chunk summaries are deleted after this many days
+CHUNK_SUMMARY_TTL_DAYS = int(os.getenv("CHUNK_SUMMARY_TTL_DAYS", "30"))
+
+MAP_PROMPT = """Write detailed notes on the following part of a document, for someone who
+will later write FAQs, a study guide and a briefing from the notes of every part.
+Keep the key points, definitions, findings, figures, and the names of the files,
+functions, classes and terms, and leave out anything else.
+
+Source: {file_name} (part {part} of {parts})
+Content:
+{content}
+
+Notes:
+"""
+
+REDUCE_PROMPT = """Merge the following notes on parts of a set of documents into a single set
+of notes. Keep every distinct key point, definition and finding and the names of
+the sources, functions and terms they relate to, and merge repeated points.
+
+Notes:
+{notes}
+
+Merged notes:
+"""
+
+# One document per chunk text, shared by every notebook holding that text
+chunk_summaries_collection = db["chunk_summaries"]
+
+map_reduce_stats = {
+    "runs": 0,
+    "chunks": 0,
+    "chunk_summary_hits": 0,
+    "map_calls": 0,
+    "reduce_calls": 0,
+}
+
+
+def get_map_reduce_stats():
+    """
+    Get the chunk, cache hit and model call counters of map-reduce generation.
+    """
+    return dict(map_reduce_stats)
+
+
+def split_source(text: str, max_tokens: int = MAP_CHUNK_TOKENS) -> list:
+    """
+    Split a source on line boundaries into pieces of at most max_tokens.
+    Pieces only depend on the source itself, so that they keep their hash
+    when other sources are added to the notebook.
+    """
+    limit = int(max_tokens * len(text) / max(estimate_tokens(text), 1))
+    pieces = []
+    start = 0
+    while start < len(text):
+        end = min(start + limit, len(text))
+        if end < len(text):
+            cut = text.rfind("\n", start + limit // 2, end)
+            if cut != -1:
+                end = cut + 1
+        pieces.append(text[start:end])
+        start = end
+    return pieces
+
+
+def chunk_hash(text: str) -> str:
+    # The map prompt is part of the hash, editing it retires older summaries
+    return hashlib.sha256(f"{MAP_PROMPT}\0{text}".encode("utf-8")).hexdigest()
+
+
+async def get_chunk_summaries(hashes: list) -> dict:
+    """
+    Get the cached summaries of chunks by their hash.
+    """
+    try:
+        entries = await chunk_summaries_collection.find(
+            {"_id": {"$in": hashes}}, {"summary": 1}
+        ).to_list(length=None)
+    except Exception as e:
+        print(f"Error reading chunk summaries: {e}")
+        return {}
+    if entries:
+        # Keep the summaries that are still in use from expiring
+        await chunk_summaries_collection.update_many(
+            {"_id": {"$in": [entry["_id"] for entry in entries]}},
+            {"$set": {"used_at": datetime.datetime.utcnow()}},
+        )
+    return {entry["_id"]: entry["summary"] for entry in entries}
+
+
+async def store_chunk_summary(key: str, summary: str):
+    try:
+        await chunk_summaries_collection.update_one(
+            {"_id": key},
+            {"$set": {"summary": summary, "used_at": datetime.datetime.utcnow()}},
+            upsert=True,
+        )
+    except Exception as e:
+        print(f"Error storing chunk summary {key}: {e}")
+
+
+async def map_sources(sources: list, generate, semaphore: asyncio.Semaphore):
+    """
+    Summarize the chunks of every source, reusing the summaries of chunks
+    that were already mapped. sources is a list of dicts with "file_name" and
+    "content". Returns the notes of every chunk in source order and the
+    number of chunks that had to be mapped.
+    """
+    chunks = []
+    for source in sources:
+        pieces = split_source(source["content"])
+        for index, piece in enumerate(pieces):
+            chunks.append(
+                {
+                    "file_name": source["file_name"],
+                    "part": index + 1,
+                    "parts": len(pieces),
+                    "content": piece,
+                    "hash": chunk_hash(piece),
+                }
+            )
+    cached = await get_chunk_summaries(list({chunk["hash"] for chunk in chunks}))
+    map_reduce_stats["chunks"] += len(chunks)
+
+    async def summarize(chunk):
+        summary = cached.get(chunk["hash"])
+        if summary is not None:
+            map_reduce_stats["chunk_summary_hits"] += 1
+        else:
+            async with semaphore:
+                map_reduce_stats["map_calls"] += 1
+                summary = await generate(MAP_PROMPT.format(**chunk))
+            await store_chunk_summary(chunk["hash"], summary)
+        header = f"--- Source: {chunk['file_name']}"
+        if chunk["parts"] > 1:
+            header += f" (part {chunk['part']} of {chunk['parts']})"
+        return f"{header} ---\n{summary.strip()}"
+
+    notes = await asyncio.gather(*(summarize(chunk) for chunk in chunks))
+    return notes, sum(1 for chunk in chunks if chunk["hash"] not in cached)
+
+
+def group_notes(notes: list, max_tokens: int) -> list:
+    """
+    Group consecutive notes into groups of at most max_tokens, and of at
+    least two notes so that every reduce level shrinks the list.
+    """
+    groups = []
+    group = []
+    used = 0
+    for note in notes:
+        tokens = estimate_tokens(note)
+        if len(group) >= 2 and used + tokens > max_tokens:
+            groups.append(group)
+            group = []
+            used = 0
+        group.append(note)
+        used += tokens
+    if group:
+        groups.append(group)
+    return groups
+
+
+async def reduce_notes(notes: list, generate, semaphore: asyncio.Semaphore):
+    """
+    Merge notes level by level, each group of a level in parallel, until they
+    fit in REDUCE_INPUT_TOKENS. Returns the notes and the number of levels.
+    """
+    levels = 0
+    while len(notes) > 1 and estimate_tokens("\n\n".join(notes)) > REDUCE_INPUT_TOKENS:
+        levels += 1
+
+        async def merge(group):
+            if len(group) == 1:
+                return group[0]
+            async with semaphore:
+                map_reduce_stats["reduce_calls"] += 1
+                return await generate(REDUCE_PROMPT.format(notes="\n\n".join(group)))
+
+        groups = group_notes(notes, REDUCE_INPUT_TOKENS)
+        notes = list(await asyncio.gather(*(merge(group) for group in groups)))
+    combined = "\n\n".join(notes)
+    # A single note larger than the budget can't be merged any further
+    return truncate_to_tokens(combined, REDUCE_INPUT_TOKENS), levels
+
+
+async def condense_sources(sources: list, generate):
+    """
+    Condense sources too large for a single prompt into notes: every chunk
+    is summarized (map), then the summaries are merged hierarchically
+    (reduce). generate is an async function sending a prompt to the model.
+    Returns the notes and a report of the chunks mapped and reduce levels.
+    """
+    map_reduce_stats["runs"] += 1
+    semaphore = asyncio.Semaphore(MAP_CONCURRENCY)
+    notes, mapped = await map_sources(sources, generate, semaphore)
+    print(f"Mapped {mapped} of {len(notes)} chunks, reducing their notes")
+    combined, levels = await reduce_notes(notes, generate, semaphore)
+    return combined, {
+        "chunks": len(notes),
+        "mapped_chunks": mapped,
+        "reduce_levels": levels,
+        "notes_tokens": estimate_tokens(combined),
+    }
+
+
+async def ensure_map_reduce_indexes():
+    """
+    Create the MongoDB index expiring unused chunk summaries.
+    """
+    try:
+        await chunk_summaries_collection.create_index(
+            "used_at", expireAfterSeconds=CHUNK_SUMMARY_TTL_DAYS * 24 * 3600
+        )
+    except Exception as e:
+        print(f"Error creating chunk summary indexes: {e}")
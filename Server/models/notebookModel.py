@@ -1,13 +1,18 @@
+import asyncio
 import datetime
 import os
 from http.client import HTTPException
 
-from pymongo import AsyncMongoClient
+from pymongo import AsyncMongoClient, ReturnDocument
+from pymongo.errors import BulkWriteError, DuplicateKeyError
 
 MONGO_URI = os.getenv("MONGO_URI", "mongodb://localhost:27017")
 
 mongo_client = AsyncMongoClient(MONGO_URI)
 db = mongo_client["CodeLM"]
+# A claim on moving a file to its blob, or on deleting a blob, older than this
+# is taken over, its holder is taken to have died
+BLOB_LEASE_SECONDS = int(os.getenv("BLOB_LEASE_SECONDS", "300"))
 # each notebook is a collection that holds the user's input and the model's output
 
 
@@ -78,6 +83,36 @@ async def delete_notebook(notebook_id: str):
     return {"detail": "Notebook deleted"}
 
 
+def build_file_metadata(
+    notebook_id: str,
+    file_name: str,
+    file_type: str,
+    file_size: int,
+    file_original_name: str,
+    public_url: str = None,
+    content_hash: str = None,
+    blob_path: str = None,
+):
+    """
+    Build the notebook_files document of a file.
+    blob_path is the content-addressed storage object shared by identical files.
+    """
+    return {
+        "file_name": file_name,
+        "file_type": file_type,
+        "file_size": file_size,
+        "file_original_name": file_original_name,
+        "notebook_id": notebook_id,
+        "public_url": public_url,
+        "content_hash": content_hash,
+        "blob_path": blob_path,
+        "metadata": {
+            "created_at": datetime.datetime.utcnow(),
+            "updated_at": datetime.datetime.utcnow(),
+        },
+    }
+
+
 async def insert_file_metadata(
     notebook_id: str,
     file_name: str,
@@ -85,6 +120,8 @@ async def insert_file_metadata(
     file_size: int,
     file_original_name: str,
     public_url: str = None,
+    content_hash: str = None,
+    blob_path: str = None,
 ):
     """
     Insert file metadata into the notebook.
@@ -94,26 +131,223 @@ async def insert_file_metadata(
         if notebook_collection is None:
             raise HTTPException(status_code=404, detail="Notebook not found")
         await notebook_collection.insert_one(
+            build_file_metadata(
+                notebook_id,
+                file_name,
+                file_type,
+                file_size,
+                file_original_name,
+                public_url,
+                content_hash,
+                blob_path,
+            )
+        )
+        return {"detail": "File metadata inserted"}
+    except Exception as e:
+        raise HTTPException(
+            status_code=500, detail=f"Error inserting file metadata: {str(e)}"
+        )
+
+
+async def insert_many_file_metadata(records: list):
+    """
+    Insert the metadata of several files with a single bulk write.
+    records are documents built with build_file_metadata. Files already
+    registered in the notebook are skipped.
+    """
+    if not records:
+        return {"detail": "No file metadata to insert"}
+    try:
+        notebook_collection = db["notebook_files"]
+        await notebook_collection.insert_many(records, ordered=False)
+        return {"detail": f"{len(records)} file metadata inserted"}
+    except BulkWriteError as e:
+        errors = e.details.get("writeErrors", [])
+        if errors and all(error.get("code") == 11000 for error in errors):
+            inserted = len(records) - len(errors)
+            return {"detail": f"{inserted} file metadata inserted"}
+        raise HTTPException(
+            status_code=500, detail=f"Error inserting file metadata: {str(e)}"
+        )
+    except Exception as e:
+        raise HTTPException(
+            status_code=500, detail=f"Error inserting file metadata: {str(e)}"
+        )
+
+
+async def get_registered_file_names(notebook_id: str, file_names: list) -> set:
+    """
+    Get which of the given file names have a notebook_files record.
+    """
+    try:
+        notebook_collection = db["notebook_files"]
+        registered = await notebook_collection.distinct(
+            "file_name",
+            {"notebook_id": notebook_id, "file_name": {"$in": list(file_names)}},
+        )
+        return set(registered)
+    except Exception as e:
+        raise HTTPException(
+            status_code=500, detail=f"Error fetching file metadata: {str(e)}"
+        )
+
+
+async def set_file_blob(
+    file_name: str, notebook_id: str, content_hash: str, blob_path: str
+):
+    """
+    Point a file at its content-addressed blob, and end its migration claim.
+    """
+    try:
+        notebook_collection = db["notebook_files"]
+        await notebook_collection.update_one(
+            {"file_name": file_name, "notebook_id": notebook_id},
+            {
+                "$set": {
+                    "content_hash": content_hash,
+                    "blob_path": blob_path,
+                    "metadata.updated_at": datetime.datetime.utcnow(),
+                },
+                "$unset": {"migrating_at": ""},
+            },
+        )
+        return {"detail": "File blob updated"}
+    except Exception as e:
+        print(f"Error updating blob of {file_name}: {e}")
+        return None
+
+
+async def claim_file_migration(file_name: str, notebook_id: str) -> bool:
+    """
+    Claim the move of a file stored before deduplication to its blob, so that
+    of the requests reading it for the first time only one moves it. Returns
+    False when the file has a blob or another claim is within its lease.
+    """
+    claimed_at = datetime.datetime.utcnow()
+    stale_before = claimed_at - datetime.timedelta(seconds=BLOB_LEASE_SECONDS)
+    try:
+        result = await db["notebook_files"].update_one(
             {
                 "file_name": file_name,
-                "file_type": file_type,
-                "file_size": file_size,
-                "file_original_name": file_original_name,
                 "notebook_id": notebook_id,
-                "public_url": public_url,
-                "metadata": {
-                    "created_at": datetime.datetime.utcnow(),
-                    "updated_at": datetime.datetime.utcnow(),
-                },
-            }
+                "blob_path": None,
+                "$or": [
+                    {"migrating_at": {"$exists": False}},
+                    {"migrating_at": {"$lt": stale_before}},
+                ],
+            },
+            {"$set": {"migrating_at": claimed_at}},
+        )
+        return result.modified_count == 1
+    except Exception as e:
+        print(f"Error claiming the migration of {file_name}: {e}")
+        return False
+
+
+async def release_file_migration(file_name: str, notebook_id: str):
+    try:
+        await db["notebook_files"].update_one(
+            {"file_name": file_name, "notebook_id": notebook_id},
+            {"$unset": {"migrating_at": ""}},
         )
-        return {"detail": "File metadata inserted"}
+    except Exception as e:
+        print(f"Error releasing the migration of {file_name}: {e}")
+
+
+async def count_file_references(content_hash: str):
+    """
+    Count the notebook_files records, across all notebooks, that share a content hash.
+    This is the reference count of the blob and the extracted text of that content.
+    """
+    try:
+        notebook_collection = db["notebook_files"]
+        return await notebook_collection.count_documents({"content_hash": content_hash})
     except Exception as e:
         raise HTTPException(
-            status_code=500, detail=f"Error inserting file metadata: {str(e)}"
+            status_code=500, detail=f"Error counting file references: {str(e)}"
         )
 
 
+async def acquire_blob_reference(content_hash: str):
+    """
+    Take a reference on the blob and extracted text of a content hash before
+    relying on them, so that they are not deleted by a concurrent release.
+    Waits while a release is deleting them, unless its claim is stale.
+    """
+    references = db["blob_references"]
+    while True:
+        try:
+            await references.find_one_and_update(
+                {"_id": content_hash, "deleting": {"$ne": True}},
+                {"$inc": {"refs": 1}},
+                upsert=True,
+            )
+            return
+        except DuplicateKeyError:
+            pass
+        # Being deleted, the upsert can only insert once the release is done.
+        # A release that died mid-way is taken over: the blob is uploaded again
+        # when missing, and the text extracted again.
+        stale_before = datetime.datetime.utcnow() - datetime.timedelta(
+            seconds=BLOB_LEASE_SECONDS
+        )
+        taken = await references.find_one_and_update(
+            {
+                "_id": content_hash,
+                "deleting": True,
+                "$or": [
+                    {"deleting_at": {"$exists": False}},
+                    {"deleting_at": {"$lt": stale_before}},
+                ],
+            },
+            {"$set": {"refs": 1, "deleting": False}, "$unset": {"deleting_at": ""}},
+        )
+        if taken is not None:
+            return
+        await asyncio.sleep(0.1)
+
+
+async def release_blob_reference(content_hash: str) -> bool:
+    """
+    Drop a reference taken with acquire_blob_reference, or held by a
+    notebook_files record. Returns True when it was the last one: the caller
+    then owns the deletion of the blob and text, and must call
+    forget_blob_reference once they are deleted.
+    """
+    references = db["blob_references"]
+    reference = await references.find_one_and_update(
+        {"_id": content_hash, "deleting": {"$ne": True}},
+        {"$inc": {"refs": -1}},
+        return_document=ReturnDocument.AFTER,
+    )
+    if reference is not None and reference["refs"] > 0:
+        return False
+    # Files stored before reference counting have no reference document
+    try:
+        claimed = await references.find_one_and_update(
+            {"_id": content_hash, "refs": {"$lte": 0}, "deleting": {"$ne": True}},
+            {"$set": {"deleting": True, "deleting_at": datetime.datetime.utcnow()}},
+            upsert=reference is None,
+        )
+    except DuplicateKeyError:
+        return False
+    if claimed is None and reference is not None:
+        return False
+    # Records of files stored before reference counting still count
+    files = await count_file_references(content_hash)
+    if files:
+        await references.update_one(
+            {"_id": content_hash},
+            {"$set": {"refs": files, "deleting": False}, "$unset": {"deleting_at": ""}},
+        )
+        return False
+    return True
+
+
+async def forget_blob_reference(content_hash: str):
+    await db["blob_references"].delete_one({"_id": content_hash, "deleting": True})
+
+
 async def delete_file_metadata(file_name: str, notebook_id: str):
     """
     Delete file metadata from the notebook.
@@ -134,6 +368,70 @@ async def delete_file_metadata(file_name: str, notebook_id: str):
         )
 
 
+async def upsert_source_text(
+    content_hash: str, text: str, page_offsets: list, reason: str = None
+):
+    """
+    Store the extracted text of a source, keyed by the hash of its content.
+    A source that could not be extracted is stored with no text and the
+    reason why.
+    """
+    texts_collection = db["source_texts"]
+    update = {
+        "$set": {
+            "text": text,
+            "page_offsets": page_offsets,
+            "reason": reason,
+            "metadata.updated_at": datetime.datetime.utcnow(),
+        },
+        "$setOnInsert": {"metadata.created_at": datetime.datetime.utcnow()},
+    }
+    try:
+        try:
+            await texts_collection.update_one(
+                {"content_hash": content_hash}, update, upsert=True
+            )
+        except DuplicateKeyError:
+            # A concurrent upsert inserted it first, this one now updates it
+            await texts_collection.update_one(
+                {"content_hash": content_hash}, update, upsert=True
+            )
+        return {"detail": "Source text stored"}
+    except Exception as e:
+        raise HTTPException(
+            status_code=500, detail=f"Error storing source text: {str(e)}"
+        )
+
+
+async def get_source_texts(content_hashes: list):
+    """
+    Get the extracted text of the given content hashes, keyed by hash.
+    """
+    try:
+        texts_collection = db["source_texts"]
+        texts = await texts_collection.find(
+            {"content_hash": {"$in": list(content_hashes)}}
+        ).to_list(length=None)
+        return {text["content_hash"]: text for text in texts}
+    except Exception as e:
+        raise HTTPException(
+            status_code=500, detail=f"Error fetching source texts: {str(e)}"
+        )
+
+
+async def delete_source_text(content_hash: str):
+    """
+    Delete the extracted text of a content hash.
+    """
+    try:
+        texts_collection = db["source_texts"]
+        result = await texts_collection.delete_one({"content_hash": content_hash})
+        return result.deleted_count
+    except Exception as e:
+        print(f"Error deleting source text {content_hash}: {e}")
+        return None
+
+
 async def get_files(notebook_id: str):
     """
     Get all files in the notebook.
@@ -287,7 +585,7 @@ async def delete_all_file_metadata(notebook_id: str):
     Delete all file metadata associated with a notebook.
     """
     try:
-        result = await db.files.delete_many({"notebook_id": notebook_id})
+        result = await db["notebook_files"].delete_many({"notebook_id": notebook_id})
         return result.deleted_count
     except Exception as e:
         print(f"Error deleting file metadata for notebook {notebook_id}: {e}")
@@ -304,3 +602,47 @@ async def delete_notebook_messages(notebook_id: str):
     except Exception as e:
         print(f"Error deleting messages for notebook {notebook_id}: {e}")
         return None
+
+
+async def ensure_source_indexes():
+    """
+    Create the MongoDB indexes content reference counting relies on. A file
+    name is registered once per notebook and the text of a content hash is
+    stored once, duplicates left before the unique indexes existed are
+    removed first.
+    """
+    try:
+        files_collection = db["notebook_files"]
+        await files_collection.create_index("content_hash")
+        # Retried finalizations registered the same uploaded object again
+        duplicates = files_collection.aggregate(
+            [
+                {
+                    "$group": {
+                        "_id": {
+                            "notebook_id": "$notebook_id",
+                            "file_name": "$file_name",
+                        },
+                        "ids": {"$push": "$_id"},
+                    }
+                },
+                {"$match": {"ids.1": {"$exists": True}}},
+            ]
+        )
+        async for duplicate in await duplicates:
+            await files_collection.delete_many({"_id": {"$in": duplicate["ids"][1:]}})
+        await files_collection.create_index(
+            [("notebook_id", 1), ("file_name", 1)], unique=True
+        )
+        texts_collection = db["source_texts"]
+        duplicates = texts_collection.aggregate(
+            [
+                {"$group": {"_id": "$content_hash", "ids": {"$push": "$_id"}}},
+                {"$match": {"ids.1": {"$exists": True}}},
+            ]
+        )
+        async for duplicate in await duplicates:
+            await texts_collection.delete_many({"_id": {"$in": duplicate["ids"][1:]}})
+        await texts_collection.create_index("content_hash", unique=True)
+    except Exception as e:
+        print(f"Error creating source indexes: {e}")
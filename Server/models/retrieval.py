@@ -0,0 +1,479 @@
+import asyncio
+import heapq
+import math
+import os
+import re
+from collections import Counter
+
+from models.chunking import chunk_source, tokenize
+from models.notebookModel import db
+from models.vectorIndex import (
+    add_chunks,
+    delete_notebook_vectors,
+    get_vector_files,
+    remove_file,
+    search_vectors,
+)
+
+# --- Retrieval Configuration ---
+RETRIEVAL_TOP_K = int(os.getenv("RETRIEVAL_TOP_K", "8"))
+# Chunks holding definitions named in a question, put ahead of the ranked ones
+RETRIEVAL_MAX_DEFINITION_CHUNKS = int(os.getenv("RETRIEVAL_MAX_DEFINITION_CHUNKS", "4"))
+# "bm25", "vector" or "hybrid", which fuses both rankings
+RETRIEVAL_MODE = os.getenv("RETRIEVAL_MODE", "hybrid")
+# Rank offset of the reciprocal rank fusion
+RRF_K = 60
+BM25_K1 = float(os.getenv("BM25_K1", "1.2"))
+BM25_B = float(os.getenv("BM25_B", "0.75"))
+
+# One document per chunk, "terms" is a multikey index that acts as the posting lists
+chunks_collection = db["notebook_chunks"]
+# Per notebook chunk count and total chunk length, for the BM25 length normalization
+index_stats_collection = db["notebook_index_stats"]
+# One document per function, class or method of the code files of a notebook
+symbols_collection = db["notebook_symbols"]
+
+IDENTIFIER_PATTERN = re.compile(r"[A-Za-z_][A-Za-z0-9_]+")
+# Words of a question, with their dotted parts and a following call parenthesis
+CODE_TOKEN_PATTERN = re.compile(
+    r"[A-Za-z_][A-Za-z0-9_]*(?:\.[A-Za-z_][A-Za-z0-9_]*)*(?:\s*\()?"
+)
+BACKTICKED_PATTERN = re.compile(r"`([^`\n]+)`")
+CAMEL_CASE_PATTERN = re.compile(r"[a-z0-9][A-Z]")
+
+
+async def ensure_indexes():
+    """
+    Create the MongoDB indexes the inverted index relies on.
+    """
+    try:
+        await chunks_collection.create_index([("notebook_id", 1), ("terms", 1)])
+        await chunks_collection.create_index([("notebook_id", 1), ("file_name", 1)])
+        await index_stats_collection.create_index("notebook_id", unique=True)
+        await symbols_collection.create_index([("notebook_id", 1), ("key", 1)])
+        await symbols_collection.create_index([("notebook_id", 1), ("file_name", 1)])
+    except Exception as e:
+        print(f"Error creating retrieval indexes: {e}")
+
+
+async def get_indexed_files(notebook_id: str) -> set:
+    """
+    Get the names of the files of a notebook that are in its index.
+    """
+    return set(
+        await chunks_collection.distinct("file_name", {"notebook_id": notebook_id})
+    )
+
+
+async def index_source(notebook_id: str, file_name: str, text: str):
+    """
+    Chunk a source and add its chunks to the notebook's lexical and vector
+    indexes. Indexing a file again replaces its previous chunks.
+    """
+    return await index_sources(notebook_id, [(file_name, text)])
+
+
+def build_chunks(notebook_id: str, file_name: str, text: str):
+    """
+    Chunk a source into the chunk and symbol documents of the index.
+    """
+    source_chunks, symbols = chunk_source(text, file_name)
+    chunks = []
+    for chunk_index, chunk in enumerate(source_chunks):
+        term_freqs = Counter(tokenize(chunk["text"]))
+        if not term_freqs:
+            continue
+        chunks.append(
+            {
+                "notebook_id": notebook_id,
+                "file_name": file_name,
+                "chunk_index": chunk_index,
+                "start": chunk["start"],
+                "start_line": chunk["start_line"],
+                "end_line": chunk["end_line"],
+                "symbols": chunk.get("symbols", []),
+                "text": chunk["text"],
+                "terms": list(term_freqs),
+                "term_freqs": dict(term_freqs),
+                "length": sum(term_freqs.values()),
+            }
+        )
+    symbol_documents = [
+        {
+            "notebook_id": notebook_id,
+            "file_name": file_name,
+            "key": symbol["name"].lower(),
+            **symbol,
+        }
+        for symbol in symbols
+    ]
+    return chunks, symbol_documents
+
+
+async def index_sources(notebook_id: str, sources: list):
+    """
+    Index several sources with one write per index, sources is a list of
+    (file_name, text) pairs. Returns the number of chunks indexed.
+    """
+    await asyncio.gather(
+        *(delete_chunks(notebook_id, file_name) for file_name, _ in sources)
+    )
+    chunks_by_file = {}
+    chunks = []
+    symbols = []
+    for file_name, text in sources:
+        # Parsing a large code file takes a while, keep it off the event loop
+        file_chunks, file_symbols = await asyncio.to_thread(
+            build_chunks, notebook_id, file_name, text
+        )
+        chunks_by_file[file_name] = [
+            {"chunk_index": chunk["chunk_index"], "text": chunk["text"]}
+            for chunk in file_chunks
+        ]
+        chunks.extend(file_chunks)
+        symbols.extend(file_symbols)
+    await add_chunks(notebook_id, chunks_by_file)
+    if symbols:
+        await symbols_collection.insert_many(symbols, ordered=False)
+    if not chunks:
+        return 0
+    await chunks_collection.insert_many(chunks, ordered=False)
+    await index_stats_collection.update_one(
+        {"notebook_id": notebook_id},
+        {
+            "$inc": {
+                "chunk_count": len(chunks),
+                "total_length": sum(chunk["length"] for chunk in chunks),
+            }
+        },
+        upsert=True,
+    )
+    return len(chunks)
+
+
+async def unindex_source(notebook_id: str, file_name: str):
+    """
+    Remove the chunks of a source from the notebook's indexes.
+    """
+    await remove_file(notebook_id, file_name)
+    return await delete_chunks(notebook_id, file_name)
+
+
+async def delete_chunks(notebook_id: str, file_name: str):
+    """
+    Remove the chunks and symbols of a source from the notebook's lexical index.
+    """
+    await symbols_collection.delete_many(
+        {"notebook_id": notebook_id, "file_name": file_name}
+    )
+    lengths = await chunks_collection.find(
+        {"notebook_id": notebook_id, "file_name": file_name}, {"length": 1}
+    ).to_list(length=None)
+    if not lengths:
+        return 0
+    result = await chunks_collection.delete_many(
+        {"notebook_id": notebook_id, "file_name": file_name}
+    )
+    await index_stats_collection.update_one(
+        {"notebook_id": notebook_id},
+        {
+            "$inc": {
+                "chunk_count": -result.deleted_count,
+                "total_length": -sum(chunk["length"] for chunk in lengths),
+            }
+        },
+    )
+    return result.deleted_count
+
+
+async def delete_notebook_index(notebook_id: str):
+    """
+    Remove the whole index of a notebook.
+    """
+    try:
+        await chunks_collection.delete_many({"notebook_id": notebook_id})
+        await index_stats_collection.delete_one({"notebook_id": notebook_id})
+        await symbols_collection.delete_many({"notebook_id": notebook_id})
+        await delete_notebook_vectors(notebook_id)
+    except Exception as e:
+        print(f"Error deleting the index of notebook {notebook_id}: {e}")
+
+
+async def search(notebook_id: str, query: str, file_names: list, top_k: int):
+    """
+    Rank the chunks of the given files against a query with BM25.
+    Returns up to top_k chunk documents, best first, each with its "score".
+    """
+    terms = list(dict.fromkeys(tokenize(query)))
+    stats = await index_stats_collection.find_one({"notebook_id": notebook_id})
+    if not terms or not stats or stats.get("chunk_count", 0) <= 0:
+        return []
+    chunk_count = stats["chunk_count"]
+    average_length = max(stats["total_length"] / chunk_count, 1)
+
+    # Document frequencies are counted on the multikey index
+    document_frequencies = await asyncio.gather(
+        *(
+            chunks_collection.count_documents(
+                {"notebook_id": notebook_id, "terms": term}
+            )
+            for term in terms
+        )
+    )
+    idf = {
+        term: math.log(1 + (chunk_count - frequency + 0.5) / (frequency + 0.5))
+        for term, frequency in zip(terms, document_frequencies)
+        if frequency
+    }
+    if not idf:
+        return []
+
+    projection = {"file_name": 1, "chunk_index": 1, "text": 1, "length": 1}
+    projection.update({f"term_freqs.{term}": 1 for term in idf})
+    candidates = await chunks_collection.find(
+        {
+            "notebook_id": notebook_id,
+            "terms": {"$in": list(idf)},
+            "file_name": {"$in": list(file_names)},
+        },
+        projection,
+    ).to_list(length=None)
+
+    scored = []
+    for chunk in candidates:
+        normalization = BM25_K1 * (
+            1 - BM25_B + BM25_B * chunk["length"] / average_length
+        )
+        chunk["score"] = sum(
+            idf[term] * frequency * (BM25_K1 + 1) / (frequency + normalization)
+            for term, frequency in chunk.get("term_freqs", {}).items()
+        )
+        scored.append(chunk)
+    return heapq.nlargest(top_k, scored, key=lambda chunk: chunk["score"])
+
+
+async def find_symbols(notebook_id: str, names: list, file_names: list = None):
+    """
+    Look up definitions by name, case-insensitively.
+    Returns symbol documents with their file and line span.
+    """
+    keys = list({name.lower() for name in names})
+    if not keys:
+        return []
+    query = {"notebook_id": notebook_id, "key": {"$in": keys}}
+    if file_names is not None:
+        query["file_name"] = {"$in": list(file_names)}
+    return await symbols_collection.find(query, {"_id": 0, "key": 0}).to_list(
+        length=None
+    )
+
+
+async def search_symbols(notebook_id: str, prefix: str, limit: int = 50):
+    """
+    List the definitions of a notebook whose name starts with prefix.
+    """
+    return (
+        await symbols_collection.find(
+            {
+                "notebook_id": notebook_id,
+                "key": {"$regex": f"^{re.escape(prefix.lower())}"},
+            },
+            {"_id": 0, "key": 0, "notebook_id": 0},
+        )
+        .sort([("key", 1), ("file_name", 1), ("start_line", 1)])
+        .limit(limit)
+        .to_list(length=None)
+    )
+
+
+def code_identifiers(query: str) -> list:
+    """
+    Get the identifiers a question names as code: backticked, called, dotted,
+    snake_case or camelCase. Plain words are left out, they would bring in
+    any definition that happens to share their name.
+    """
+    names = []
+    for quoted in BACKTICKED_PATTERN.findall(query):
+        names.extend(IDENTIFIER_PATTERN.findall(quoted))
+    for match in CODE_TOKEN_PATTERN.finditer(BACKTICKED_PATTERN.sub(" ", query)):
+        token = match.group()
+        name = token.rstrip("( \t\n")
+        if (
+            token.endswith("(")
+            or "." in name
+            or "_" in name
+            or CAMEL_CASE_PATTERN.search(name)
+        ):
+            names.extend(IDENTIFIER_PATTERN.findall(name))
+    return list(dict.fromkeys(names))
+
+
+async def definition_chunks(notebook_id: str, query: str, file_names: list):
+    """
+    Get the chunks holding the definitions of identifiers named in a query,
+    so that asking about a function brings in its code. At most
+    RETRIEVAL_MAX_DEFINITION_CHUNKS are returned.
+    """
+    symbols = await find_symbols(notebook_id, code_identifiers(query), file_names)
+    if not symbols:
+        return []
+    return (
+        await chunks_collection.find(
+            {
+                "notebook_id": notebook_id,
+                "$or": [
+                    {
+                        "file_name": symbol["file_name"],
+                        "start_line": {"$lte": symbol["end_line"]},
+                        "end_line": {"$gte": symbol["start_line"]},
+                    }
+                    for symbol in symbols
+                ],
+            },
+            {"file_name": 1, "chunk_index": 1, "text": 1},
+        )
+        .limit(RETRIEVAL_MAX_DEFINITION_CHUNKS)
+        .to_list(length=None)
+    )
+
+
+async def get_chunks(notebook_id: str, keys: list):
+    """
+    Fetch chunk documents by (file_name, chunk_index).
+    """
+    if not keys:
+        return []
+    return await chunks_collection.find(
+        {
+            "notebook_id": notebook_id,
+            "$or": [
+                {"file_name": file_name, "chunk_index": chunk_index}
+                for file_name, chunk_index in keys
+            ],
+        },
+        {"file_name": 1, "chunk_index": 1, "text": 1},
+    ).to_list(length=None)
+
+
+async def rank_chunks(notebook_id: str, query: str, file_names: list, top_k: int):
+    """
+    Rank chunks with BM25, with vector similarity, or with both fused by
+    reciprocal rank, depending on RETRIEVAL_MODE.
+    Returns up to top_k chunk documents, best first.
+    """
+    if RETRIEVAL_MODE == "bm25":
+        return await search(notebook_id, query, file_names, top_k)
+
+    lexical, semantic = await asyncio.gather(
+        search(notebook_id, query, file_names, top_k)
+        if RETRIEVAL_MODE == "hybrid"
+        else asyncio.sleep(0, result=[]),
+        search_vectors(notebook_id, query, file_names, top_k),
+    )
+    fused = {}
+    for ranking in (lexical, semantic):
+        for rank, chunk in enumerate(ranking):
+            key = (chunk["file_name"], chunk["chunk_index"])
+            fused[key] = fused.get(key, 0.0) + 1.0 / (RRF_K + rank + 1)
+    best = heapq.nlargest(top_k, fused, key=fused.get)
+
+    # Vector hits only carry their position, their text comes from the chunk store
+    documents = {(chunk["file_name"], chunk["chunk_index"]): chunk for chunk in lexical}
+    missing = [key for key in best if key not in documents]
+    for chunk in await get_chunks(notebook_id, missing):
+        documents[(chunk["file_name"], chunk["chunk_index"])] = chunk
+    ranked = []
+    for key in best:
+        if key in documents:
+            documents[key]["score"] = fused[key]
+            ranked.append(documents[key])
+    return ranked
+
+
+async def restore_vectors(notebook_id: str, indexed_files: set):
+    """
+    Rebuild the vector rows of indexed files that the local vector index is
+    missing, as on a new server or after its directory was cleared, from the
+    chunks stored in MongoDB.
+    """
+    missing = indexed_files - await get_vector_files(notebook_id)
+    if not missing:
+        return
+    print(
+        f"Vector index of notebook {notebook_id} lacks {len(missing)} files, rebuilding"
+    )
+    chunks = await chunks_collection.find(
+        {"notebook_id": notebook_id, "file_name": {"$in": list(missing)}},
+        {"file_name": 1, "chunk_index": 1, "text": 1},
+    ).to_list(length=None)
+    chunks_by_file = {}
+    for chunk in chunks:
+        chunks_by_file.setdefault(chunk["file_name"], []).append(
+            {"chunk_index": chunk["chunk_index"], "text": chunk["text"]}
+        )
+    await add_chunks(notebook_id, chunks_by_file)
+
+
+async def select_relevant_sources(
+    notebook_id: str, sources: list, query: str, budget_chars: int
+):
+    """
+    Pick the chunks of the given sources that are most relevant to a query,
+    within budget_chars characters. Sources missing from the index are indexed
+    first, and restored in the vector index if only it lacks them.
+    sources is the list of (file_meta, text) pairs of load_source_texts.
+    Returns a list of {"file_name", "content"} entries in source order.
+    """
+    indexed_files = await get_indexed_files(notebook_id)
+    for file_meta, text in sources:
+        if text and file_meta["file_name"] not in indexed_files:
+            await index_source(notebook_id, file_meta["file_name"], text)
+    if RETRIEVAL_MODE != "bm25":
+        await restore_vectors(notebook_id, indexed_files)
+
+    file_names = [file_meta["file_name"] for file_meta, text in sources if text]
+    ranked = await rank_chunks(notebook_id, query, file_names, RETRIEVAL_TOP_K)
+    # Definitions of the identifiers the query names come first
+    definitions = await definition_chunks(notebook_id, query, file_names)
+    if definitions:
+        keys = {(chunk["file_name"], chunk["chunk_index"]) for chunk in definitions}
+        ranked = definitions + [
+            chunk
+            for chunk in ranked
+            if (chunk["file_name"], chunk["chunk_index"]) not in keys
+        ]
+    if not ranked:
+        # Nothing matches the query, fall back to the start of every source
+        share = budget_chars // max(len(file_names), 1)
+        return [
+            {"file_name": file_meta["file_original_name"], "content": text[:share]}
+            for file_meta, text in sources
+            if text
+        ]
+    selected = []
+    used_chars = 0
+    for chunk in ranked:
+        if used_chars + len(chunk["text"]) > budget_chars:
+            continue
+        selected.append(chunk)
+        used_chars += len(chunk["text"])
+
+    # Present the excerpts in source order, not score order
+    files_content = []
+    for file_meta, _ in sources:
+        excerpts = sorted(
+            (
+                chunk
+                for chunk in selected
+                if chunk["file_name"] == file_meta["file_name"]
+            ),
+            key=lambda chunk: chunk["chunk_index"],
+        )
+        if excerpts:
+            files_content.append(
+                {
+                    "file_name": file_meta["file_original_name"],
+                    "content": "\n...\n".join(chunk["text"] for chunk in excerpts),
+                }
+            )
+    return files_content
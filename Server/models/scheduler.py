@@ -0,0 +1,203 @@
+import asyncio
+import contextvars
+import heapq
+import itertools
+import math
+import os
+import time
+from collections import deque
+
+from cachetools import TTLCache
+from fastapi import HTTPException, status
+
+# --- Scheduler Configuration ---
+# Requests a user may start per minute, and how many at once after a pause
+SCHEDULER_RATE_PER_MINUTE = float(os.getenv("SCHEDULER_RATE_PER_MINUTE", "30"))
+SCHEDULER_BURST = float(os.getenv("SCHEDULER_BURST", "10"))
+# Model calls waiting for a slot, across users and per user, before refusing more
+SCHEDULER_MAX_QUEUE = int(os.getenv("SCHEDULER_MAX_QUEUE", "256"))
+SCHEDULER_USER_MAX_QUEUE = int(os.getenv("SCHEDULER_USER_MAX_QUEUE", "32"))
+# Comma separated user_id:weight pairs, a user with weight 2 gets twice the share
+SCHEDULER_USER_WEIGHTS = {
+    user: float(weight)
+    for user, weight in (
+        pair.split(":", 1)
+        for pair in os.getenv("SCHEDULER_USER_WEIGHTS", "").split(",")
+        if ":" in pair
+    )
+}
+
+ANONYMOUS_USER = "anonymous"
+
+# User the model calls of the current request are made for
+current_user = contextvars.ContextVar("current_user", default=ANONYMOUS_USER)
+
+# user -> (tokens, refilled_at). A bucket that would be full again is dropped,
+# a missing bucket is a full one
+buckets = TTLCache(maxsize=100000, ttl=SCHEDULER_BURST / SCHEDULER_RATE_PER_MINUTE * 60)
+
+# Weighted fair queue of the calls waiting for a slot: (finish tag, sequence,
+# user, future) entries, served in finish tag order
+wait_queue = []
+sequence = itertools.count()
+virtual_time = 0.0
+# user -> finish tag of their last queued call
+last_finish = {}
+queued_by_user = {}
+capacity = 0
+in_use = 0
+waiting = 0
+# Seconds a slot is held for, smoothed, to estimate Retry-After
+average_hold_seconds = 5.0
+
+scheduler_stats = {
+    "admitted": 0,
+    "rate_limited": 0,
+    "queue_full": 0,
+    "queued": 0,
+    "total_wait_seconds": 0.0,
+    "max_wait_seconds": 0.0,
+}
+# Most recent queue waits, for the percentiles
+recent_waits = deque(maxlen=1000)
+
+
+def get_scheduler_stats():
+    """
+    Get the admission counters and the queue wait times of the scheduler.
+    """
+    stats = dict(scheduler_stats)
+    waits = sorted(recent_waits)
+    for name, quantile in (("p50", 0.5), ("p95", 0.95), ("p99", 0.99)):
+        stats[f"wait_{name}_seconds"] = (
+            waits[min(int(len(waits) * quantile), len(waits) - 1)] if waits else 0.0
+        )
+    stats["waiting"] = waiting
+    stats["in_use"] = in_use
+    stats["capacity"] = capacity
+    stats["queued_by_user"] = {
+        user: count for user, count in queued_by_user.items() if count
+    }
+    return stats
+
+
+def configure(slots: int):
+    """
+    Set the number of model calls that may run at the same time.
+    """
+    global capacity
+    capacity = slots
+
+
+def user_weight(user: str) -> float:
+    return SCHEDULER_USER_WEIGHTS.get(user, 1.0)
+
+
+def too_many_requests(detail: str, retry_after: float):
+    return HTTPException(
+        status_code=status.HTTP_429_TOO_MANY_REQUESTS,
+        detail=detail,
+        headers={"Retry-After": str(max(math.ceil(retry_after), 1))},
+    )
+
+
+def admit(user_id: str = None):
+    """
+    Take a token from the user's bucket for a new request and make the
+    user the one the request's model calls are made for.
+    Raises a 429 HTTPException with Retry-After when the bucket is empty.
+    """
+    user = user_id or ANONYMOUS_USER
+    now = time.monotonic()
+    rate = SCHEDULER_RATE_PER_MINUTE / 60
+    tokens, refilled_at = buckets.get(user, (SCHEDULER_BURST, now))
+    tokens = min(SCHEDULER_BURST, tokens + (now - refilled_at) * rate)
+    if tokens < 1:
+        scheduler_stats["rate_limited"] += 1
+        raise too_many_requests(
+            "Too many requests, please slow down.", (1 - tokens) / rate
+        )
+    buckets[user] = (tokens - 1, now)
+    scheduler_stats["admitted"] += 1
+    current_user.set(user)
+
+
+def dispatch():
+    """
+    Hand free slots to the waiting calls with the smallest finish tags.
+    """
+    global in_use, virtual_time
+    while in_use < capacity and wait_queue:
+        finish, _, _, future = heapq.heappop(wait_queue)
+        if future.done():
+            # Timed out or cancelled while waiting
+            continue
+        virtual_time = finish
+        in_use += 1
+        future.set_result(None)
+    if not wait_queue:
+        last_finish.clear()
+
+
+async def acquire(timeout: float):
+    """
+    Wait for a model call slot, in weighted fair order between the users.
+    Raises a 429 HTTPException with Retry-After when the queue is full, and
+    TimeoutError when no slot frees up within timeout.
+    """
+    global in_use, waiting
+    user = current_user.get()
+    if in_use < capacity and not wait_queue:
+        in_use += 1
+        recent_waits.append(0.0)
+        return
+    retry_after = (waiting / max(capacity, 1) + 1) * average_hold_seconds
+    if waiting >= SCHEDULER_MAX_QUEUE:
+        scheduler_stats["queue_full"] += 1
+        raise too_many_requests("The AI service is busy, please retry.", retry_after)
+    if queued_by_user.get(user, 0) >= SCHEDULER_USER_MAX_QUEUE:
+        scheduler_stats["queue_full"] += 1
+        raise too_many_requests("Too many requests in progress.", retry_after)
+
+    # Each call moves the user's finish tag forward by 1/weight
+    finish = max(virtual_time, last_finish.get(user, 0.0)) + 1 / user_weight(user)
+    last_finish[user] = finish
+    future = asyncio.get_running_loop().create_future()
+    heapq.heappush(wait_queue, (finish, next(sequence), user, future))
+    queued_at = time.monotonic()
+    waiting += 1
+    queued_by_user[user] = queued_by_user.get(user, 0) + 1
+    scheduler_stats["queued"] += 1
+    # Slots may be free behind calls that gave up waiting
+    dispatch()
+    try:
+        await asyncio.wait_for(asyncio.shield(future), timeout)
+    except BaseException:
+        if future.done() and not future.cancelled():
+            # The slot was granted as the wait was given up
+            release(0.0)
+        else:
+            future.cancel()
+        raise
+    finally:
+        waiting -= 1
+        queued_by_user[user] -= 1
+        if not queued_by_user[user]:
+            del queued_by_user[user]
+        waited = time.monotonic() - queued_at
+        scheduler_stats["total_wait_seconds"] += waited
+        scheduler_stats["max_wait_seconds"] = max(
+            scheduler_stats["max_wait_seconds"], waited
+        )
+        recent_waits.append(waited)
+
+
+def release(held_seconds: float):
+    """
+    Give back a slot taken with acquire.
+    """
+    global in_use, average_hold_seconds
+    in_use -= 1
+    if held_seconds:
+        average_hold_seconds = 0.9 * average_hold_seconds + 0.1 * held_seconds
+    dispatch()
@@ -0,0 +1,48 @@
+import asyncio
+
+# key -> task of the call in flight for it
+in_flight = {}
+
+singleflight_stats = {"calls": 0, "shared": 0}
+
+
+def get_singleflight_stats():
+    """
+    Get the number of calls made and of duplicate requests that shared one.
+    """
+    stats = dict(singleflight_stats)
+    stats["in_flight"] = len(in_flight)
+    return stats
+
+
+def normalize_input(text: str) -> str:
+    """
+    Normalize user input so that requests differing only in case or
+    whitespace share a key.
+    """
+    return " ".join(text.split()).casefold()
+
+
+async def coalesce(key: tuple, call):
+    """
+    Run call, a coroutine function, unless a call with the same key is in
+    flight, in which case its result or exception is shared instead.
+    A caller that goes away does not cancel the call for the others.
+    """
+    task = in_flight.get(key)
+    if task is None:
+        singleflight_stats["calls"] += 1
+        task = asyncio.ensure_future(call())
+        in_flight[key] = task
+
+        def forget(done):
+            if in_flight.get(key) is done:
+                del in_flight[key]
+            # Mark the exception as retrieved when every caller went away
+            if not done.cancelled():
+                done.exception()
+
+        task.add_done_callback(forget)
+    else:
+        singleflight_stats["shared"] += 1
+    return await asyncio.shield(task)
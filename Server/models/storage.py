@@ -1,20 +1,168 @@
+import asyncio
+import hashlib
+import io
 import os
-import requests
+import tempfile
+import urllib.parse
+import httpx
 from dotenv import load_dotenv
 from supabase import Client, create_client
-import fitz
+
+from models import blobCache, localStorage
 
 load_dotenv()
 
+# --- Storage Backend ---
+# "supabase", or "filesystem" to keep the buckets in local directories, for
+# development and tests without a Supabase project, see models/localStorage
+STORAGE_BACKEND = os.getenv("STORAGE_BACKEND", "supabase")
+
 url: str = os.getenv("SUPABASE_URL")
 key: str = os.getenv("SUPABASE_KEY")
-supabase: Client = create_client(url, key)
+supabase: Client = create_client(url, key) if STORAGE_BACKEND == "supabase" else None
+
+# --- Storage HTTP pool ---
+STORAGE_POOL_SIZE = int(os.getenv("STORAGE_POOL_SIZE", "20"))
+STORAGE_KEEPALIVE_CONNECTIONS = int(
+    os.getenv("STORAGE_KEEPALIVE_CONNECTIONS", str(STORAGE_POOL_SIZE))
+)
+STORAGE_CONNECT_TIMEOUT = float(os.getenv("STORAGE_CONNECT_TIMEOUT", "5"))
+STORAGE_READ_TIMEOUT = float(os.getenv("STORAGE_READ_TIMEOUT", "60"))
+STORAGE_POOL_TIMEOUT = float(os.getenv("STORAGE_POOL_TIMEOUT", "10"))
+# Process-wide cap on downloads in flight, shared by every request
+STORAGE_MAX_CONCURRENT_DOWNLOADS = int(
+    os.getenv("STORAGE_MAX_CONCURRENT_DOWNLOADS", "16")
+)
+download_semaphore = asyncio.Semaphore(STORAGE_MAX_CONCURRENT_DOWNLOADS)
+# Downloads larger than this are refused instead of being buffered
+STORAGE_MAX_DOWNLOAD_BYTES = int(
+    os.getenv("STORAGE_MAX_DOWNLOAD_BYTES", str(200 * 1024 * 1024))
+)
+# Downloads stay in memory up to this size and are spooled to disk beyond it
+STORAGE_SPOOL_MEMORY_BYTES = int(
+    os.getenv("STORAGE_SPOOL_MEMORY_BYTES", str(8 * 1024 * 1024))
+)
+DOWNLOAD_CHUNK_SIZE = 64 * 1024
+
+
+class UploadTooLarge(Exception):
+    """
+    Raised while streaming an upload that goes past its size limit.
+    """
+
+
+http_client: httpx.AsyncClient = None
+
+
+def get_http_client() -> httpx.AsyncClient:
+    """
+    Get the shared keep-alive HTTP client used for storage downloads.
+    """
+    global http_client
+    if http_client is None or http_client.is_closed:
+        http_client = httpx.AsyncClient(
+            limits=httpx.Limits(
+                max_connections=STORAGE_POOL_SIZE,
+                max_keepalive_connections=STORAGE_KEEPALIVE_CONNECTIONS,
+            ),
+            timeout=httpx.Timeout(
+                STORAGE_READ_TIMEOUT,
+                connect=STORAGE_CONNECT_TIMEOUT,
+                pool=STORAGE_POOL_TIMEOUT,
+            ),
+            follow_redirects=True,
+        )
+    return http_client
+
+
+async def close_http_client():
+    """
+    Close the shared HTTP client and its pooled connections.
+    """
+    global http_client
+    if http_client is not None and not http_client.is_closed:
+        await http_client.aclose()
+    http_client = None
+
+
+class SpooledBuffer:
+    """
+    Downloaded or uploaded bytes kept in memory while small and moved to a
+    temporary file once they grow past STORAGE_SPOOL_MEMORY_BYTES. The content
+    hash is computed while writing so the bytes never have to be read back for it.
+    """
+
+    def __init__(self, max_memory: int = STORAGE_SPOOL_MEMORY_BYTES):
+        self.max_memory = max_memory
+        self.buffer = io.BytesIO()
+        self.file = None
+        self.path = None
+        self.size = 0
+        self.hasher = hashlib.sha256()
+
+    def write(self, chunk: bytes):
+        self.size += len(chunk)
+        self.hasher.update(chunk)
+        if self.file is None and self.size > self.max_memory:
+            self.file = tempfile.NamedTemporaryFile(delete=False, suffix=".spool")
+            self.file.write(self.buffer.getvalue())
+            self.path = self.file.name
+            self.buffer = None
+        (self.file or self.buffer).write(chunk)
+
+    def finish(self):
+        if self.file is not None:
+            self.file.close()
+
+    @property
+    def content_hash(self) -> str:
+        return self.hasher.hexdigest()
+
+    @property
+    def source(self):
+        """
+        The bytes while in memory, otherwise the path of the spooled file.
+        """
+        return self.path if self.path is not None else self.buffer.getvalue()
+
+    async def iter_chunks(self, chunk_size: int = DOWNLOAD_CHUNK_SIZE):
+        """
+        Yield the spooled bytes back in chunks, for streaming them to storage.
+        """
+        if self.path is None:
+            content = self.buffer.getvalue()
+            for start in range(0, len(content), chunk_size):
+                yield content[start : start + chunk_size]
+            return
+        with open(self.path, "rb") as spooled:
+            for chunk in iter(lambda: spooled.read(chunk_size), b""):
+                yield chunk
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            try:
+                os.remove(self.path)
+            except OSError:
+                pass
+        self.file = None
+        self.path = None
+        self.buffer = None
+
+
+async def iterate_bytes(content: bytes, chunk_size: int = DOWNLOAD_CHUNK_SIZE):
+    for start in range(0, len(content), chunk_size):
+        yield content[start : start + chunk_size]
 
 
 async def upload(file: bytes, file_name: str, bucket_name: str, notebook_id: str):
     """
     Upload a file to Supabase storage.
     """
+    if STORAGE_BACKEND == "filesystem":
+        return await upload_stream(
+            iterate_bytes(file), f"{notebook_id}/{file_name}", bucket_name
+        )
     try:
         # Upload the file
         response = supabase.storage.from_(bucket_name).upload(
@@ -35,10 +183,170 @@ async def upload(file: bytes, file_name: str, bucket_name: str, notebook_id: str
         return None
 
 
+def get_public_url(file_path: str, bucket_name: str) -> str:
+    """
+    Get the public URL of a stored file.
+    """
+    if STORAGE_BACKEND == "filesystem":
+        return localStorage.get_public_url(file_path, bucket_name)
+    return supabase.storage.from_(bucket_name).get_public_url(file_path)
+
+
+def storage_headers():
+    """
+    Authentication headers for the Supabase storage REST API.
+    """
+    return {"Authorization": f"Bearer {key}", "apikey": key}
+
+
+async def upload_stream(
+    chunks,
+    file_path: str,
+    bucket_name: str,
+    content_type: str = None,
+    content_length: int = None,
+    upsert: bool = False,
+):
+    """
+    Stream a file to Supabase storage chunk by chunk.
+    chunks is an async iterator of bytes, it may raise UploadTooLarge.
+    Returns the public URL of the uploaded file, or None on failure.
+    """
+    if STORAGE_BACKEND == "filesystem":
+        try:
+            if not await localStorage.write_object(
+                chunks, file_path, bucket_name, upsert
+            ):
+                print(f"Error uploading file: {file_path} already exists")
+                return None
+        except UploadTooLarge:
+            raise
+        except Exception as e:
+            print(f"Exception occurred: {e}")
+            return None
+        return get_public_url(file_path, bucket_name)
+    headers = {
+        **storage_headers(),
+        "Content-Type": content_type or "application/octet-stream",
+        "x-upsert": "true" if upsert else "false",
+    }
+    if content_length:
+        # A known length avoids chunked transfer encoding
+        headers["Content-Length"] = str(content_length)
+    try:
+        response = await get_http_client().post(
+            f"{url}/storage/v1/object/{bucket_name}/{file_path}",
+            content=chunks,
+            headers=headers,
+        )
+        response.raise_for_status()
+        print(f"File {file_path} uploaded successfully.")
+        return get_public_url(file_path, bucket_name)
+    except UploadTooLarge:
+        raise
+    except httpx.HTTPError as e:
+        print(f"Error uploading file: {e}")
+        return None
+    except Exception as e:
+        print(f"Exception occurred: {e}")
+        return None
+
+
+async def create_signed_upload_url(file_path: str, bucket_name: str):
+    """
+    Create a URL the client can upload a file to directly, bypassing the API.
+    Returns a dict with the signed URL, its token and the object path, or None.
+    """
+    if STORAGE_BACKEND == "filesystem":
+        return localStorage.create_signed_upload_url(file_path, bucket_name)
+    try:
+        response = await get_http_client().post(
+            f"{url}/storage/v1/object/upload/sign/{bucket_name}/{file_path}",
+            headers=storage_headers(),
+        )
+        response.raise_for_status()
+        signed_path = response.json()["url"]
+        query = urllib.parse.parse_qs(urllib.parse.urlparse(signed_path).query)
+        return {
+            "signed_url": f"{url}/storage/v1/{signed_path.lstrip('/')}",
+            "token": query["token"][0],
+            "path": file_path,
+        }
+    except httpx.HTTPError as e:
+        print(f"Error creating signed upload URL: {e}")
+        return None
+    except Exception as e:
+        print(f"Exception occurred: {e}")
+        return None
+
+
+async def get_file_size(file_path: str, bucket_name: str):
+    """
+    Get the size of a stored file in bytes, or None if it does not exist.
+    """
+    if STORAGE_BACKEND == "filesystem":
+        return await asyncio.to_thread(
+            localStorage.get_file_size, file_path, bucket_name
+        )
+    try:
+        response = await get_http_client().head(
+            f"{url}/storage/v1/object/authenticated/{bucket_name}/{file_path}",
+            headers=storage_headers(),
+        )
+        if response.status_code in (400, 404):
+            return None
+        response.raise_for_status()
+        return int(response.headers.get("content-length") or 0)
+    except httpx.HTTPError as e:
+        print(f"Error checking file {file_path}: {e}")
+        return None
+
+
+async def copy_file(source_path: str, destination_path: str, bucket_name: str):
+    """
+    Copy a stored file inside its bucket without downloading it.
+    """
+    if STORAGE_BACKEND == "filesystem":
+        try:
+            return await asyncio.to_thread(
+                localStorage.copy_file, source_path, destination_path, bucket_name
+            )
+        except (OSError, ValueError) as e:
+            print(f"Error copying {source_path} to {destination_path}: {e}")
+            return None
+    try:
+        response = await get_http_client().post(
+            f"{url}/storage/v1/object/copy",
+            json={
+                "bucketId": bucket_name,
+                "sourceKey": source_path,
+                "destinationKey": destination_path,
+            },
+            headers=storage_headers(),
+        )
+        response.raise_for_status()
+        return destination_path
+    except httpx.HTTPError as e:
+        print(f"Error copying {source_path} to {destination_path}: {e}")
+        return None
+
+
 async def delete_file(file_path: str, bucket_name: str):
     """
     Delete a file from Supabase storage.
     """
+    if STORAGE_BACKEND == "filesystem":
+        try:
+            if await asyncio.to_thread(
+                localStorage.delete_file, file_path, bucket_name
+            ):
+                print(f"File {file_path} deleted successfully.")
+                return [file_path]
+            print(f"Error deleting file: {file_path} does not exist")
+            return None
+        except Exception as e:
+            print(f"Exception occurred: {e}")
+            return None
     try:
         # Delete the file
         response = supabase.storage.from_(bucket_name).remove([file_path])
@@ -53,50 +361,82 @@ async def delete_file(file_path: str, bucket_name: str):
         return None
 
 
-async def read_file(file_path: str, bucket_name: str, file_type: str):
+async def download_file(file_path: str, bucket_name: str, content_hash: str = None):
     """
-    Read a file from Supabase storage and return its content.
+    Stream a file from Supabase storage into a SpooledBuffer.
+    Objects with a known content hash are served from the local disk cache
+    when possible, and cached after downloading.
+    Returns None if the download fails or exceeds STORAGE_MAX_DOWNLOAD_BYTES.
+    The caller must close() the returned download.
     """
+    if STORAGE_BACKEND == "filesystem":
+        return await open_local_file(file_path, bucket_name, content_hash)
+    cache_path = f"{bucket_name}/{file_path}"
+    cached = blobCache.lookup(cache_path, content_hash)
+    if cached is not None:
+        return blobCache.CachedBlob(cached, content_hash)
+
+    spool = SpooledBuffer()
     try:
         # Get the public URL for the file
         public_url = supabase.storage.from_(bucket_name).get_public_url(file_path)
         if not public_url:
             print(f"Could not generate public URL for {file_path}")
+            spool.close()
             return None
 
-        # Fetch the file content
-        response = requests.get(public_url)
-        response.raise_for_status()  # Raise exception for HTTP errors
+        # Stream the file content over the shared connection pool
+        async with download_semaphore:
+            async with get_http_client().stream("GET", public_url) as response:
+                response.raise_for_status()  # Raise exception for HTTP errors
+                content_length = int(response.headers.get("content-length") or 0)
+                if content_length > STORAGE_MAX_DOWNLOAD_BYTES:
+                    raise ValueError(
+                        f"{file_path} is {content_length} bytes, "
+                        f"the limit is {STORAGE_MAX_DOWNLOAD_BYTES}"
+                    )
+                async for chunk in response.aiter_bytes(DOWNLOAD_CHUNK_SIZE):
+                    spool.write(chunk)
+                    if spool.size > STORAGE_MAX_DOWNLOAD_BYTES:
+                        raise ValueError(
+                            f"{file_path} exceeds the limit of "
+                            f"{STORAGE_MAX_DOWNLOAD_BYTES} bytes"
+                        )
+        spool.finish()
+        if content_hash is not None:
+            await asyncio.to_thread(blobCache.store, spool, cache_path, content_hash)
+        return spool
 
-        # Process based on file type
+    except httpx.HTTPError as e:
+        print(f"Error fetching file from URL: {e}")
+        spool.close()
+        return None
+    except Exception as e:
+        print(f"Exception occurred: {e}")
+        spool.close()
+        return None
 
-        # Handle document files that need conversion to markdown
-        if file_type == "application/pdf":
-            try:
-                doc = fitz.open(stream=response.content, filetype="pdf")
-                md_text = ""
-                for page in doc:
-                    md_text += page.get_text("text")
-                doc.close()
-                return md_text
-            except Exception as e:
-                print(f"Error converting document to markdown: {e}")
-                return None
 
-        # Handle text-based files
-        elif file_type in [
-            "text/plain",
-            "application/json",
-            "text/markdown",
-        ] or file_type.startswith("text/"):
-            return response.text
-        else:
-            print(f"Unsupported file type: {file_type}")
-            return None
+def hash_file(path: str) -> str:
+    with open(path, "rb") as stored:
+        return hashlib.file_digest(stored, "sha256").hexdigest()
 
-    except requests.RequestException as e:
-        print(f"Error fetching file from URL: {e}")
-        return None
+
+async def open_local_file(file_path: str, bucket_name: str, content_hash: str = None):
+    """
+    Open a file of the filesystem backend in place of a download. It is read
+    where it is stored, like a blob cache hit, instead of being copied.
+    """
+    try:
+        path = localStorage.object_path(file_path, bucket_name)
+        size = os.path.getsize(path)
+        if size > STORAGE_MAX_DOWNLOAD_BYTES:
+            raise ValueError(
+                f"{file_path} is {size} bytes, the limit is {STORAGE_MAX_DOWNLOAD_BYTES}"
+            )
+        if content_hash is None:
+            content_hash = await asyncio.to_thread(hash_file, path)
+        return blobCache.CachedBlob(path, content_hash)
     except Exception as e:
         print(f"Exception occurred: {e}")
         return None
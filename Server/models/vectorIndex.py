@@ -0,0 +1,422 @@
+import asyncio
+import fcntl
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import threading
+import zlib
+from collections import Counter
+from contextlib import contextmanager
+
+import numpy as np
+from cachetools import LRUCache
+
+from models.chunking import tokenize
+
+# --- Vector Index Configuration ---
+# Local directory holding one memory-mapped index per notebook
+VECTOR_INDEX_DIR = os.getenv(
+    "VECTOR_INDEX_DIR", os.path.join(tempfile.gettempdir(), "codelm-vectors")
+)
+# Width of the hashed TF-IDF vectors
+VECTOR_DIMENSIONS = int(os.getenv("VECTOR_DIMENSIONS", "1024"))
+# Rows scored per matrix product, bounds the memory used by a search
+VECTOR_SEARCH_BLOCK_ROWS = int(os.getenv("VECTOR_SEARCH_BLOCK_ROWS", "65536"))
+# Share of deleted rows past which an index is rewritten without them
+VECTOR_COMPACT_RATIO = float(os.getenv("VECTOR_COMPACT_RATIO", "0.25"))
+# Parsed segments kept open, across notebooks
+VECTOR_SEGMENT_CACHE_SIZE = int(os.getenv("VECTOR_SEGMENT_CACHE_SIZE", "512"))
+
+# Each notebook directory holds immutable segments, each with its vectors and
+# the [file_name, chunk_index] of its rows, and a manifest listing the current
+# segments, their deleted rows and the document frequencies of the live rows.
+# segment path -> parsed segment, directory -> (manifest stat, manifest)
+segment_cache = LRUCache(maxsize=VECTOR_SEGMENT_CACHE_SIZE)
+manifest_cache = LRUCache(maxsize=VECTOR_SEGMENT_CACHE_SIZE)
+# Searches run in worker threads
+cache_lock = threading.Lock()
+
+
+def hash_terms(tokens: list) -> Counter:
+    """
+    Map terms to signed buckets of the hashed vector space.
+    The sign halves the bias of colliding terms.
+    """
+    buckets = Counter()
+    for term, frequency in Counter(tokens).items():
+        hashed = zlib.crc32(term.encode("utf-8"))
+        sign = 1.0 if (hashed >> 31) & 1 else -1.0
+        buckets[hashed % VECTOR_DIMENSIONS] += sign * (1.0 + np.log(frequency))
+    return buckets
+
+
+def embed(texts: list) -> np.ndarray:
+    """
+    Turn texts into L2-normalized hashed term-frequency vectors.
+    The IDF weighting is applied to the query at search time, so stored
+    vectors never change when other chunks are added or removed.
+    """
+    vectors = np.zeros((len(texts), VECTOR_DIMENSIONS), dtype=np.float32)
+    for row, text in enumerate(texts):
+        for bucket, weight in hash_terms(tokenize(text)).items():
+            vectors[row, bucket] = weight
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return vectors / norms
+
+
+def notebook_dir(notebook_id: str) -> str:
+    # Hashed so that a notebook ID can never escape the index directory
+    name = hashlib.sha256(notebook_id.encode("utf-8")).hexdigest()[:32]
+    return os.path.join(VECTOR_INDEX_DIR, name)
+
+
+@contextmanager
+def notebook_lock(notebook_id: str):
+    """
+    Serialize writers of a notebook's index across worker processes.
+    """
+    directory = notebook_dir(notebook_id)
+    os.makedirs(directory, exist_ok=True)
+    with open(os.path.join(directory, ".lock"), "w") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            yield directory
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+
+
+def load_segment(path: str) -> dict:
+    """
+    Open a segment of an index. Segments never change once written, so they
+    are parsed once and kept with their vectors memory-mapped.
+    Returns a dict with the "vectors", the [file_name, chunk_index] "ids" of
+    the rows and the "rows" of each file.
+    """
+    with cache_lock:
+        segment = segment_cache.get(path)
+    if segment is not None:
+        return segment
+    vectors = np.load(os.path.join(path, "vectors.npy"), mmap_mode="r")
+    with open(os.path.join(path, "ids.json")) as ids_file:
+        ids = json.load(ids_file)
+    rows = {}
+    for row, (file_name, _) in enumerate(ids):
+        rows.setdefault(file_name, []).append(row)
+    segment = {
+        "vectors": vectors,
+        "ids": ids,
+        "rows": {
+            file_name: np.array(file_rows, dtype=np.int64)
+            for file_name, file_rows in rows.items()
+        },
+    }
+    with cache_lock:
+        segment_cache[path] = segment
+    return segment
+
+
+def read_manifest(directory: str):
+    """
+    Read the manifest of an index, reusing the parsed one while the file is
+    unchanged. Writers replace the file, so a new inode means a new manifest.
+    """
+    path = os.path.join(directory, "manifest.json")
+    stat = os.stat(path)
+    key = (stat.st_ino, stat.st_mtime_ns)
+    with cache_lock:
+        cached = manifest_cache.get(directory)
+    if cached is not None and cached[0] == key:
+        return cached[1]
+    with open(path) as manifest_file:
+        manifest = json.load(manifest_file)
+    with cache_lock:
+        manifest_cache[directory] = (key, manifest)
+    return manifest
+
+
+def load_index(notebook_id: str):
+    """
+    Open the current segments of a notebook's index.
+    Returns a dict with the "segments" as (name, segment, deleted rows)
+    triples, the "frequencies" of the live rows and the number of live
+    "rows", or None if the notebook has no index yet.
+    """
+    directory = notebook_dir(notebook_id)
+    for _ in range(2):
+        try:
+            manifest = read_manifest(directory)
+            segments = [
+                (
+                    name,
+                    load_segment(os.path.join(directory, name)),
+                    np.array(manifest["deleted"].get(name, []), dtype=np.int64),
+                )
+                for name in manifest["segments"]
+            ]
+        except FileNotFoundError:
+            # A writer may have merged the segments in between, try once more
+            continue
+        return {
+            "segments": segments,
+            "frequencies": np.array(manifest["df"], dtype=np.int64),
+            "rows": sum(
+                len(segment["ids"]) - len(deleted) for _, segment, deleted in segments
+            ),
+        }
+    return None
+
+
+def live_mask(segment: dict, deleted) -> np.ndarray:
+    mask = np.ones(len(segment["ids"]), dtype=bool)
+    mask[deleted] = False
+    return mask
+
+
+def write_segment(directory: str, vectors, ids: list) -> str:
+    path = tempfile.mkdtemp(prefix="s", dir=directory)
+    np.save(os.path.join(path, "vectors.npy"), vectors)
+    with open(os.path.join(path, "ids.json"), "w") as ids_file:
+        json.dump(ids, ids_file)
+    return os.path.basename(path)
+
+
+def merge_segments(directory: str, segments: list) -> list:
+    """
+    Rewrite the live rows of (name, segment, deleted rows) triples as a
+    single segment. Returns the new triple in a list, empty when no row is left.
+    """
+    vectors = []
+    ids = []
+    for _, segment, deleted in segments:
+        mask = live_mask(segment, deleted)
+        vectors.append(np.asarray(segment["vectors"][mask]))
+        ids.extend(row_id for row_id, live in zip(segment["ids"], mask) if live)
+    if not ids:
+        return []
+    name = write_segment(directory, np.concatenate(vectors), ids)
+    segment = load_segment(os.path.join(directory, name))
+    return [(name, segment, np.zeros(0, dtype=np.int64))]
+
+
+def write_manifest(directory: str, segments: list, frequencies):
+    """
+    Point the index at its new segments atomically, then delete the segments
+    it no longer uses. Readers still mapping them keep their view until they
+    close it.
+    """
+    manifest = {
+        "segments": [name for name, _, _ in segments],
+        "deleted": {
+            name: deleted.tolist() for name, _, deleted in segments if len(deleted)
+        },
+        "df": frequencies.tolist(),
+    }
+    handle, pointer = tempfile.mkstemp(dir=directory, prefix=".tmp-")
+    with os.fdopen(handle, "w") as manifest_file:
+        json.dump(manifest, manifest_file)
+    os.replace(pointer, os.path.join(directory, "manifest.json"))
+    used = set(manifest["segments"]) | {".lock", "manifest.json"}
+    for name in os.listdir(directory):
+        if name in used:
+            continue
+        path = os.path.join(directory, name)
+        with cache_lock:
+            segment_cache.pop(path, None)
+        if os.path.isdir(path):
+            shutil.rmtree(path, ignore_errors=True)
+        else:
+            os.remove(path)
+
+
+def replace_rows(notebook_id: str, chunks_by_file: dict):
+    """
+    Drop the rows of the given files from a notebook's index and append their
+    new chunks. chunks_by_file maps file names to lists of dicts with
+    "chunk_index" and "text", an empty list only removes.
+    Old rows are only marked deleted and the new ones go to a new segment, so
+    an update costs the size of the files it touches. Small segments are
+    merged as they pile up, and the whole index is rewritten once
+    VECTOR_COMPACT_RATIO of its rows are deleted.
+    """
+    with notebook_lock(notebook_id) as directory:
+        current = load_index(notebook_id)
+        if current is None:
+            segments = []
+            frequencies = np.zeros(VECTOR_DIMENSIONS, dtype=np.int64)
+        else:
+            segments = current["segments"]
+            frequencies = current["frequencies"].copy()
+
+        removed = 0
+        for position, (name, segment, deleted) in enumerate(segments):
+            rows = [
+                segment["rows"][file_name]
+                for file_name in chunks_by_file
+                if file_name in segment["rows"]
+            ]
+            if not rows:
+                continue
+            rows = np.setdiff1d(np.concatenate(rows), deleted)
+            if not len(rows):
+                continue
+            frequencies -= (np.asarray(segment["vectors"][rows]) != 0).sum(axis=0)
+            segments[position] = (name, segment, np.union1d(deleted, rows))
+            removed += len(rows)
+
+        new_ids = [
+            [file_name, chunk["chunk_index"]]
+            for file_name, chunks in chunks_by_file.items()
+            for chunk in chunks
+        ]
+        if not removed and not new_ids:
+            return 0
+        if new_ids:
+            new_vectors = embed(
+                [
+                    chunk["text"]
+                    for chunks in chunks_by_file.values()
+                    for chunk in chunks
+                ]
+            )
+            frequencies += (new_vectors != 0).sum(axis=0)
+            name = write_segment(directory, new_vectors, new_ids)
+            segments.append(
+                (
+                    name,
+                    load_segment(os.path.join(directory, name)),
+                    np.zeros(0, dtype=np.int64),
+                )
+            )
+
+        def live_rows(entry):
+            return len(entry[1]["ids"]) - len(entry[2])
+
+        total_rows = sum(len(segment["ids"]) for _, segment, _ in segments)
+        deleted_rows = sum(len(deleted) for _, _, deleted in segments)
+        if deleted_rows > VECTOR_COMPACT_RATIO * total_rows:
+            segments = merge_segments(directory, segments)
+        else:
+            # Each segment is kept at least twice the size of the newer ones,
+            # so a row is rewritten a logarithmic number of times
+            while len(segments) > 1 and live_rows(segments[-2]) < 2 * live_rows(
+                segments[-1]
+            ):
+                segments[-2:] = merge_segments(directory, segments[-2:])
+        write_manifest(directory, segments, frequencies)
+        return len(new_ids)
+
+
+def top_k_cosine(vectors, queries: np.ndarray, k: int, mask=None):
+    """
+    Batched cosine top-k of normalized query rows against normalized vectors.
+    The vectors are scored block by block so a memory-mapped index is never
+    loaded whole. Returns, per query, a list of (row, score) best first.
+    """
+    results = [[] for _ in range(len(queries))]
+    for start in range(0, len(vectors), VECTOR_SEARCH_BLOCK_ROWS):
+        block = np.asarray(vectors[start : start + VECTOR_SEARCH_BLOCK_ROWS])
+        scores = queries @ block.T
+        if mask is not None:
+            scores[:, ~mask[start : start + len(block)]] = -np.inf
+        count = min(k, scores.shape[1])
+        best = np.argpartition(-scores, count - 1, axis=1)[:, :count]
+        for query_row, rows in enumerate(best):
+            results[query_row].extend(
+                (start + int(row), float(scores[query_row, row]))
+                for row in rows
+                if np.isfinite(scores[query_row, row])
+            )
+    return [
+        sorted(found, key=lambda item: item[1], reverse=True)[:k] for found in results
+    ]
+
+
+def search_rows(notebook_id: str, query: str, file_names: list, top_k: int):
+    current = load_index(notebook_id)
+    if current is None or not current["rows"]:
+        return []
+    idf = np.log((1.0 + current["rows"]) / (1.0 + current["frequencies"])) + 1.0
+    query_vector = embed([query])[0] * idf
+    norm = np.linalg.norm(query_vector)
+    if norm == 0:
+        return []
+    query_vectors = (query_vector / norm)[None, :]
+    found = []
+    for _, segment, deleted in current["segments"]:
+        mask = np.zeros(len(segment["ids"]), dtype=bool)
+        for file_name in file_names:
+            rows = segment["rows"].get(file_name)
+            if rows is not None:
+                mask[rows] = True
+        mask[deleted] = False
+        if not mask.any():
+            continue
+        found.extend(
+            (segment["ids"][row], score)
+            for row, score in top_k_cosine(
+                segment["vectors"], query_vectors, top_k, mask
+            )[0]
+        )
+    found.sort(key=lambda item: item[1], reverse=True)
+    return [
+        {"file_name": row_id[0], "chunk_index": row_id[1], "score": score}
+        for row_id, score in found[:top_k]
+        if score > 0
+    ]
+
+
+def indexed_rows_files(notebook_id: str) -> set:
+    current = load_index(notebook_id)
+    if current is None:
+        return set()
+    return {
+        file_name
+        for _, segment, deleted in current["segments"]
+        for file_name, rows in segment["rows"].items()
+        if not np.isin(rows, deleted).all()
+    }
+
+
+async def add_chunks(notebook_id: str, chunks_by_file: dict):
+    """
+    Add the chunks of one or more sources to the notebook's vector index,
+    replacing their old rows. chunks_by_file is as in replace_rows.
+    """
+    return await asyncio.to_thread(replace_rows, notebook_id, chunks_by_file)
+
+
+async def remove_file(notebook_id: str, file_name: str):
+    """
+    Remove the rows of a source from the notebook's vector index.
+    """
+    return await asyncio.to_thread(replace_rows, notebook_id, {file_name: []})
+
+
+async def get_vector_files(notebook_id: str) -> set:
+    """
+    Get the names of the files that have rows in the notebook's vector index.
+    """
+    return await asyncio.to_thread(indexed_rows_files, notebook_id)
+
+
+async def delete_notebook_vectors(notebook_id: str):
+    """
+    Remove the whole vector index of a notebook.
+    """
+    directory = notebook_dir(notebook_id)
+    await asyncio.to_thread(shutil.rmtree, directory, True)
+    with cache_lock:
+        manifest_cache.pop(directory, None)
+        for path in [path for path in segment_cache if path.startswith(directory)]:
+            segment_cache.pop(path, None)
+
+
+async def search_vectors(notebook_id: str, query: str, file_names: list, top_k: int):
+    """
+    Find the chunks of the given files most similar to a query.
+    Returns dicts with "file_name", "chunk_index" and "score", best first.
+    """
+    return await asyncio.to_thread(search_rows, notebook_id, query, file_names, top_k)
@@ -1,22 +1,29 @@
+import asyncio
+import json
 import os
+import posixpath
 import uuid
+from contextlib import aclosing
 from typing import List, Optional
-import google.genai as genai
 from dotenv import load_dotenv
 from fastapi import (
     APIRouter,
+    BackgroundTasks,
     Cookie,
     File,
     Form,
     HTTPException,
+    Request,
     Response,
     UploadFile,
     status,
 )
+from fastapi.responses import StreamingResponse
 from google.genai.types import GenerateContentConfig, ModelContent, Part, UserContent
 from pydantic import BaseModel, Field  # For request/response validation
 
 from models.notebookModel import (
+    build_file_metadata,
     create_notebook,
     delete_all_file_metadata,
     delete_file_metadata,
@@ -26,11 +33,86 @@ from models.notebookModel import (
     get_notebook_messages,
     get_notebook_metadata,
     get_notebooks,
+    get_registered_file_names,
     insert_file_metadata,
+    insert_many_file_metadata,
     insert_message,
     update_notebook_metadata,
 )
-from models.storage import delete_file, read_file, upload
+from models.archive import ARCHIVE_BATCH_SIZE, ARCHIVE_MAX_BYTES, process_archive
+from models.blobCache import get_blob_cache_stats
+from models.briefing import (
+    BRIEFING_UPDATE_PROMPT,
+    delete_briefing,
+    get_briefing,
+    is_fresh,
+    refresh_briefing,
+    save_briefing,
+)
+from models.contextCache import (
+    PROVIDER_CACHE_MODEL,
+    fingerprint_files,
+    format_sources,
+    get_context_cache_stats,
+    get_provider_cache,
+    get_source_context,
+    invalidate_source_context,
+    is_provider_cacheable,
+)
+from models.contextPacker import CONTEXT_MAX_TOKENS, estimate_tokens, pack_context
+from models.mapReduce import (
+    MAP_REDUCE_MIN_TOKENS,
+    condense_sources,
+    get_map_reduce_stats,
+)
+from models.llmGateway import (
+    generate_content,
+    get_llm_stats,
+    send_chat_message,
+    stream_chat_message,
+)
+from models.conversation import delete_summary, load_history, refresh_summary
+from models.extraction import get_extraction_stats
+from models.generationCache import (
+    delete_generations,
+    get_generation,
+    get_generation_cache_stats,
+    store_generation,
+    template_version,
+)
+from models.ingestion import (
+    ingest_source,
+    ingest_stored_sources,
+    release_content,
+    release_source,
+    release_unregistered,
+    store_blob,
+)
+from models.jobs import (
+    delete_notebook_jobs,
+    get_job,
+    get_job_stats,
+    public_job,
+    submit_job,
+    watch_job,
+)
+from models.scheduler import ANONYMOUS_USER, admit, current_user, get_scheduler_stats
+from models.singleflight import coalesce, get_singleflight_stats, normalize_input
+from models.retrieval import (
+    delete_notebook_index,
+    index_source,
+    index_sources,
+    search_symbols,
+    select_relevant_sources,
+    unindex_source,
+)
+from models.storage import (
+    SpooledBuffer,
+    create_signed_upload_url,
+    delete_file,
+    get_file_size,
+    get_public_url,
+)
 import datetime
 
 load_dotenv()
@@ -38,6 +120,45 @@ load_dotenv()
 GEMINI_API_KEY = os.getenv("GEMINI_API_KEY")
 MODEL_NAME = "gemini-2.0-flash"
 SYSTEM_INSTRUCTION = os.getenv("SYSTEM_INSTRUCTION")
+# Uploads are streamed to storage in chunks and refused past this size
+UPLOAD_MAX_BYTES = int(os.getenv("UPLOAD_MAX_BYTES", str(100 * 1024 * 1024)))
+UPLOAD_CHUNK_SIZE = int(os.getenv("UPLOAD_CHUNK_SIZE", str(1024 * 1024)))
+# Chat sends whole sources up to this size, and only the relevant chunks beyond it
+CHAT_SOURCE_BUDGET_CHARS = int(os.getenv("CHAT_SOURCE_BUDGET_CHARS", "60000"))
+CHAT_MAX_OUTPUT_TOKENS = 1000
+GENERATION_MAX_OUTPUT_TOKENS = 2048
+
+FAQ_PROMPT = """Based *only* on the following document content, generate a list of 3-5 frequently asked questions (FAQs) and their answers. Format each as a question followed by its answer. Document Content:
+{source_content}
+
+FAQs:
+"""
+
+STUDY_GUIDE_PROMPT = """Analyze the following document content and generate a concise study guide. Include:
+    1.  A list of the main key topics covered.
+    2.  3-4 potential short-answer or definition questions based *only* on the provided text.
+
+    Document Content:
+    {source_content}
+
+    Study Guide:
+    """
+
+BRIEFING_PROMPT = """Based *only* on the following document content, generate a concise briefing. 
+    The briefing should summarize the key points and findings from the documents.
+
+    Document Content:
+    {source_content}
+
+    Briefing:
+    """
+
+# URL name -> (label, prompt template) of each generator
+GENERATORS = {
+    "faq": ("FAQ", FAQ_PROMPT),
+    "study-guide": ("study guide", STUDY_GUIDE_PROMPT),
+    "briefing": ("briefing", BRIEFING_PROMPT),
+}
 
 # ----------- SETTING UP THE API CALLS -----------------
 # --- Configure Logging ---
@@ -55,7 +176,8 @@ class Message(BaseModel):
 
 class ChatRequest(BaseModel):
     user_text: str = Field(..., min_length=1)  # Ensure user_text is not empty
-    history: List[Message]  # Expects a list of Message objects
+    # Ignored, the history is rebuilt from the notebook's stored messages
+    history: Optional[List[Message]] = None
     notebookID: str = Field(..., min_length=1)  # Ensure notebookID is not empty
     excluded_files: Optional[List[str]] = Field(
         default=[]
@@ -64,44 +186,106 @@ class ChatRequest(BaseModel):
 
 class ChatResponse(BaseModel):
     reply: str
+    context: Optional[dict] = None  # What the context packer kept and dropped
 
 
 class GenerationResponse(BaseModel):
     content: str
+    context: Optional[dict] = None
+    cached: bool = False  # Served from the generation cache
+    updated_at: Optional[datetime.datetime] = None  # When a briefing was last updated
+    fresh: Optional[bool] = None  # Whether a briefing covers the current sources
+
+
+class UploadUrlFile(BaseModel):
+    file_name: str = Field(..., min_length=1)  # Original name of the file
+    content_type: Optional[str] = None
+    file_size: Optional[int] = None
+
+
+class UploadUrlRequest(BaseModel):
+    notebookID: str = Field(..., min_length=1)
+    files: List[UploadUrlFile] = Field(..., min_length=1)
+
+
+class FinalizeUploadFile(BaseModel):
+    file_name: str = Field(..., min_length=1)  # Name returned by /upload-urls
+    file_original_name: str = Field(..., min_length=1)
+    content_type: Optional[str] = None
 
 
-async def get_combined_source_content(notebook_id: str) -> str:
+class FinalizeUploadRequest(BaseModel):
+    notebookID: str = Field(..., min_length=1)
+    files: List[FinalizeUploadFile] = Field(..., min_length=1)
+
+
+async def get_combined_source_content(
+    notebook_id: str, prompt_template: str = "", files: list = None
+):
     """
-    Retrieves all files for a notebook, reads their content,
-    and combines them into a single string.
+    Retrieves all files for a notebook, unless already given, reads their
+    content, fits it in the context budget left by the prompt and combines
+    it into a single string.
+    Returns the combined content and the context packer's report.
     """
     try:
-        files = await get_files(notebook_id)
+        if files is None:
+            files = await get_files(notebook_id)
         combined_content = ""
         if not files:
-            return combined_content
-
-        for file_meta in files:
-            file_path = f"{notebook_id}/{file_meta.get('file_name')}"
-            bucket_name = "files"
-            file_type = file_meta.get("file_type")
+            return combined_content, None
+
+        sources = (await get_source_context(notebook_id, files))["sources"]
+        packed = pack_context(
+            "",
+            [
+                {"file_name": file_meta.get("file_original_name"), "content": text}
+                for file_meta, text in sources
+                if text
+            ],
+            system=prompt_template,
+            max_output_tokens=GENERATION_MAX_OUTPUT_TOKENS,
+        )
+        packed_sources = iter(packed["sources"])
+        for file_meta, file_content in sources:
             original_name = file_meta.get("file_original_name", "Unknown File")
-            print(f"Reading source file: {original_name} ({file_path})")
-            file_content = await read_file(file_path, bucket_name, file_type)
-
             if file_content:
+                source = next(packed_sources, None)
+                if source is None or source["file_name"] != original_name:
+                    # Dropped to fit the context budget
+                    break
                 combined_content += f"--- Source: {original_name} ---\n"
-                combined_content += file_content
+                combined_content += source["content"]
                 combined_content += "\n\n"  # Add separation between files
             else:
                 print(f"Warning: Could not read content for file {original_name}")
                 combined_content += (
                     f"--- Source: {original_name} (Could not read content) ---\n\n"
                 )
-        return combined_content.strip()
+        return combined_content.strip(), packed["report"]
     except Exception as e:
         print(f"Error getting combined source content for notebook {notebook_id}: {e}")
-        return ""
+        return "", None
+
+
+async def get_generation_content(notebook_id: str, prompt_template: str, files: list):
+    """
+    Get the content a generation prompt is run over: the combined sources,
+    or notes condensed from them by map-reduce when they are too large for a
+    single prompt. Returns the content and a report of how it was built.
+    """
+    sources = (await get_source_context(notebook_id, files))["sources"]
+    readable = [
+        {"file_name": file_meta.get("file_original_name"), "content": text}
+        for file_meta, text in sources
+        if text
+    ]
+    source_tokens = sum(estimate_tokens(source["content"]) for source in readable)
+    if source_tokens <= MAP_REDUCE_MIN_TOKENS:
+        return await get_combined_source_content(notebook_id, prompt_template, files)
+    print(f"Sources are {source_tokens} tokens, condensing them with map-reduce")
+    notes, report = await condense_sources(readable, generate_single_turn)
+    return notes, {"source_tokens": source_tokens, "map_reduce": report}
 
 
 async def generate_single_turn(prompt: str) -> str:
@@ -117,21 +301,15 @@ async def generate_single_turn(prompt: str) -> str:
     try:
         generation_config = GenerateContentConfig(
             temperature=0.7,
-            max_output_tokens=2048,
+            max_output_tokens=GENERATION_MAX_OUTPUT_TOKENS,
             top_p=0.9,
             top_k=40,
         )
 
-        gemini_client = genai.Client(
-            api_key=GEMINI_API_KEY,
-        )
-
         print(
             f"Sending generation prompt (length: {len(prompt)} chars) to model: {MODEL_NAME}"
         )
-        response = gemini_client.models.generate_content(
-            model=MODEL_NAME, contents=prompt, config=generation_config
-        )
+        response = await generate_content(MODEL_NAME, prompt, generation_config)
 
         if (
             response.candidates
@@ -156,6 +334,8 @@ async def generate_single_turn(prompt: str) -> str:
                 detail="AI model returned an empty response.",
             )
 
+    except HTTPException:
+        raise
     except Exception as e:
         print(f"Error during Gemini API call: {e}")
         # Catch other potential errors during API call setup or sending
@@ -179,163 +359,583 @@ async def create_notebook_route(res: Response, user_id: str = Cookie(None)):
     return {"notebook_id": notebook_id}  # this is the response body
 
 
+async def stream_upload_file(notebook_id: str, file: UploadFile):
+    """
+    Read one uploaded file in chunks while enforcing UPLOAD_MAX_BYTES, store it
+    as a content-addressed blob and extract its text. Identical content that is
+    already stored is neither uploaded nor extracted again.
+    Returns the notebook_files record to insert.
+    """
+    if file.size is not None and file.size > UPLOAD_MAX_BYTES:
+        raise HTTPException(
+            status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE,
+            detail=f"{file.filename} is larger than {UPLOAD_MAX_BYTES} bytes",
+        )
+    file_extension = file.filename.split(".")[-1]
+    unique_filename = str(uuid.uuid4()) + "." + file_extension
+    # The chunks are spooled locally and hashed before anything is uploaded
+    spool = SpooledBuffer()
+    try:
+        while True:
+            chunk = await file.read(UPLOAD_CHUNK_SIZE)
+            if not chunk:
+                break
+            spool.write(chunk)
+            if spool.size > UPLOAD_MAX_BYTES:
+                raise HTTPException(
+                    status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE,
+                    detail=f"{file.filename} is larger than {UPLOAD_MAX_BYTES} bytes",
+                )
+        spool.finish()
+        return await store_spooled_source(
+            notebook_id,
+            spool,
+            unique_filename,
+            file.content_type,
+            file.filename,
+        )
+    finally:
+        spool.close()
+
+
+async def store_spooled_source(
+    notebook_id: str,
+    spool: SpooledBuffer,
+    file_name: str,
+    file_type: str,
+    file_original_name: str,
+):
+    """
+    Store spooled bytes as a content-addressed blob, extract their text and
+    index it. Returns the notebook_files record to insert.
+    """
+    record, text = await ingest_spooled_source(
+        notebook_id, spool, file_name, file_type, file_original_name
+    )
+    if text is not None:
+        try:
+            await index_source(notebook_id, file_name, text)
+        except BaseException:
+            await release_unregistered(notebook_id, [record])
+            raise
+    return record
+
+
+async def ingest_spooled_source(
+    notebook_id: str,
+    spool: SpooledBuffer,
+    file_name: str,
+    file_type: str,
+    file_original_name: str,
+):
+    """
+    Store spooled bytes as a content-addressed blob and extract their text.
+    Returns the notebook_files record to insert and the text, or None.
+    """
+    blob_path = await store_blob(spool, file_type)
+    if blob_path is None:
+        raise HTTPException(status_code=500, detail="Error uploading file")
+    try:
+        extracted = await ingest_source(spool.source, file_type, spool.content_hash)
+    except BaseException:
+        # The record holding the blob's reference won't be inserted
+        await release_content(spool.content_hash, blob_path)
+        raise
+    record = build_file_metadata(
+        notebook_id,
+        file_name,
+        file_type,
+        spool.size,
+        file_original_name,
+        get_public_url(blob_path, "files"),
+        spool.content_hash,
+        blob_path,
+    )
+    return record, extracted["text"] if extracted is not None else None
+
+
 @router.post("/upload")
 async def upload_file_route(
-    res: Response, notebookID: str = Form(...), files: List[UploadFile] = File(...)
+    res: Response,
+    background_tasks: BackgroundTasks,
+    notebookID: str = Form(...),
+    files: List[UploadFile] = File(...),
 ):
     """
-    Upload a file to the notebook.
+    Upload files to the notebook. The files that were stored are kept when
+    others fail: the response is then a 207 listing the result of each file.
     """
     print("Uploading files to the notebook")
-    for file in files:
-        file_content = await file.read()
-        file_extension = file.filename.split(".")[-1]
-        unique_filename = str(uuid.uuid4()) + "." + file_extension
-        # Call the upload function from storage.py
-        response = await upload(file_content, unique_filename, "files", notebookID)
-        if response is None:
-            raise HTTPException(status_code=500, detail="Error uploading file")
-        else:
-            insert = await insert_file_metadata(
-                notebookID,
-                unique_filename,
-                file.content_type,
-                file.size,
-                file.filename,
-                response,
-            )
-            if insert is None:
-                raise HTTPException(
-                    status_code=500, detail="Error inserting file metadata"
+    # Files are streamed concurrently, their metadata is written in one bulk insert
+    results = await asyncio.gather(
+        *(stream_upload_file(notebookID, file) for file in files),
+        return_exceptions=True,
+    )
+    records = [result for result in results if isinstance(result, dict)]
+    try:
+        await insert_many_file_metadata(records)
+    except BaseException:
+        await release_unregistered(notebookID, records)
+        raise
+    await invalidate_source_context(notebookID)
+    if records:
+        schedule_briefing_update(background_tasks, notebookID)
+    errors = []
+    for result in results:
+        if isinstance(result, HTTPException):
+            errors.append(result)
+        elif isinstance(result, BaseException):
+            errors.append(
+                HTTPException(
+                    status_code=500, detail=f"Error uploading file: {str(result)}"
                 )
+            )
+        else:
+            errors.append(None)
+    if not records:
+        raise errors[0]
+    file_results = [
+        {"file_name": file.filename, "status_code": 200, "detail": "Uploaded"}
+        if error is None
+        else {
+            "file_name": file.filename,
+            "status_code": error.status_code,
+            "detail": error.detail,
+        }
+        for file, error in zip(files, errors)
+    ]
+    if any(error is not None for error in errors):
+        res.status_code = status.HTTP_207_MULTI_STATUS
+        return {"detail": "Some files could not be uploaded", "files": file_results}
     # If all files are uploaded successfully, return a success message
     res.status_code = status.HTTP_200_OK
-    return {"detail": "Files uploaded successfully"}
+    return {"detail": "Files uploaded successfully", "files": file_results}
 
 
-# --- API Endpoint ---
-@router.post("/chat", response_model=ChatResponse)
-async def handle_chat(request: ChatRequest, user_id: str = Cookie(None)):
+async def ingest_archive(notebook_id: str, spool: SpooledBuffer, archive_name: str):
     """
-    Receives user text and chat history, calls the Gemini API,
-    and returns the model's reply.
+    Store, extract and index every member of an uploaded archive. Members are
+    registered in notebook_files and indexed in batches of ARCHIVE_BATCH_SIZE.
+    Returns the stats of process_archive, with the number of members
+    "inserted" and of members that were ingested but not registered, as
+    "unregistered", because their batch failed.
     """
-    if not GEMINI_API_KEY:
-        raise HTTPException(
-            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
-            detail="API Key not configured on server.",
-        )
+    batch = []
+    counts = {"inserted": 0, "unregistered": 0, "failed_batches": 0}
+
+    async def flush():
+        # Swapped before awaiting, so that each member is written exactly once
+        records = [record for record, _ in batch]
+        texts = [(record["file_name"], text) for record, text in batch if text]
+        batch.clear()
+        if not records:
+            return
+        try:
+            await index_sources(notebook_id, texts)
+            await insert_many_file_metadata(records)
+        except Exception as e:
+            # The other batches are still registered
+            print(f"Error registering {len(records)} members of {archive_name}: {e}")
+            unregistered = await release_unregistered(notebook_id, records)
+            counts["failed_batches"] += 1
+            counts["unregistered"] += unregistered
+            counts["inserted"] += len(records) - unregistered
+            if unregistered < len(records):
+                await invalidate_source_context(notebook_id)
+            return
+        except BaseException:
+            await release_unregistered(notebook_id, records)
+            raise
+        counts["inserted"] += len(records)
+        await invalidate_source_context(notebook_id)
+
+    async def handle_member(path: str, data: bytes, content_type: str):
+        member_spool = SpooledBuffer()
+        try:
+            member_spool.write(data)
+            member_spool.finish()
+            # Dots in the directories of a member are not its extension
+            file_extension = os.path.splitext(posixpath.basename(path))[1][1:] or "txt"
+            batch.append(
+                await ingest_spooled_source(
+                    notebook_id,
+                    member_spool,
+                    str(uuid.uuid4()) + "." + file_extension,
+                    content_type,
+                    path,
+                )
+            )
+        finally:
+            member_spool.close()
+        if len(batch) >= ARCHIVE_BATCH_SIZE:
+            await flush()
 
+    stats = {}
     try:
-        client = genai.Client(
-            api_key=GEMINI_API_KEY,
-            # Optional: Set the region if needed
-            # region="us-central1",
+        stats.update(await process_archive(spool.source, archive_name, handle_member))
+        await flush()
+    except Exception as e:
+        print(f"Error ingesting archive {archive_name}: {e}")
+        stats["error"] = str(e)
+        # Members ingested since the last flush are never registered
+        counts["unregistered"] += await release_unregistered(
+            notebook_id, [record for record, _ in batch]
         )
+    finally:
+        spool.close()
+    stats.update(counts)
+    print(f"Ingested archive {archive_name} into {notebook_id}: {stats}")
+    if counts["inserted"]:
+        try:
+            await update_notebook_metadata(
+                notebook_id=notebook_id, source=counts["inserted"]
+            )
+            await refresh_briefing(notebook_id, build_briefing, extend_briefing)
+        except Exception as e:
+            print(f"Error updating notebook {notebook_id} after the archive: {e}")
+    return stats
 
-        files = await get_files(request.notebookID)
-        files_content = []
-        print(request.excluded_files)
-        for file in files:
-            if file["file_name"] in request.excluded_files:
-                continue
 
-            print(f"Reading file: {file['file_name']}")
-            file_content = await read_file(
-                f"{request.notebookID}/{file['file_name']}", "files", file["file_type"]
-            )
-            if file_content is not None:
-                files_content.append(
-                    {"file_name": file["file_original_name"], "content": file_content}
+@router.post("/upload-archive")
+async def upload_archive_route(
+    res: Response,
+    background_tasks: BackgroundTasks,
+    notebookID: str = Form(...),
+    file: UploadFile = File(...),
+):
+    """
+    Upload a zip or tar archive of a repository. Its members are filtered,
+    stored, extracted and indexed in the background, poll /fetch-files to
+    follow the progress.
+    """
+    print(f"Uploading archive {file.filename} to {notebookID}")
+    spool = SpooledBuffer()
+    try:
+        while True:
+            chunk = await file.read(UPLOAD_CHUNK_SIZE)
+            if not chunk:
+                break
+            spool.write(chunk)
+            if spool.size > ARCHIVE_MAX_BYTES:
+                raise HTTPException(
+                    status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE,
+                    detail=f"{file.filename} is larger than {ARCHIVE_MAX_BYTES} bytes",
                 )
-        # --- Prepare History for Gemini SDK ---
-        # The Python SDK expects history like: [{'role': 'user'/'model', 'parts': [{'text': '...'}]}]
-        history_objs = []
-        for msg in request.history:
-            # Basic validation for role
-            if msg.role == "user":
-                history_objs.append(UserContent(parts=[Part(text=msg.text)]))
-            elif msg.role == "model":
-                history_objs.append(ModelContent(parts=[Part(text=msg.text)]))
-
-        # --- Configuration ---
-        # Keeping it wholesome and Christian
-        safety_settings = [
-            {
-                "category": "HARM_CATEGORY_HARASSMENT",
-                "threshold": "BLOCK_MEDIUM_AND_ABOVE",
-            },
-            {
-                "category": "HARM_CATEGORY_HATE_SPEECH",
-                "threshold": "BLOCK_MEDIUM_AND_ABOVE",
-            },
-            {
-                "category": "HARM_CATEGORY_SEXUALLY_EXPLICIT",
-                "threshold": "BLOCK_MEDIUM_AND_ABOVE",
-            },
+        spool.finish()
+    except BaseException:
+        spool.close()
+        raise
+    # The spool is closed by the background task once every member is ingested
+    background_tasks.add_task(ingest_archive, notebookID, spool, file.filename)
+    res.status_code = status.HTTP_202_ACCEPTED
+    return {"detail": "Archive uploaded, its files are being processed"}
+
+
+@router.post("/upload-urls")
+async def create_upload_urls_route(res: Response, request: UploadUrlRequest):
+    """
+    First phase of a direct upload: issue signed URLs the client uploads to
+    without the bytes passing through the API. Call /finalize-upload afterwards.
+    """
+    print(f"Creating {len(request.files)} signed upload URLs for {request.notebookID}")
+    for file in request.files:
+        if file.file_size is not None and file.file_size > UPLOAD_MAX_BYTES:
+            raise HTTPException(
+                status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE,
+                detail=f"{file.file_name} is larger than {UPLOAD_MAX_BYTES} bytes",
+            )
+    unique_filenames = [
+        str(uuid.uuid4()) + "." + file.file_name.split(".")[-1]
+        for file in request.files
+    ]
+    signed_urls = await asyncio.gather(
+        *(
+            create_signed_upload_url(f"{request.notebookID}/{unique_filename}", "files")
+            for unique_filename in unique_filenames
+        )
+    )
+    if any(signed_url is None for signed_url in signed_urls):
+        raise HTTPException(status_code=500, detail="Error creating upload URLs")
+    res.status_code = status.HTTP_200_OK
+    return {
+        "uploads": [
             {
-                "category": "HARM_CATEGORY_DANGEROUS_CONTENT",
-                "threshold": "BLOCK_MEDIUM_AND_ABOVE",
-            },
+                "file_name": unique_filename,
+                "file_original_name": file.file_name,
+                "content_type": file.content_type,
+                "signed_url": signed_url["signed_url"],
+                "token": signed_url["token"],
+            }
+            for file, unique_filename, signed_url in zip(
+                request.files, unique_filenames, signed_urls
+            )
         ]
-        # Basic model config
-        generation_config = GenerateContentConfig(
-            temperature=0.9,  # 90% randomness, keeping it fresh.
-            max_output_tokens=1000,  # 1000 tokens = 750 words (I think)
-            top_p=0.9,  # consider the top 90% of the probability distribution when generating text.
-            top_k=40,  # consider the top 40 tokens with the highest probabilities when generating text.
-            safety_settings=safety_settings,
-            # system_instruction=SYSTEM_INSTRUCTION,
+    }
+
+
+@router.post("/finalize-upload")
+async def finalize_upload_route(
+    res: Response, request: FinalizeUploadRequest, background_tasks: BackgroundTasks
+):
+    """
+    Second phase of a direct upload: check the uploaded objects, record their
+    metadata and extract their text in the background. Files a previous
+    attempt already registered are skipped, so that it can be retried.
+    """
+    print(f"Finalizing {len(request.files)} uploads for {request.notebookID}")
+    for file in request.files:
+        if "/" in file.file_name or ".." in file.file_name:
+            raise HTTPException(status_code=400, detail="Invalid file name")
+    registered = await get_registered_file_names(
+        request.notebookID, [file.file_name for file in request.files]
+    )
+    files = {
+        file.file_name: file
+        for file in request.files
+        if file.file_name not in registered
+    }.values()
+    sizes = await asyncio.gather(
+        *(
+            get_file_size(f"{request.notebookID}/{file.file_name}", "files")
+            for file in files
         )
-        try:
-            prompt = ""
-            for file in files_content:
-                prompt += f"File Name: {file['file_name']}\n"
-                prompt += f"Content: {file['content']}\n\n"
-            # Add the system instruction to the prompt
-            prompt += request.user_text
-            # --- Start Chat Session ---
-            chat_session = client.chats.create(
-                model=MODEL_NAME,
-                history=history_objs,
-                config=generation_config,
-            )
-            # --- Send Message to Gemini ---
-            response = chat_session.send_message(prompt)
-            # --- Process Response ---
-            reply_text = response.text
-            await insert_message(
-                notebook_id=request.notebookID,
-                responder="user",
-                message=request.user_text,
-                user_id=user_id,
-            )
-            await insert_message(
-                notebook_id=request.notebookID,
-                responder=MODEL_NAME,
-                message=reply_text,
-            )
-            return ChatResponse(reply=reply_text)
-
-        except ValueError:
-            # This usually indicates the response was blocked by safety settings
-            # Optionally inspect response.prompt_feedback here
-            feedback = response.prompt_feedback
-            block_reason = "Content may be blocked by safety settings."
-            if feedback.block_reason:
-                block_reason += (
-                    f" Reason: {feedback.block_reason.name}"  # Use .name for enum
-                )
+    )
+    records = []
+    for file, size in zip(files, sizes):
+        if size is None:
             raise HTTPException(
-                status_code=status.HTTP_400_BAD_REQUEST, detail=block_reason
+                status_code=404, detail=f"{file.file_original_name} was not uploaded"
             )
-        except Exception as e:
-            # Catch other potential errors during response processing
+        if size > UPLOAD_MAX_BYTES:
+            await delete_file(f"{request.notebookID}/{file.file_name}", "files")
             raise HTTPException(
-                status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
-                detail=f"Error processing the bot's response.{str(e)}",
+                status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE,
+                detail=f"{file.file_original_name} is larger than {UPLOAD_MAX_BYTES} bytes",
+            )
+        records.append(
+            build_file_metadata(
+                request.notebookID,
+                file.file_name,
+                file.content_type,
+                size,
+                file.file_original_name,
+                get_public_url(f"{request.notebookID}/{file.file_name}", "files"),
+            )
+        )
+    await insert_many_file_metadata(records)
+    await invalidate_source_context(request.notebookID)
+    # Sources that are not extracted yet are extracted on first read as well
+    background_tasks.add_task(ingest_stored_sources, request.notebookID, records)
+    schedule_briefing_update(background_tasks, request.notebookID)
+    res.status_code = status.HTTP_200_OK
+    return {"detail": "Files uploaded successfully"}
+
+
+async def prepare_chat(request: ChatRequest, files: list = None):
+    """
+    Assemble a chat turn: the notebook's sources, or the chunks relevant to
+    the question, the rebuilt history and the model configuration, all fitted
+    in the context budget. files are the notebook's files, unless given they
+    are fetched.
+    Returns a dict with the "model", "history_objs", "prompt", "config",
+    the packer's "packed" result and the loaded "history".
+    """
+    if files is None:
+        files = await get_files(request.notebookID)
+    files = [file for file in files if file["file_name"] not in request.excluded_files]
+    # Assembled once per file set, later turns reuse it
+    context = await get_source_context(
+        request.notebookID, files, request.excluded_files
+    )
+    sources = context["sources"]
+    files_content = context["files_content"]
+    source_chars = context["chars"]
+    cached_content = None
+    if is_provider_cacheable(context):
+        # Unchanged sources stay whole on the provider between turns
+        cached_content = await get_provider_cache(context)
+    if cached_content is None and source_chars > CHAT_SOURCE_BUDGET_CHARS:
+        print(f"Sources are {source_chars} chars, retrieving relevant chunks")
+        files_content = await select_relevant_sources(
+            request.notebookID,
+            sources,
+            request.user_text,
+            CHAT_SOURCE_BUDGET_CHARS,
+        )
+    # Recent turns as they are, older ones through their summary
+    history = await load_history(request.notebookID)
+    summary_text = ""
+    if history["summary"]:
+        summary_text = f"Summary of the earlier conversation:\n{history['summary']}\n\n"
+    # Fit history and sources in the model's context budget, cached sources
+    # are part of the request without being in the prompt
+    packed = pack_context(
+        request.user_text,
+        [] if cached_content else files_content,
+        history["messages"],
+        system=summary_text,
+        max_output_tokens=CHAT_MAX_OUTPUT_TOKENS,
+        max_tokens=CONTEXT_MAX_TOKENS
+        - (estimate_tokens(context["preamble"]) if cached_content else 0),
+    )
+    files_content = packed["sources"]
+    # --- Prepare History for Gemini SDK ---
+    # The Python SDK expects history like: [{'role': 'user'/'model', 'parts': [{'text': '...'}]}]
+    history_objs = []
+    for msg in packed["history"]:
+        # Basic validation for role
+        if msg["role"] == "user":
+            history_objs.append(UserContent(parts=[Part(text=msg["text"])]))
+        elif msg["role"] == "model":
+            history_objs.append(ModelContent(parts=[Part(text=msg["text"])]))
+
+    # --- Configuration ---
+    # Keeping it wholesome and Christian
+    safety_settings = [
+        {
+            "category": "HARM_CATEGORY_HARASSMENT",
+            "threshold": "BLOCK_MEDIUM_AND_ABOVE",
+        },
+        {
+            "category": "HARM_CATEGORY_HATE_SPEECH",
+            "threshold": "BLOCK_MEDIUM_AND_ABOVE",
+        },
+        {
+            "category": "HARM_CATEGORY_SEXUALLY_EXPLICIT",
+            "threshold": "BLOCK_MEDIUM_AND_ABOVE",
+        },
+        {
+            "category": "HARM_CATEGORY_DANGEROUS_CONTENT",
+            "threshold": "BLOCK_MEDIUM_AND_ABOVE",
+        },
+    ]
+    # Basic model config
+    generation_config = GenerateContentConfig(
+        temperature=0.9,  # 90% randomness, keeping it fresh.
+        max_output_tokens=CHAT_MAX_OUTPUT_TOKENS,  # 1000 tokens = 750 words (I think)
+        top_p=0.9,  # consider the top 90% of the probability distribution when generating text.
+        top_k=40,  # consider the top 40 tokens with the highest probabilities when generating text.
+        safety_settings=safety_settings,
+        cached_content=cached_content,
+        # system_instruction=SYSTEM_INSTRUCTION,
+    )
+    prompt = summary_text
+    if cached_content is None:
+        prompt += format_sources(files_content)
+    # Add the system instruction to the prompt
+    prompt += packed["question"]
+    return {
+        "model": PROVIDER_CACHE_MODEL if cached_content else MODEL_NAME,
+        "history_objs": history_objs,
+        "prompt": prompt,
+        "config": generation_config,
+        "packed": packed,
+        "history": history,
+    }
+
+
+async def save_chat_turn(
+    request: ChatRequest,
+    user_id: str,
+    reply_text: str,
+    history: dict,
+    background_tasks: BackgroundTasks,
+):
+    """
+    Store both messages of a finished turn and refresh the summary if older
+    turns are waiting to be folded into it.
+    """
+    await insert_message(
+        notebook_id=request.notebookID,
+        responder="user",
+        message=request.user_text,
+        user_id=user_id,
+    )
+    await insert_message(
+        notebook_id=request.notebookID,
+        responder=MODEL_NAME,
+        message=reply_text,
+    )
+    if history["stale"]:
+        background_tasks.add_task(
+            refresh_summary, request.notebookID, generate_single_turn
+        )
+
+
+async def answer_chat(request: ChatRequest, files: list):
+    """
+    Answer a chat turn without storing it.
+    Returns a dict with the "reply" text and the "chat" of prepare_chat.
+    """
+    chat = await prepare_chat(request, files)
+    try:
+        # --- Send Message to Gemini ---
+        response = await send_chat_message(
+            chat["model"],
+            chat["history_objs"],
+            chat["prompt"],
+            chat["config"],
+        )
+        # --- Process Response ---
+        return {"reply": response.text, "chat": chat}
+    except ValueError:
+        # This usually indicates the response was blocked by safety settings
+        # Optionally inspect response.prompt_feedback here
+        feedback = response.prompt_feedback
+        block_reason = "Content may be blocked by safety settings."
+        if feedback.block_reason:
+            block_reason += (
+                f" Reason: {feedback.block_reason.name}"  # Use .name for enum
             )
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST, detail=block_reason
+        )
+    except HTTPException:
+        raise
+    except Exception as e:
+        # Catch other potential errors during response processing
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            detail=f"Error processing the bot's response.{str(e)}",
+        )
+
+
+# --- API Endpoint ---
+@router.post("/chat", response_model=ChatResponse)
+async def handle_chat(
+    request: ChatRequest,
+    background_tasks: BackgroundTasks,
+    user_id: str = Cookie(None),
+):
+    """
+    Receives user text, rebuilds the chat history from the notebook's
+    messages, calls the Gemini API and returns the model's reply.
+    Identical questions sent at the same time share a single model call,
+    each of them is stored as its own turn.
+    """
+    if not GEMINI_API_KEY:
+        raise HTTPException(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            detail="API Key not configured on server.",
+        )
+    admit(user_id)
 
+    try:
+        files = await get_files(request.notebookID)
+        key = (
+            "chat",
+            request.notebookID,
+            fingerprint_files(files, request.excluded_files),
+            normalize_input(request.user_text),
+        )
+        answer = await coalesce(key, lambda: answer_chat(request, files))
+        chat = answer["chat"]
+        await save_chat_turn(
+            request, user_id, answer["reply"], chat["history"], background_tasks
+        )
+        return ChatResponse(reply=answer["reply"], context=chat["packed"]["report"])
+    except HTTPException:
+        raise
     except Exception as e:
         # Catch potential errors during API call setup or sending
         # You might want more specific error handling based on Gemini SDK exceptions
@@ -345,6 +945,87 @@ async def handle_chat(request: ChatRequest, user_id: str = Cookie(None)):
         )
 
 
+@router.post("/chat-stream")
+async def handle_chat_stream(
+    request: ChatRequest,
+    http_request: Request,
+    background_tasks: BackgroundTasks,
+    user_id: str = Cookie(None),
+):
+    """
+    Streaming variant of /chat: the reply is sent as Server-Sent Events as
+    soon as the model produces it. Each event carries {"text": ...}, a final
+    "done" event carries the context report and failures, an empty reply
+    included, an "error" event.
+    Both messages are stored once the reply is complete, a client that
+    disconnects cancels the model call and nothing is stored.
+    """
+    if not GEMINI_API_KEY:
+        raise HTTPException(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            detail="API Key not configured on server.",
+        )
+    admit(user_id)
+    try:
+        chat = await prepare_chat(request)
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            detail=f"An error occurred while contacting the AI service: {str(e)}",
+        )
+
+    async def events():
+        parts = []
+        chunk = None
+        try:
+            async with aclosing(
+                stream_chat_message(
+                    chat["model"],
+                    chat["history_objs"],
+                    chat["prompt"],
+                    chat["config"],
+                )
+            ) as stream:
+                async for chunk in stream:
+                    if await http_request.is_disconnected():
+                        print(f"Client left the chat stream of {request.notebookID}")
+                        return
+                    if chunk.text:
+                        parts.append(chunk.text)
+                        yield f"data: {json.dumps({'text': chunk.text})}\n\n"
+            if not parts:
+                # Blocked or empty, like /chat nothing is stored
+                detail = "AI model returned an empty response."
+                feedback = getattr(chunk, "prompt_feedback", None)
+                if feedback is not None and feedback.block_reason:
+                    detail = (
+                        "Content may be blocked by safety settings."
+                        f" Reason: {feedback.block_reason.name}"
+                    )
+                yield f"event: error\ndata: {json.dumps({'detail': detail})}\n\n"
+                return
+            await save_chat_turn(
+                request, user_id, "".join(parts), chat["history"], background_tasks
+            )
+            done = {"context": chat["packed"]["report"]}
+            yield f"event: done\ndata: {json.dumps(done)}\n\n"
+        except HTTPException as e:
+            yield f"event: error\ndata: {json.dumps({'detail': e.detail})}\n\n"
+        except Exception as e:
+            print(f"Error streaming the chat reply: {e}")
+            error = {"detail": f"Error processing the bot's response. {str(e)}"}
+            yield f"event: error\ndata: {json.dumps(error)}\n\n"
+
+    return StreamingResponse(
+        events(),
+        media_type="text/event-stream",
+        # Proxies must not buffer the events
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
 @router.post("/fetch-messages")
 async def get_messages_route(res: Response, notebookID: str = Form(...)):
     """
@@ -390,15 +1071,22 @@ async def delete_file_route(
     """
     print("Deleting the file")
     print(f"Files to delete: {files}")
+    files_by_name = {
+        file_meta["file_name"]: file_meta for file_meta in await get_files(notebookID)
+    }
     for file_name in files:
         print(f"Deleting file: {file_name}")
         print(f"Deleting file from {notebookID}/{file_name}")
-        response = await delete_file(f"{notebookID}/{file_name}", "files")
-        if response is None:
-            raise HTTPException(status_code=500, detail="Error deleting file")
+        file_meta = files_by_name.get(file_name)
+        if file_meta is None:
+            raise HTTPException(status_code=404, detail="File not found")
         response = await delete_file_metadata(file_name, notebookID)
         if response is None:
             raise HTTPException(status_code=500, detail="Error deleting file metadata")
+        # The blob is only removed once no notebook references its content
+        await release_source(notebookID, file_meta)
+        await unindex_source(notebookID, file_name)
+    await invalidate_source_context(notebookID)
     res.status_code = status.HTTP_200_OK
     return {"detail": "File deleted"}
 
@@ -414,20 +1102,25 @@ async def delete_notebook_route(res: Response, notebookID: str):
         # 1. Get all files for this notebook
         files = await get_files(notebookID)
 
-        # 2. Delete each file from storage
-        if files:
-            for file in files:
-                file_name = file.get("file_name")
-                print(f"Deleting file from storage: {notebookID}/{file_name}")
-                await delete_file(f"{notebookID}/{file_name}", "files")
-
-        # 3. Delete all file metadata for this notebook (batch operation)
+        # 2. Delete all file metadata for this notebook (batch operation)
         print(f"Deleting all file metadata for notebook: {notebookID}")
         await delete_all_file_metadata(notebookID)
 
+        # 3. Delete the blobs no other notebook references any more
+        if files:
+            for file in files:
+                print(f"Releasing file from storage: {file.get('file_name')}")
+                await release_source(notebookID, file)
+        await delete_notebook_index(notebookID)
+        await invalidate_source_context(notebookID)
+
         # 4. Delete all messages for this notebook
         print(f"Deleting all messages for notebook: {notebookID}")
         await delete_notebook_messages(notebookID)
+        await delete_summary(notebookID)
+        await delete_generations(notebookID)
+        await delete_briefing(notebookID)
+        await delete_notebook_jobs(notebookID)
 
         # 5. Finally delete the notebook itself
         response = await delete_notebook(notebookID)
@@ -514,27 +1207,179 @@ async def get_notebook_metadata_route(res: Response, notebookID: str = Form(...)
     return {"metadata": metadata}
 
 
-@router.post("/generate-faq", response_model=GenerationResponse)
-async def generate_faq_route(notebookID: str = Form(...)):
+@router.get("/symbols/{notebookID}")
+async def get_symbols_route(res: Response, notebookID: str, prefix: str = ""):
     """
-    Generates Frequently Asked Questions based on the notebook's source documents.
+    Find the functions, classes and methods of the notebook's code files by name.
     """
-    print(f"Generating FAQ for notebook: {notebookID}")
-    source_content = await get_combined_source_content(notebookID)
+    try:
+        symbols = await search_symbols(notebookID, prefix)
+        files_by_name = {
+            file_meta["file_name"]: file_meta
+            for file_meta in await get_files(notebookID)
+        }
+        for symbol in symbols:
+            file_meta = files_by_name.get(symbol["file_name"], {})
+            symbol["file_original_name"] = file_meta.get("file_original_name")
+        res.status_code = status.HTTP_200_OK
+        return {"symbols": symbols}
+    except Exception as e:
+        res.status_code = status.HTTP_500_INTERNAL_SERVER_ERROR
+        return {"detail": f"Error fetching symbols: {str(e)}"}
+
+
+@router.get("/extraction-stats")
+async def extraction_stats_route(res: Response):
+    """
+    Get the queue depth and per-page parse time of the extraction engine.
+    """
+    res.status_code = status.HTTP_200_OK
+    return {"stats": get_extraction_stats()}
+
+
+@router.get("/cache-stats")
+async def cache_stats_route(res: Response):
+    """
+    Get the hit, miss and eviction counters of the server-side caches.
+    """
+    res.status_code = status.HTTP_200_OK
+    return {
+        "blob_cache": get_blob_cache_stats(),
+        "source_context": get_context_cache_stats(),
+        "generations": get_generation_cache_stats(),
+        "map_reduce": get_map_reduce_stats(),
+    }
+
+
+@router.get("/llm-stats")
+async def llm_stats_route(res: Response):
+    """
+    Get the call, queue and timeout counters of the LLM gateway, how many
+    calls duplicate requests saved by sharing one, and the scheduler's
+    admission counters and queue wait times.
+    """
+    res.status_code = status.HTTP_200_OK
+    return {
+        "stats": get_llm_stats(),
+        "singleflight": get_singleflight_stats(),
+        "scheduler": get_scheduler_stats(),
+    }
+
+
+async def get_cached_generation(
+    notebook_id: str, kind: str, files: list
+) -> Optional[GenerationResponse]:
+    """
+    Get a generation cached for the notebook's current sources, or None.
+    Briefings come from the maintained briefing instead.
+    """
+    if kind == "briefing":
+        briefing = await get_briefing(notebook_id)
+        if not is_fresh(briefing, files):
+            return None
+        return GenerationResponse(
+            content=briefing["content"],
+            cached=True,
+            updated_at=briefing["updated_at"],
+            fresh=True,
+        )
+    fingerprint = fingerprint_files(files)
+    _, prompt_template = GENERATORS[kind]
+    version = template_version(
+        prompt_template, MODEL_NAME, GENERATION_MAX_OUTPUT_TOKENS
+    )
+    cached = await get_generation(notebook_id, kind, version, fingerprint)
+    if cached is None:
+        return None
+    print(f"Serving the cached {kind} of notebook {notebook_id}")
+    return GenerationResponse(
+        content=cached["content"], context=cached.get("context"), cached=True
+    )
+
+
+def generation_key(notebook_id: str, kind: str, files: list) -> tuple:
+    return ("generate", notebook_id, kind, fingerprint_files(files))
+
+
+async def run_generation(
+    notebook_id: str,
+    kind: str,
+    files: list,
+    source_content: str,
+    context_report: dict = None,
+) -> GenerationResponse:
+    """
+    Run a generation prompt over already combined source content and cache
+    the result. A briefing becomes the notebook's maintained briefing.
+    """
+    label, prompt_template = GENERATORS[kind]
     if not source_content:
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND,
-            detail="No source content found for this notebook to generate FAQ.",
+            detail=f"No source content found for this notebook to generate a {label}.",
+        )
+    prompt = prompt_template.format(source_content=source_content)
+    generated_text = await generate_single_turn(prompt)
+    if kind == "briefing":
+        updated_at = await save_briefing(notebook_id, generated_text, files, "full")
+        return GenerationResponse(
+            content=generated_text,
+            context=context_report,
+            updated_at=updated_at,
+            fresh=True,
         )
+    version = template_version(
+        prompt_template, MODEL_NAME, GENERATION_MAX_OUTPUT_TOKENS
+    )
+    await store_generation(
+        notebook_id,
+        kind,
+        version,
+        fingerprint_files(files),
+        generated_text,
+        context_report,
+    )
+    return GenerationResponse(content=generated_text, context=context_report)
 
-    prompt = f"""Based *only* on the following document content, generate a list of 3-5 frequently asked questions (FAQs) and their answers. Format each as a question followed by its answer. Document Content:
-{source_content}
 
-FAQs:
-"""
+async def generate_from_sources(
+    notebook_id: str, kind: str, regenerate: bool = False
+) -> GenerationResponse:
+    """
+    Run a generation prompt over the notebook's sources. The result is cached
+    until the template or the sources change, regenerate bypasses the cache.
+    """
+    files = await get_files(notebook_id)
+    if not regenerate:
+        cached = await get_cached_generation(notebook_id, kind, files)
+        if cached is not None:
+            return cached
+
+    async def generate():
+        source_content, context_report = await get_generation_content(
+            notebook_id, GENERATORS[kind][1], files
+        )
+        return await run_generation(
+            notebook_id, kind, files, source_content, context_report
+        )
+
+    # Duplicate requests for the same sources share one generation
+    return await coalesce(generation_key(notebook_id, kind, files), generate)
+
+
+@router.post("/generate-faq", response_model=GenerationResponse)
+async def generate_faq_route(
+    notebookID: str = Form(...),
+    regenerate: bool = Form(False),
+    user_id: str = Cookie(None),
+):
+    """
+    Generates Frequently Asked Questions based on the notebook's source documents.
+    """
+    print(f"Generating FAQ for notebook: {notebookID}")
+    admit(user_id)
     try:
-        generated_text = await generate_single_turn(prompt)
-        return GenerationResponse(content=generated_text)
+        return await generate_from_sources(notebookID, "faq", regenerate)
     except HTTPException as e:
         raise e
     except Exception as e:
@@ -543,30 +1388,18 @@ FAQs:
 
 
 @router.post("/generate-study-guide", response_model=GenerationResponse)
-async def generate_study_guide_route(notebookID: str = Form(...)):
+async def generate_study_guide_route(
+    notebookID: str = Form(...),
+    regenerate: bool = Form(False),
+    user_id: str = Cookie(None),
+):
     """
     Generates a study guide (key topics, potential questions) based on the notebook's source documents.
     """
     print(f"Generating Study Guide for notebook: {notebookID}")
-    source_content = await get_combined_source_content(notebookID)
-    if not source_content:
-        raise HTTPException(
-            status_code=status.HTTP_404_NOT_FOUND,
-            detail="No source content found for this notebook to generate a study guide.",
-        )
-
-    prompt = f"""Analyze the following document content and generate a concise study guide. Include:
-    1.  A list of the main key topics covered.
-    2.  3-4 potential short-answer or definition questions based *only* on the provided text.
-
-    Document Content:
-    {source_content}
-
-    Study Guide:
-    """
+    admit(user_id)
     try:
-        generated_text = await generate_single_turn(prompt)
-        return GenerationResponse(content=generated_text)
+        return await generate_from_sources(notebookID, "study-guide", regenerate)
     except HTTPException as e:
         raise e
     except Exception as e:
@@ -576,30 +1409,73 @@ async def generate_study_guide_route(notebookID: str = Form(...)):
         )
 
 
-@router.post("/generate-briefing", response_model=GenerationResponse)
-async def generate_briefing_route(notebookID: str = Form(...)):
+async def build_briefing(notebook_id: str, files: list):
     """
-    Generates a briefing (summary) based on the notebook's source documents.
+    Generate a notebook's briefing from all of its files.
     """
-    print(f"Generating Briefing for notebook: {notebookID}")
-    source_content = await get_combined_source_content(notebookID)
+    source_content, _ = await get_generation_content(
+        notebook_id, BRIEFING_PROMPT, files
+    )
     if not source_content:
-        raise HTTPException(
-            status_code=status.HTTP_404_NOT_FOUND,
-            detail="No source content found for this notebook to generate a briefing.",
-        )
+        return None
+    return await generate_single_turn(
+        BRIEFING_PROMPT.format(source_content=source_content)
+    )
 
-    prompt = f"""Based *only* on the following document content, generate a concise briefing. 
-    The briefing should summarize the key points and findings from the documents.
 
-    Document Content:
-    {source_content}
+async def extend_briefing(notebook_id: str, briefing: str, files: list):
+    """
+    Fold newly added files into a notebook's previous briefing.
+    """
+    source_content, _ = await get_generation_content(
+        notebook_id, BRIEFING_UPDATE_PROMPT + briefing, files
+    )
+    if not source_content:
+        return briefing
+    return await generate_single_turn(
+        BRIEFING_UPDATE_PROMPT.format(briefing=briefing, source_content=source_content)
+    )
 
-    Briefing:
+
+def schedule_briefing_update(background_tasks: BackgroundTasks, notebook_id: str):
+    """
+    Update the notebook's briefing, if it has one, once the response is sent.
+    """
+    background_tasks.add_task(
+        refresh_briefing, notebook_id, build_briefing, extend_briefing
+    )
+
+
+@router.post("/generate-briefing", response_model=GenerationResponse)
+async def generate_briefing_route(
+    background_tasks: BackgroundTasks,
+    notebookID: str = Form(...),
+    regenerate: bool = Form(False),
+    user_id: str = Cookie(None),
+):
     """
+    Generates a briefing (summary) based on the notebook's source documents.
+    Once generated, the briefing is kept up to date as sources are added and
+    served immediately: fresh tells whether it covers the current sources,
+    updated_at when it was last updated.
+    """
+    print(f"Generating Briefing for notebook: {notebookID}")
+    admit(user_id)
     try:
-        generated_text = await generate_single_turn(prompt)
-        return GenerationResponse(content=generated_text)
+        briefing = None if regenerate else await get_briefing(notebookID)
+        if briefing is None:
+            return await generate_from_sources(notebookID, "briefing", True)
+        files = await get_files(notebookID)
+        fresh = is_fresh(briefing, files)
+        if not fresh:
+            # Served as it is while the update runs
+            schedule_briefing_update(background_tasks, notebookID)
+        return GenerationResponse(
+            content=briefing["content"],
+            cached=True,
+            updated_at=briefing["updated_at"],
+            fresh=fresh,
+        )
     except HTTPException as e:
         raise e
     except Exception as e:
@@ -609,9 +1485,138 @@ async def generate_briefing_route(notebookID: str = Form(...)):
         )
 
 
+async def generate_artifacts(notebook_id: str, kinds: list, regenerate: bool):
+    """
+    Run several generators over the notebook's sources, read and packed once
+    for all of them. Cached artifacts are served as they are, the others are
+    generated concurrently.
+    Yields (kind, GenerationResponse or HTTPException) pairs as they complete.
+    """
+    files = await get_files(notebook_id)
+    pending = []
+    for kind in kinds:
+        cached = None
+        if not regenerate:
+            cached = await get_cached_generation(notebook_id, kind, files)
+        if cached is not None:
+            yield kind, cached
+        else:
+            pending.append(kind)
+    if not pending:
+        return
+
+    # Packed against the longest template, so that the content fits every prompt
+    longest_template = max((GENERATORS[kind][1] for kind in pending), key=len)
+    source_content, context_report = await get_generation_content(
+        notebook_id, longest_template, files
+    )
+
+    async def generate(kind):
+        try:
+            return kind, await coalesce(
+                generation_key(notebook_id, kind, files),
+                lambda: run_generation(
+                    notebook_id, kind, files, source_content, context_report
+                ),
+            )
+        except HTTPException as e:
+            return kind, e
+        except Exception as e:
+            print(f"Unexpected error generating {kind}: {e}")
+            return kind, HTTPException(
+                status_code=500, detail=f"Failed to generate {kind}: {str(e)}"
+            )
+
+    tasks = [asyncio.create_task(generate(kind)) for kind in pending]
+    try:
+        for task in asyncio.as_completed(tasks):
+            yield await task
+    finally:
+        # The client went away before every artifact was ready
+        for task in tasks:
+            task.cancel()
+
+
+@router.post("/generate-artifacts")
+async def generate_artifacts_route(
+    notebookID: str = Form(...),
+    kinds: str = Form(",".join(GENERATORS)),
+    regenerate: bool = Form(False),
+    stream: bool = Form(False),
+    user_id: str = Cookie(None),
+):
+    """
+    Generates several artifacts at once from a comma separated list of kinds
+    (faq, study-guide, briefing). Returns them all together, or with stream
+    as Server-Sent Events, one "artifact" event each as soon as it is ready
+    and a final "done" event.
+    """
+    requested = [kind.strip() for kind in kinds.split(",") if kind.strip()]
+    unknown = [kind for kind in requested if kind not in GENERATORS]
+    if not requested or unknown:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=f"Unknown artifact kinds: {', '.join(unknown) or kinds}. "
+            f"Expected some of {', '.join(GENERATORS)}.",
+        )
+    requested = list(dict.fromkeys(requested))
+    admit(user_id)
+    print(f"Generating {', '.join(requested)} for notebook: {notebookID}")
+
+    def artifact(kind, result):
+        if isinstance(result, HTTPException):
+            return {
+                "kind": kind,
+                "status_code": result.status_code,
+                "detail": result.detail,
+            }
+        return {"kind": kind, **result.model_dump()}
+
+    if not stream:
+        artifacts = {}
+        try:
+            async with aclosing(
+                generate_artifacts(notebookID, requested, regenerate)
+            ) as results:
+                async for kind, result in results:
+                    artifacts[kind] = artifact(kind, result)
+        except HTTPException as e:
+            raise e
+        except Exception as e:
+            print(f"Unexpected error generating artifacts: {e}")
+            raise HTTPException(
+                status_code=500, detail=f"Failed to generate artifacts: {str(e)}"
+            )
+        return {"artifacts": artifacts}
+
+    async def events():
+        try:
+            async with aclosing(
+                generate_artifacts(notebookID, requested, regenerate)
+            ) as results:
+                async for kind, result in results:
+                    event = "error" if isinstance(result, HTTPException) else "artifact"
+                    data = json.dumps(artifact(kind, result), default=str)
+                    yield f"event: {event}\ndata: {data}\n\n"
+            yield "event: done\ndata: {}\n\n"
+        except HTTPException as e:
+            yield f"event: error\ndata: {json.dumps({'detail': e.detail})}\n\n"
+        except Exception as e:
+            print(f"Error streaming artifacts: {e}")
+            error = {"detail": f"Failed to generate artifacts: {str(e)}"}
+            yield f"event: error\ndata: {json.dumps(error)}\n\n"
+
+    return StreamingResponse(
+        events(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
 @router.post("/save-generated-source")
 async def save_generated_source_route(
     res: Response,
+    background_tasks: BackgroundTasks,
     notebookID: str = Form(...),
     content: str = Form(...),
     title: str = Form(...),
@@ -631,39 +1636,49 @@ async def save_generated_source_route(
 
     timestamp = datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
 
+    spool = SpooledBuffer()
     try:
-        file_content_bytes = content.encode("utf-8")
-        file_size = len(file_content_bytes)
+        spool.write(content.encode("utf-8"))
+        spool.finish()
         unique_filename = f"{timestamp}.md"  # Save as markdown
         file_type = "text/markdown"
-        bucket_name = "files"
-
-        print(
-            f"Uploading new source file: {unique_filename} to bucket: {bucket_name}/{notebookID}"
-        )
-        public_url = await upload(
-            file_content_bytes, unique_filename, bucket_name, notebookID
-        )
 
-        if not public_url:
+        print(f"Uploading new source file: {unique_filename} for {notebookID}")
+        try:
+            record = await store_spooled_source(
+                notebookID,
+                spool,
+                unique_filename,
+                file_type,
+                title,  # Use the provided title as the display name
+            )
+        except HTTPException:
             print("Error: Failed to upload generated source to storage.")
             raise HTTPException(
                 status_code=500, detail="Error saving source file to storage."
             )
-        else:
-            print(f"Successfully uploaded. Public URL: {public_url}")
+        public_url = record["public_url"]
+        print(f"Successfully uploaded. Public URL: {public_url}")
 
         print(f"Inserting metadata for new source: {unique_filename}")
-        await insert_file_metadata(
-            notebook_id=notebookID,
-            file_name=unique_filename,
-            file_type=file_type,
-            file_size=file_size,
-            file_original_name=title,  # Use the provided title as the display name
-            public_url=public_url,
-        )
+        try:
+            await insert_file_metadata(
+                notebook_id=notebookID,
+                file_name=unique_filename,
+                file_type=file_type,
+                file_size=record["file_size"],
+                file_original_name=title,
+                public_url=public_url,
+                content_hash=record["content_hash"],
+                blob_path=record["blob_path"],
+            )
+        except BaseException:
+            await release_unregistered(notebookID, [record])
+            raise
 
         await update_notebook_metadata(notebook_id=notebookID, source=1)
+        await invalidate_source_context(notebookID)
+        schedule_briefing_update(background_tasks, notebookID)
 
         res.status_code = status.HTTP_201_CREATED  # Use 201 for resource creation
         return {
@@ -676,3 +1691,91 @@ async def save_generated_source_route(
     except Exception as e:
         print(f"Unexpected error saving generated source: {e}")
         raise HTTPException(status_code=500, detail=f"Failed to save source: {str(e)}")
+    finally:
+        spool.close()
+
+
+async def run_generation_job(job: dict) -> dict:
+    """
+    Run a generation job queued by /jobs. Returns the GenerationResponse as
+    a dict.
+    """
+    # Scheduled for the user who submitted it, already admitted then
+    current_user.set(job.get("user_id") or ANONYMOUS_USER)
+    notebook_id = job["notebook_id"]
+    regenerate = job["params"].get("regenerate", False)
+    if job["kind"] == "briefing" and not regenerate:
+        # Brings a maintained briefing up to date with only the new sources
+        await refresh_briefing(notebook_id, build_briefing, extend_briefing)
+    response = await generate_from_sources(notebook_id, job["kind"], regenerate)
+    return response.model_dump(mode="json")
+
+
+@router.post("/jobs")
+async def submit_job_route(
+    res: Response,
+    notebookID: str = Form(...),
+    kind: str = Form(...),
+    regenerate: bool = Form(False),
+    user_id: str = Cookie(None),
+):
+    """
+    Queue the generation of an artifact (faq, study-guide or briefing) and
+    return its job right away. A job of the same kind already queued or
+    running for the notebook is returned instead of a new one. Poll
+    /jobs/{job_id} or subscribe to /jobs/{job_id}/events for the result.
+    """
+    if kind not in GENERATORS:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=f"Unknown artifact kind: {kind}. Expected one of {', '.join(GENERATORS)}.",
+        )
+    admit(user_id)
+    job = await submit_job(notebookID, kind, {"regenerate": regenerate}, user_id)
+    print(f"Job {job['_id']} ({kind}) for notebook {notebookID} is {job['status']}")
+    res.status_code = status.HTTP_202_ACCEPTED
+    return public_job(job)
+
+
+@router.get("/jobs/{job_id}")
+async def get_job_route(res: Response, job_id: str):
+    """
+    Get the status of a job, and its result or error once it is finished.
+    """
+    job = await get_job(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+    res.status_code = status.HTTP_200_OK
+    return public_job(job)
+
+
+@router.get("/jobs/{job_id}/events")
+async def job_events_route(job_id: str):
+    """
+    Follow a job as Server-Sent Events: a "status" event each time its status
+    changes, then a "done" or "error" event carrying the finished job.
+    """
+    if await get_job(job_id) is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+
+    async def events():
+        async with aclosing(watch_job(job_id)) as updates:
+            async for job in updates:
+                event = {"done": "done", "failed": "error"}.get(job["status"], "status")
+                data = json.dumps(public_job(job), default=str)
+                yield f"event: {event}\ndata: {data}\n\n"
+
+    return StreamingResponse(
+        events(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
+@router.get("/job-stats")
+async def job_stats_route(res: Response):
+    """
+    Get the submission and completion counters of the job queue.
+    """
+    res.status_code = status.HTTP_200_OK
+    return {"stats": get_job_stats()}
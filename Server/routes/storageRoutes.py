@@ -0,0 +1,65 @@
+import os
+
+from fastapi import APIRouter, HTTPException, Request, status
+from fastapi.responses import FileResponse
+
+from models import localStorage
+from models.storage import STORAGE_MAX_DOWNLOAD_BYTES, UploadTooLarge
+
+# Stand-in for the Supabase storage endpoints the clients use, served when
+# STORAGE_BACKEND is "filesystem". The paths match Supabase's, so the URLs of
+# both backends are used the same way.
+router = APIRouter(prefix="/storage/v1/object")
+
+
+def local_path(file_path: str, bucket_name: str) -> str:
+    try:
+        return localStorage.object_path(file_path, bucket_name)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid object path")
+
+
+@router.put("/upload/sign/{bucket_name}/{file_path:path}")
+async def signed_upload_route(
+    request: Request, bucket_name: str, file_path: str, token: str
+):
+    """
+    Store the body of the request at a path a signed upload URL was issued for.
+    """
+    local_path(file_path, bucket_name)
+    if not localStorage.verify_upload_token(file_path, bucket_name, token):
+        raise HTTPException(
+            status_code=status.HTTP_403_FORBIDDEN, detail="Invalid or expired token"
+        )
+
+    async def body():
+        size = 0
+        async for chunk in request.stream():
+            size += len(chunk)
+            if size > STORAGE_MAX_DOWNLOAD_BYTES:
+                raise UploadTooLarge()
+            yield chunk
+
+    try:
+        stored = await localStorage.write_object(body(), file_path, bucket_name, False)
+    except UploadTooLarge:
+        raise HTTPException(
+            status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE,
+            detail=f"Uploads are limited to {STORAGE_MAX_DOWNLOAD_BYTES} bytes",
+        )
+    if not stored:
+        raise HTTPException(
+            status_code=status.HTTP_409_CONFLICT, detail="The object already exists"
+        )
+    return {"Key": f"{bucket_name}/{file_path}"}
+
+
+@router.get("/public/{bucket_name}/{file_path:path}")
+async def public_object_route(bucket_name: str, file_path: str):
+    """
+    Serve a stored object at its public URL.
+    """
+    path = local_path(file_path, bucket_name)
+    if not os.path.isfile(path):
+        raise HTTPException(status_code=404, detail="Object not found")
+    return FileResponse(path)
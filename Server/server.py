@@ -1,19 +1,48 @@
 import os
+from contextlib import asynccontextmanager
 
 from dotenv import load_dotenv
 from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
 from pymongo import AsyncMongoClient
 
+from models.briefing import ensure_briefing_indexes
+from models.conversation import ensure_conversation_indexes
+from models.extraction import shutdown_process_pool
+from models.generationCache import ensure_generation_indexes
+from models.jobs import start_job_workers, stop_job_workers
+from models.mapReduce import ensure_map_reduce_indexes
+from models.notebookModel import ensure_source_indexes
+from models.retrieval import ensure_indexes
+from models.storage import STORAGE_BACKEND, close_http_client
 from routes.authRoutes import router as auth_router
 from routes.notebookRoutes import router as notebook_router
+from routes.notebookRoutes import run_generation_job
+from routes.storageRoutes import router as storage_router
 
 # --- Load Environment Variables ---
 load_dotenv()  # Get the local one
 GEMINI_API_KEY = os.getenv("GEMINI_API_KEY")
 
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    await ensure_indexes()
+    await ensure_source_indexes()
+    await ensure_conversation_indexes()
+    await ensure_generation_indexes()
+    await ensure_map_reduce_indexes()
+    await ensure_briefing_indexes()
+    await start_job_workers(run_generation_job)
+    yield
+    # Release pooled connections and worker processes on shutdown
+    await stop_job_workers()
+    await close_http_client()
+    shutdown_process_pool()
+
+
 # --- FastAPI App Initialization ---
-app = FastAPI()
+app = FastAPI(lifespan=lifespan)
 
 MONGO_URI = os.getenv("MONGO_URI", "mongodb://localhost:27017")
 
@@ -21,6 +50,9 @@ mongo_client = AsyncMongoClient(MONGO_URI)
 
 app.include_router(notebook_router, prefix="/api")
 app.include_router(auth_router)  # does not need a prefix
+if STORAGE_BACKEND == "filesystem":
+    # Local stand-in for the Supabase storage URLs
+    app.include_router(storage_router)
 
 # --- CORS Configuration ---
 app.add_middleware(
@@ -0,0 +1,283 @@
+import copy
+import itertools
+from types import SimpleNamespace
+
+from pymongo import ReturnDocument
+from pymongo.errors import DuplicateKeyError
+
+# In-memory stand-in for the pymongo async collection methods the models use.
+# Each call runs without awaiting, so like MongoDB's single document writes it
+# is atomic with respect to the other coroutines.
+
+MISSING = object()
+
+
+def get_field(document: dict, path: str):
+    value = document
+    for part in path.split("."):
+        if not isinstance(value, dict) or part not in value:
+            return MISSING
+        value = value[part]
+    return value
+
+
+def set_field(document: dict, path: str, value):
+    *parents, last = path.split(".")
+    for part in parents:
+        document = document.setdefault(part, {})
+    document[last] = value
+
+
+def unset_field(document: dict, path: str):
+    *parents, last = path.split(".")
+    for part in parents:
+        document = document.get(part, {})
+    document.pop(last, None)
+
+
+def is_operator_condition(condition) -> bool:
+    return (
+        isinstance(condition, dict)
+        and bool(condition)
+        and all(key.startswith("$") for key in condition)
+    )
+
+
+def matches_condition(value, condition) -> bool:
+    # Arrays match when one of their elements does, as multikey indexes do
+    if isinstance(value, list) and not isinstance(condition, list):
+        if any(matches_condition(element, condition) for element in value):
+            return True
+    if not is_operator_condition(condition):
+        if condition is None:
+            return value is MISSING or value is None
+        return value == condition
+    for operator, argument in condition.items():
+        present = value is not MISSING
+        if operator == "$exists":
+            if present != bool(argument):
+                return False
+        elif operator == "$ne":
+            if (value if present else None) == argument:
+                return False
+        elif operator == "$in":
+            if not present or value not in argument:
+                return False
+        elif operator in ("$lt", "$lte", "$gt", "$gte"):
+            if not present or value is None:
+                return False
+            compare = {
+                "$lt": value < argument,
+                "$lte": value <= argument,
+                "$gt": value > argument,
+                "$gte": value >= argument,
+            }
+            if not compare[operator]:
+                return False
+        else:
+            raise NotImplementedError(operator)
+    return True
+
+
+def matches(document: dict, query: dict) -> bool:
+    for key, condition in query.items():
+        if key == "$or":
+            if not any(matches(document, option) for option in condition):
+                return False
+        elif not matches_condition(get_field(document, key), condition):
+            return False
+    return True
+
+
+def project(document: dict, projection: dict) -> dict:
+    document = copy.deepcopy(document)
+    if not projection:
+        return document
+    if not any(projection.values()):
+        for path in projection:
+            unset_field(document, path)
+        return document
+    projected = {}
+    for path in ["_id", *projection]:
+        value = get_field(document, path)
+        if projection.get(path, 1) and value is not MISSING:
+            set_field(projected, path, value)
+    return projected
+
+
+class FakeCursor:
+    def __init__(self, documents: list):
+        self.documents = documents
+
+    def sort(self, keys: list):
+        for field, direction in reversed(keys):
+            self.documents.sort(
+                key=lambda document: document[field], reverse=direction < 0
+            )
+        return self
+
+    def limit(self, count: int):
+        self.documents = self.documents[:count]
+        return self
+
+    async def to_list(self, length=None):
+        return self.documents[:length]
+
+
+def apply_update(document: dict, update: dict, inserting: bool):
+    for path, value in update.get("$set", {}).items():
+        set_field(document, path, copy.deepcopy(value))
+    for path in update.get("$unset", {}):
+        unset_field(document, path)
+    for path, amount in update.get("$inc", {}).items():
+        current = get_field(document, path)
+        set_field(document, path, (0 if current is MISSING else current) + amount)
+    if inserting:
+        for path, value in update.get("$setOnInsert", {}).items():
+            set_field(document, path, copy.deepcopy(value))
+
+
+class FakeCollection:
+    def __init__(self, unique=()):
+        # unique is a list of (field, partial filter or None)
+        self.documents = []
+        self.unique = list(unique)
+        self.ids = itertools.count(1)
+
+    def check_unique(self, document: dict, ignore=None):
+        for other in self.documents:
+            if other is ignore:
+                continue
+            if other["_id"] == document["_id"]:
+                raise DuplicateKeyError("duplicate _id")
+            for field, partial in self.unique:
+                value = get_field(document, field)
+                if value is MISSING or value != get_field(other, field):
+                    continue
+                if partial is None or (
+                    matches(document, partial) and matches(other, partial)
+                ):
+                    raise DuplicateKeyError(f"duplicate {field}")
+
+    def find_matching(self, query: dict, sort=None):
+        found = [document for document in self.documents if matches(document, query)]
+        for field, direction in reversed(sort or []):
+            found.sort(key=lambda document: document[field], reverse=direction < 0)
+        return found
+
+    async def create_index(self, *args, **kwargs):
+        pass
+
+    async def insert_one(self, document: dict):
+        document.setdefault("_id", next(self.ids))
+        stored = copy.deepcopy(document)
+        self.check_unique(stored)
+        self.documents.append(stored)
+        return SimpleNamespace(inserted_id=document["_id"])
+
+    async def insert_many(self, documents: list, ordered=True):
+        for document in documents:
+            await self.insert_one(document)
+
+    async def find_one(self, query: dict):
+        found = self.find_matching(query)
+        return copy.deepcopy(found[0]) if found else None
+
+    def find(self, query: dict, projection: dict = None):
+        return FakeCursor(
+            [project(document, projection) for document in self.find_matching(query)]
+        )
+
+    async def count_documents(self, query: dict):
+        return len(self.find_matching(query))
+
+    async def distinct(self, field: str, query: dict):
+        values = []
+        for document in self.find_matching(query):
+            value = get_field(document, field)
+            if value is not MISSING and value not in values:
+                values.append(value)
+        return values
+
+    def upsert(self, query: dict, update: dict):
+        document = {
+            key: copy.deepcopy(condition)
+            for key, condition in query.items()
+            if not key.startswith("$") and not is_operator_condition(condition)
+        }
+        document.setdefault("_id", next(self.ids))
+        apply_update(document, update, inserting=True)
+        self.check_unique(document)
+        self.documents.append(document)
+        return document
+
+    def update(self, document: dict, update: dict) -> bool:
+        before = copy.deepcopy(document)
+        apply_update(document, update, inserting=False)
+        try:
+            self.check_unique(document, ignore=document)
+        except DuplicateKeyError:
+            document.clear()
+            document.update(before)
+            raise
+        return document != before
+
+    async def find_one_and_update(
+        self,
+        query: dict,
+        update: dict,
+        upsert=False,
+        sort=None,
+        return_document=ReturnDocument.BEFORE,
+    ):
+        found = self.find_matching(query, sort)
+        if not found:
+            if not upsert:
+                return None
+            document = self.upsert(query, update)
+            return (
+                copy.deepcopy(document)
+                if return_document == ReturnDocument.AFTER
+                else None
+            )
+        before = copy.deepcopy(found[0])
+        self.update(found[0], update)
+        if return_document == ReturnDocument.AFTER:
+            return copy.deepcopy(found[0])
+        return before
+
+    async def update_one(self, query: dict, update: dict, upsert=False):
+        found = self.find_matching(query)
+        if not found:
+            if upsert:
+                self.upsert(query, update)
+            return SimpleNamespace(matched_count=0, modified_count=0)
+        modified = self.update(found[0], update)
+        return SimpleNamespace(matched_count=1, modified_count=int(modified))
+
+    async def update_many(self, query: dict, update: dict):
+        found = self.find_matching(query)
+        modified = sum(self.update(document, update) for document in found)
+        return SimpleNamespace(matched_count=len(found), modified_count=modified)
+
+    async def delete_one(self, query: dict):
+        found = self.find_matching(query)
+        if found:
+            self.documents.remove(found[0])
+        return SimpleNamespace(deleted_count=len(found[:1]))
+
+    async def delete_many(self, query: dict):
+        found = self.find_matching(query)
+        for document in found:
+            self.documents.remove(document)
+        return SimpleNamespace(deleted_count=len(found))
+
+
+class FakeDatabase(dict):
+    """
+    Collections are created on first use, as in MongoDB.
+    """
+
+    def __missing__(self, name: str):
+        collection = self[name] = FakeCollection()
+        return collection
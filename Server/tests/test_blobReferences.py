@@ -0,0 +1,124 @@
+import asyncio
+import datetime
+
+import pytest
+
+from fakeMongo import FakeDatabase
+from models import ingestion, notebookModel
+
+
+@pytest.fixture
+def db(monkeypatch):
+    database = FakeDatabase()
+    monkeypatch.setattr(notebookModel, "db", database)
+    return database
+
+
+def reference(db, content_hash: str):
+    return asyncio.run(db["blob_references"].find_one({"_id": content_hash}))
+
+
+def test_the_last_release_owns_the_deletion(db):
+    async def acquire_twice_release_twice():
+        await notebookModel.acquire_blob_reference("h")
+        await notebookModel.acquire_blob_reference("h")
+        first = await notebookModel.release_blob_reference("h")
+        last = await notebookModel.release_blob_reference("h")
+        return first, last
+
+    assert asyncio.run(acquire_twice_release_twice()) == (False, True)
+    assert reference(db, "h")["deleting"] is True
+    asyncio.run(notebookModel.forget_blob_reference("h"))
+    assert reference(db, "h") is None
+
+
+def test_records_still_holding_the_content_keep_it(db):
+    db["notebook_files"].documents.extend(
+        [
+            {"_id": "f1", "notebook_id": "a", "file_name": "1", "content_hash": "h"},
+            {"_id": "f2", "notebook_id": "b", "file_name": "2", "content_hash": "h"},
+        ]
+    )
+    # Files stored before reference counting have no reference document
+    assert asyncio.run(notebookModel.release_blob_reference("h")) is False
+    assert reference(db, "h")["refs"] == 2
+    assert reference(db, "h")["deleting"] is False
+
+
+def test_acquire_waits_for_a_deletion_in_progress(db):
+    async def acquire_during_deletion():
+        await notebookModel.acquire_blob_reference("h")
+        assert await notebookModel.release_blob_reference("h")
+        acquiring = asyncio.ensure_future(notebookModel.acquire_blob_reference("h"))
+        await asyncio.sleep(0.05)
+        assert not acquiring.done()
+        await notebookModel.forget_blob_reference("h")
+        await asyncio.wait_for(acquiring, 1)
+
+    asyncio.run(acquire_during_deletion())
+    assert reference(db, "h")["refs"] == 1
+
+
+def test_a_stale_deletion_is_taken_over(db):
+    stale = datetime.datetime.utcnow() - datetime.timedelta(
+        seconds=notebookModel.BLOB_LEASE_SECONDS + 1
+    )
+    db["blob_references"].documents.append(
+        {"_id": "h", "refs": 0, "deleting": True, "deleting_at": stale}
+    )
+    asyncio.run(asyncio.wait_for(notebookModel.acquire_blob_reference("h"), 1))
+    taken = reference(db, "h")
+    assert taken["refs"] == 1 and taken["deleting"] is False
+    assert "deleting_at" not in taken
+
+
+def test_one_reader_claims_a_legacy_migration(db):
+    db["notebook_files"].documents.append(
+        {"_id": "f", "notebook_id": "nb", "file_name": "a.pdf", "blob_path": None}
+    )
+
+    async def claim_twice():
+        return await asyncio.gather(
+            notebookModel.claim_file_migration("a.pdf", "nb"),
+            notebookModel.claim_file_migration("a.pdf", "nb"),
+        )
+
+    assert sorted(asyncio.run(claim_twice())) == [False, True]
+    asyncio.run(notebookModel.set_file_blob("a.pdf", "nb", "h", "blobs/h"))
+    record = db["notebook_files"].documents[0]
+    assert record["blob_path"] == "blobs/h" and "migrating_at" not in record
+    assert asyncio.run(notebookModel.claim_file_migration("a.pdf", "nb")) is False
+
+
+def test_unregistered_records_release_their_content(db, monkeypatch):
+    deleted = []
+    unindexed = []
+
+    async def delete_file(path, bucket_name):
+        deleted.append(path)
+
+    async def unindex_source(notebook_id, file_name):
+        unindexed.append(file_name)
+
+    monkeypatch.setattr(ingestion, "delete_file", delete_file)
+    monkeypatch.setattr(ingestion, "unindex_source", unindex_source)
+    records = [
+        {
+            "notebook_id": "nb",
+            "file_name": name,
+            "content_hash": name,
+            "blob_path": name,
+        }
+        for name in ("kept", "lost")
+    ]
+
+    async def insert_one_of_two():
+        for record in records:
+            await notebookModel.acquire_blob_reference(record["content_hash"])
+        await db["notebook_files"].insert_one(dict(records[0]))
+        return await ingestion.release_unregistered("nb", records)
+
+    assert asyncio.run(insert_one_of_two()) == 1
+    assert unindexed == ["lost"] and deleted == ["lost"]
+    assert reference(db, "kept")["refs"] == 1
+    assert reference(db, "lost") is None
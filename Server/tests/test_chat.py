@@ -0,0 +1,56 @@
+import asyncio
+from types import SimpleNamespace
+
+from fastapi import BackgroundTasks
+
+from routes import notebookRoutes
+
+
+def test_coalesced_chat_turns_are_each_stored(monkeypatch):
+    sent = []
+    stored = []
+
+    async def get_files(notebook_id):
+        return []
+
+    async def prepare_chat(request, files=None):
+        return {
+            "model": "model",
+            "history_objs": [],
+            "prompt": request.user_text,
+            "config": None,
+            "packed": {"report": {}},
+            "history": {"summary": "", "messages": [], "stale": False},
+        }
+
+    async def send_chat_message(model, history, prompt, config):
+        sent.append(prompt)
+        await asyncio.sleep(0.01)
+        return SimpleNamespace(text="The answer.")
+
+    async def insert_message(notebook_id, responder, message, user_id=None):
+        stored.append((responder, message, user_id))
+
+    monkeypatch.setattr(notebookRoutes, "admit", lambda user_id: None)
+    monkeypatch.setattr(notebookRoutes, "get_files", get_files)
+    monkeypatch.setattr(notebookRoutes, "prepare_chat", prepare_chat)
+    monkeypatch.setattr(notebookRoutes, "send_chat_message", send_chat_message)
+    monkeypatch.setattr(notebookRoutes, "insert_message", insert_message)
+
+    async def ask(user_id, text):
+        request = notebookRoutes.ChatRequest(user_text=text, notebookID="nb")
+        return await notebookRoutes.handle_chat(request, BackgroundTasks(), user_id)
+
+    async def ask_together():
+        return await asyncio.gather(ask("u1", "What is it?"), ask("u2", "what is  it?"))
+
+    replies = asyncio.run(ask_together())
+    assert [reply.reply for reply in replies] == ["The answer."] * 2
+    assert len(sent) == 1
+    assert sorted(message for message in stored if message[0] == "user") == [
+        ("user", "What is it?", "u1"),
+        ("user", "what is  it?", "u2"),
+    ]
+    assert [message[1] for message in stored if message[0] != "user"] == [
+        "The answer."
+    ] * 2
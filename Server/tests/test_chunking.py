@@ -0,0 +1,41 @@
+import time
+
+from models.chunking import chunk_source
+
+
+def test_long_comma_list_is_chunked_in_linear_time():
+    # No ";" or "{" for thousands of lines used to make the definition
+    # patterns backtrack over the rest of the file from every line
+    for file_name, line in (
+        ("routes.ts", "  route('/p{index}', handler{index}),\n"),
+        ("values.java", "    private int f{index}(x,\n"),
+        ("calls.c", "  call{index}(x,\n"),
+    ):
+        text = (
+            "export const routes = [\n"
+            + "".join(line.format(index=index) for index in range(6000))
+            + "];\n"
+        )
+        assert len(text) > 75_000
+        started = time.monotonic()
+        chunks, _ = chunk_source(text, file_name)
+        assert time.monotonic() - started < 2
+        assert "".join(chunk["text"] for chunk in chunks).count("\n") >= 6000
+
+
+def test_definitions_are_found_across_lines():
+    text = (
+        "class Users {\n"
+        "  async getUser(id: string): Promise<User> {\n"
+        "    return load(id);\n"
+        "  }\n"
+        "}\n"
+        "export function route(path,\n"
+        "  handler) {\n"
+        '  const open = "{";\n'
+        "}\n"
+        "export function declared();\n"
+    )
+    _, symbols = chunk_source(text, "users.ts")
+    names = {symbol["qualified_name"] for symbol in symbols}
+    assert names == {"Users", "Users.getUser", "route"}
@@ -0,0 +1,99 @@
+import asyncio
+from types import SimpleNamespace
+
+from models import contextCache
+from routes import notebookRoutes
+
+
+def test_provider_cache_hit_with_default_config(monkeypatch):
+    # Larger than CHAT_SOURCE_BUDGET_CHARS, so it used to go through retrieval
+    text = "The notebook source line.\n" * 8000
+    files = [{"file_name": "a.txt", "file_original_name": "a.txt", "content_hash": "h"}]
+    created = []
+
+    async def load_source_texts(notebook_id, files):
+        return [(file_meta, text) for file_meta in files]
+
+    async def create_cache(model, contents, ttl_seconds, display_name):
+        created.append(display_name)
+        return SimpleNamespace(name=f"cachedContents/{len(created)}")
+
+    async def load_history(notebook_id):
+        return {"summary": "", "messages": [], "stale": False}
+
+    async def select_relevant_sources(*args):
+        raise AssertionError("whole sources should be cached, not retrieved")
+
+    monkeypatch.setattr(contextCache, "load_source_texts", load_source_texts)
+    monkeypatch.setattr(contextCache, "create_cache", create_cache)
+    monkeypatch.setattr(notebookRoutes, "load_history", load_history)
+    monkeypatch.setattr(
+        notebookRoutes, "select_relevant_sources", select_relevant_sources
+    )
+    hits = contextCache.context_cache_stats["provider_hits"]
+    request = notebookRoutes.ChatRequest(user_text="What is it?", notebookID="nb")
+
+    async def two_turns():
+        return [await notebookRoutes.prepare_chat(request, files) for _ in range(2)]
+
+    turns = asyncio.run(two_turns())
+    assert len(text) > notebookRoutes.CHAT_SOURCE_BUDGET_CHARS
+    assert created == ["notebook-nb"]
+    assert contextCache.context_cache_stats["provider_hits"] == hits + 1
+    for chat in turns:
+        assert chat["config"].cached_content == "cachedContents/1"
+        assert chat["model"] == contextCache.PROVIDER_CACHE_MODEL
+        assert text not in chat["prompt"]
+
+
+def test_provider_cache_is_created_once_for_uncached_sources(monkeypatch):
+    text = "A large source line.\n" * 8000
+    files = [{"file_name": "b.txt", "file_original_name": "b.txt", "content_hash": "h"}]
+    created = []
+
+    async def load_source_texts(notebook_id, files):
+        return [(file_meta, text) for file_meta in files]
+
+    async def create_cache(model, contents, ttl_seconds, display_name):
+        created.append(display_name)
+        await asyncio.sleep(0.01)
+        return SimpleNamespace(name=f"cachedContents/{len(created)}")
+
+    monkeypatch.setattr(contextCache, "load_source_texts", load_source_texts)
+    monkeypatch.setattr(contextCache, "create_cache", create_cache)
+    # Too small to keep the sources in memory between turns
+    monkeypatch.setattr(contextCache, "source_contexts", contextCache.LRUCache(1))
+    monkeypatch.setattr(contextCache, "provider_caches", {})
+
+    async def turn():
+        entry = await contextCache.get_source_context("nb2", files)
+        return await contextCache.get_provider_cache(entry)
+
+    async def turns():
+        concurrent = await asyncio.gather(turn(), turn(), turn())
+        return list(concurrent) + [await turn()]
+
+    assert asyncio.run(turns()) == ["cachedContents/1"] * 4
+    assert created == ["notebook-nb2"]
+
+
+def test_provider_cache_is_not_created_for_incomplete_sources(monkeypatch):
+    files = [
+        {"file_name": "c.txt", "file_original_name": "c.txt", "content_hash": "c"},
+        {"file_name": "d.txt", "file_original_name": "d.txt", "content_hash": "d"},
+    ]
+
+    async def load_source_texts(notebook_id, files):
+        return [(files[0], "A large source line.\n" * 8000), (files[1], None)]
+
+    async def create_cache(*args):
+        raise AssertionError("incomplete sources should not be cached")
+
+    monkeypatch.setattr(contextCache, "load_source_texts", load_source_texts)
+    monkeypatch.setattr(contextCache, "create_cache", create_cache)
+
+    async def turn():
+        entry = await contextCache.get_source_context("nb3", files)
+        return await contextCache.get_provider_cache(entry)
+
+    assert asyncio.run(turn()) is None
@@ -0,0 +1,78 @@
+from models import contextPacker
+from models.contextPacker import estimate_tokens, pack_context
+
+
+def source(name: str, tokens: int) -> dict:
+    return {"file_name": name, "content": "word " * (tokens * 4 // 5)}
+
+
+def packed_tokens(packed: dict) -> int:
+    report = packed["report"]
+    return (
+        report["system_tokens"]
+        + report["question_tokens"]
+        + report["history_tokens"]
+        + report["source_tokens"]
+        + report["reserved_output_tokens"]
+    )
+
+
+def test_everything_is_kept_when_it_fits():
+    sources = [source("a.md", 100), source("b.md", 200)]
+    history = [{"role": "user", "text": "hello"}, {"role": "model", "text": "hi"}]
+    packed = pack_context("Why?", sources, history, system="Be brief.")
+    assert packed["sources"] == sources
+    assert packed["history"] == history
+    assert packed["report"]["dropped"] == []
+
+
+def test_large_sources_are_cut_to_equal_shares():
+    sources = [source("small.md", 300), source("big.md", 5000), source("huge.md", 9000)]
+    packed = pack_context("Why?", sources, max_output_tokens=1000, max_tokens=6000)
+    assert packed_tokens(packed) <= 6000
+    kept = {entry["file_name"]: entry["content"] for entry in packed["sources"]}
+    # The small source is whole, the others share what it leaves
+    assert kept["small.md"] == sources[0]["content"]
+    assert abs(estimate_tokens(kept["big.md"]) - estimate_tokens(kept["huge.md"])) < 10
+    assert kept["big.md"].endswith(contextPacker.TRUNCATION_MARKER)
+    assert [
+        (entry["item"], entry["action"]) for entry in packed["report"]["dropped"]
+    ] == [
+        ("big.md", "truncated"),
+        ("huge.md", "truncated"),
+    ]
+
+
+def test_least_relevant_sources_are_dropped_before_shares_get_too_small():
+    sources = [source(f"{index}.md", 1000) for index in range(8)]
+    budget = 3 * contextPacker.CONTEXT_MIN_SOURCE_TOKENS + 10
+    packed = pack_context("", sources, max_tokens=budget)
+    assert [entry["file_name"] for entry in packed["sources"]] == [
+        "0.md",
+        "1.md",
+        "2.md",
+    ]
+    dropped = [entry["item"] for entry in packed["report"]["dropped"]]
+    assert dropped[:5] == ["7.md", "6.md", "5.md", "4.md", "3.md"]
+    assert packed_tokens(packed) <= budget
+
+
+def test_history_keeps_the_latest_messages_within_its_share():
+    history = [
+        {"role": "user", "text": f"message {index} " * 100} for index in range(10)
+    ]
+    sources = [source("a.md", 20000)]
+    packed = pack_context("Why?", sources, history, max_tokens=10000)
+    history_budget = int(
+        (10000 - estimate_tokens("Why?")) * contextPacker.CONTEXT_HISTORY_SHARE
+    )
+    assert packed["report"]["history_tokens"] <= history_budget
+    assert packed["history"] == history[-len(packed["history"]) :]
+    assert 0 < len(packed["history"]) < 10
+    dropped = [
+        entry["item"]
+        for entry in packed["report"]["dropped"]
+        if entry["part"] == "history"
+    ]
+    assert sorted(dropped) == list(range(10 - len(packed["history"])))
+    assert packed_tokens(packed) <= 10000
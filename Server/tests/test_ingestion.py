@@ -0,0 +1,45 @@
+import asyncio
+
+from models import ingestion
+
+
+def test_failed_extraction_is_not_retried(monkeypatch):
+    source_texts = {}
+    extractions = []
+
+    async def get_source_texts(content_hashes):
+        return {h: source_texts[h] for h in content_hashes if h in source_texts}
+
+    async def upsert_source_text(content_hash, text, page_offsets, reason=None):
+        source_texts[content_hash] = {
+            "content_hash": content_hash,
+            "text": text,
+            "page_offsets": page_offsets,
+            "reason": reason,
+            "metadata": {"updated_at": ingestion.datetime.datetime.utcnow()},
+        }
+
+    async def extract_source(source, file_type, content_hash=None):
+        extractions.append(content_hash)
+        return None
+
+    monkeypatch.setattr(ingestion, "get_source_texts", get_source_texts)
+    monkeypatch.setattr(ingestion, "upsert_source_text", upsert_source_text)
+    monkeypatch.setattr(ingestion, "extract_source", extract_source)
+
+    async def read_twice():
+        first = await ingestion.ingest_source(b"\x00", "image/png", "h")
+        second = await ingestion.ingest_source(b"\x00", "image/png", "h")
+        text = await ingestion.load_source_text(
+            "nb", {"file_name": "a.png", "content_hash": "h"}, source_texts
+        )
+        return first, second, text
+
+    assert asyncio.run(read_twice()) == (None, None, None)
+    assert extractions == ["h"]
+    assert source_texts["h"]["reason"] == "Could not extract image/png"
+
+    # Failures are tried again once SOURCE_EXTRACTION_RETRY_SECONDS passed
+    monkeypatch.setattr(ingestion, "SOURCE_EXTRACTION_RETRY_SECONDS", 0)
+    assert asyncio.run(ingestion.ingest_source(b"\x00", "image/png", "h")) is None
+    assert extractions == ["h", "h"]
@@ -0,0 +1,134 @@
+import asyncio
+
+from fastapi import HTTPException
+
+from fakeMongo import FakeCollection
+from models import jobs
+
+
+def job_collection(monkeypatch):
+    collection = FakeCollection(unique=[("dedup_key", {"active": {"$exists": True}})])
+    monkeypatch.setattr(jobs, "jobs_collection", collection)
+    return collection
+
+
+def test_submit_retries_when_the_active_job_changes(monkeypatch):
+    collection = job_collection(monkeypatch)
+    find_one = collection.find_one
+    lookups = []
+    submitted = []
+
+    async def racing_find_one(query):
+        lookups.append(query)
+        if len(lookups) == 1:
+            # The active job finishes and another submission takes its place
+            # between the duplicate key error and the lookup
+            await jobs.finish_job(submitted[0]["_id"], result={})
+            collection.documents.append(
+                {"_id": "other", "dedup_key": query["dedup_key"], "active": True}
+            )
+            return None
+        return await find_one(query)
+
+    async def submit():
+        submitted.append(await jobs.submit_job("nb", "faq", {"n": 1}))
+        monkeypatch.setattr(collection, "find_one", racing_find_one)
+        return await jobs.submit_job("nb", "faq", {"n": 1})
+
+    assert asyncio.run(submit())["_id"] == "other"
+    assert len(lookups) == 2
+
+
+def test_watchers_are_notified_after_another_one_leaves(monkeypatch):
+    job_collection(monkeypatch)
+    monkeypatch.setattr(jobs, "JOB_POLL_SECONDS", 30)
+
+    async def watch():
+        job = await jobs.submit_job("nb", "faq")
+        leaving = jobs.watch_job(job["_id"])
+        staying = jobs.watch_job(job["_id"])
+        assert (await leaving.__anext__())["status"] == "queued"
+        assert (await staying.__anext__())["status"] == "queued"
+        waiting = asyncio.ensure_future(staying.__anext__())
+        await asyncio.sleep(0)
+        await leaving.aclose()
+        await jobs.finish_job(job["_id"], result={"ok": True})
+        finished = await asyncio.wait_for(waiting, 1)
+        await staying.aclose()
+        return finished
+
+    assert asyncio.run(watch())["status"] == "done"
+    assert jobs.job_updates == {}
+
+
+def test_active_jobs_are_deduplicated(monkeypatch):
+    job_collection(monkeypatch)
+
+    async def submit():
+        first = await jobs.submit_job("nb", "faq", {"n": 1, "style": "short"})
+        same = await jobs.submit_job("nb", "faq", {"style": "short", "n": 1})
+        other = await jobs.submit_job("nb", "faq", {"n": 2})
+        await jobs.finish_job(first["_id"], result={})
+        again = await jobs.submit_job("nb", "faq", {"n": 1, "style": "short"})
+        return first, same, other, again
+
+    first, same, other, again = asyncio.run(submit())
+    assert same["_id"] == first["_id"]
+    assert other["_id"] != first["_id"]
+    # A finished job does not absorb new submissions
+    assert again["_id"] != first["_id"]
+
+
+def test_jobs_are_claimed_oldest_first(monkeypatch):
+    job_collection(monkeypatch)
+
+    async def claim():
+        older = await jobs.submit_job("nb", "faq")
+        await jobs.submit_job("nb", "briefing")
+        return older, await jobs.claim_job()
+
+    older, claimed = asyncio.run(claim())
+    assert claimed["_id"] == older["_id"]
+    assert claimed["status"] == "running"
+    assert claimed["attempts"] == 1
+
+
+def test_stale_jobs_are_requeued_until_out_of_attempts(monkeypatch):
+    collection = job_collection(monkeypatch)
+    monkeypatch.setattr(jobs, "JOB_MAX_ATTEMPTS", 2)
+
+    async def interrupt_twice():
+        job = await jobs.submit_job("nb", "faq")
+        states = []
+        for _ in range(2):
+            await jobs.claim_job()
+            # The process running it stopped sending heartbeats
+            collection.documents[0]["heartbeat_at"] = (
+                jobs.now() - jobs.datetime.timedelta(seconds=jobs.JOB_STALE_SECONDS + 1)
+            )
+            await jobs.requeue_stale_jobs()
+            states.append(await jobs.get_job(job["_id"]))
+        return states
+
+    requeued, failed = asyncio.run(interrupt_twice())
+    assert requeued["status"] == "queued"
+    assert requeued["last_error"]["status_code"] == 500
+    assert failed["status"] == "failed"
+    assert "active" not in failed
+
+
+def test_handler_errors_are_stored_on_the_job(monkeypatch):
+    job_collection(monkeypatch)
+
+    async def handler(job):
+        raise HTTPException(status_code=413, detail="The sources are too large")
+
+    async def run():
+        job = await jobs.submit_job("nb", "faq")
+        await jobs.run_job(await jobs.claim_job(), handler)
+        return await jobs.get_job(job["_id"])
+
+    job = asyncio.run(run())
+    assert job["status"] == "failed"
+    assert job["error"] == {"status_code": 413, "detail": "The sources are too large"}
+    assert jobs.running == set()
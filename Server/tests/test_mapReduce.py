@@ -0,0 +1,64 @@
+import asyncio
+
+import pytest
+
+from fakeMongo import FakeCollection
+from models import mapReduce
+
+
+@pytest.fixture(autouse=True)
+def summaries(monkeypatch):
+    collection = FakeCollection()
+    monkeypatch.setattr(mapReduce, "chunk_summaries_collection", collection)
+    monkeypatch.setattr(mapReduce, "REDUCE_INPUT_TOKENS", 60)
+    return collection
+
+
+def recording_model(prompts: list):
+    async def generate(prompt: str) -> str:
+        prompts.append(prompt)
+        if prompt.startswith("Merge"):
+            return f"merged {len(prompts)}"
+        return f"notes {len(prompts)} " * 10
+
+    return generate
+
+
+def lines(prefix: str, count: int) -> str:
+    return "".join(f"{prefix} line {index} of the source\n" for index in range(count))
+
+
+def test_chunk_summaries_are_reused_across_runs(summaries):
+    sources = [
+        {"file_name": "a.md", "content": lines("alpha", 8000)},
+        {"file_name": "b.md", "content": lines("beta", 4000)},
+    ]
+    prompts = []
+    notes, report = asyncio.run(
+        mapReduce.condense_sources(sources, recording_model(prompts))
+    )
+    map_calls = [prompt for prompt in prompts if not prompt.startswith("Merge")]
+    assert report["chunks"] == len(map_calls) > 2
+    assert report["mapped_chunks"] == report["chunks"]
+    assert report["reduce_levels"] >= 1
+    assert len(summaries.documents) == report["chunks"]
+    assert mapReduce.estimate_tokens(notes) <= mapReduce.REDUCE_INPUT_TOKENS
+
+    # A new source only maps its own chunks, the others come from the cache
+    sources.append({"file_name": "c.md", "content": lines("gamma", 5)})
+    prompts.clear()
+    _, report = asyncio.run(
+        mapReduce.condense_sources(sources, recording_model(prompts))
+    )
+    map_calls = [prompt for prompt in prompts if not prompt.startswith("Merge")]
+    assert report["mapped_chunks"] == len(map_calls) == 1
+    assert "Source: c.md" in map_calls[0]
+
+
+def test_pieces_keep_their_hash_when_other_sources_change():
+    text = lines("alpha", 60)
+    pieces = mapReduce.split_source(text, 100)
+    assert "".join(pieces) == text
+    assert all(piece.endswith("\n") for piece in pieces)
+    assert all(mapReduce.estimate_tokens(piece) <= 100 for piece in pieces)
+    assert mapReduce.split_source(text, 100) == pieces
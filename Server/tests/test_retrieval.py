@@ -0,0 +1,93 @@
+import asyncio
+
+import pytest
+
+from fakeMongo import FakeCollection
+from models import retrieval, vectorIndex
+
+SOURCES = {
+    "refunds.md": "Refunds are issued within 14 days. A refund needs the receipt.",
+    "shipping.md": "Orders ship in two days. Shipping is free above 50 euros.",
+    "returns.md": "Returns are accepted for 30 days. Refunds follow a return.",
+}
+
+
+@pytest.fixture
+def index(monkeypatch, tmp_path):
+    monkeypatch.setattr(retrieval, "chunks_collection", FakeCollection())
+    monkeypatch.setattr(retrieval, "index_stats_collection", FakeCollection())
+    monkeypatch.setattr(retrieval, "symbols_collection", FakeCollection())
+    monkeypatch.setattr(vectorIndex, "VECTOR_INDEX_DIR", str(tmp_path))
+    asyncio.run(retrieval.index_sources("nb", list(SOURCES.items())))
+    return retrieval
+
+
+def ranked_files(chunks: list) -> list:
+    return [chunk["file_name"] for chunk in chunks]
+
+
+def test_bm25_ranks_the_chunks_matching_the_query(index):
+    ranked = asyncio.run(index.search("nb", "refund receipt", list(SOURCES), 3))
+    assert ranked_files(ranked) == ["refunds.md"]
+    assert ranked[0]["score"] > 0
+
+    # Rarer terms weigh more: both files mention refunds, only one returns
+    ranked = asyncio.run(index.search("nb", "refunds return", list(SOURCES), 3))
+    assert ranked_files(ranked) == ["returns.md", "refunds.md"]
+
+    # Only the given files are searched
+    ranked = asyncio.run(index.search("nb", "refunds", ["returns.md"], 3))
+    assert ranked_files(ranked) == ["returns.md"]
+    assert asyncio.run(index.search("nb", "warranty", list(SOURCES), 3)) == []
+
+
+def test_unindexing_a_source_updates_the_statistics(index):
+    stats = asyncio.run(index.index_stats_collection.find_one({"notebook_id": "nb"}))
+    assert stats["chunk_count"] == 3
+    assert asyncio.run(index.unindex_source("nb", "refunds.md")) == 1
+    stats = asyncio.run(index.index_stats_collection.find_one({"notebook_id": "nb"}))
+    assert stats["chunk_count"] == 2
+    assert stats["total_length"] == sum(
+        len(index.tokenize(SOURCES[name])) for name in ("shipping.md", "returns.md")
+    )
+    ranked = asyncio.run(index.search("nb", "refund receipt", list(SOURCES), 3))
+    assert ranked_files(ranked) == []
+
+
+def test_relevant_sources_fit_the_budget_in_source_order(index, monkeypatch):
+    monkeypatch.setattr(retrieval, "RETRIEVAL_MODE", "bm25")
+    new_text = "Gift cards can not be refunded, refunds go to the card."
+    sources = [
+        ({"file_name": name, "file_original_name": name.upper()}, text)
+        for name, text in [*SOURCES.items(), ("cards.md", new_text)]
+    ]
+    budget = len(SOURCES["returns.md"]) + len(new_text)
+    selected = asyncio.run(
+        index.select_relevant_sources("nb", sources, "refunds return cards", budget)
+    )
+    # The source missing from the index was indexed on the way
+    assert [entry["file_name"] for entry in selected] == ["RETURNS.MD", "CARDS.MD"]
+    assert sum(len(entry["content"]) for entry in selected) <= budget
+
+
+def test_hybrid_ranking_fuses_lexical_and_vector_hits(index, monkeypatch):
+    monkeypatch.setattr(retrieval, "RETRIEVAL_MODE", "hybrid")
+    ranked = asyncio.run(index.rank_chunks("nb", "refund receipt", list(SOURCES), 3))
+    assert ranked_files(ranked)[0] == "refunds.md"
+    scores = [chunk["score"] for chunk in ranked]
+    assert scores == sorted(scores, reverse=True)
+
+    # Vector hits get their text from the chunk store
+    monkeypatch.setattr(retrieval, "RETRIEVAL_MODE", "vector")
+    ranked = asyncio.run(index.rank_chunks("nb", "shipping orders", list(SOURCES), 1))
+    assert ranked_files(ranked) == ["shipping.md"]
+    assert ranked[0]["text"] == SOURCES["shipping.md"]
+
+
+def test_missing_vectors_are_restored_from_the_chunks(index):
+    asyncio.run(retrieval.delete_notebook_vectors("nb"))
+    assert asyncio.run(retrieval.get_vector_files("nb")) == set()
+    # The chunks are in MongoDB and outlive the local vector index
+    indexed = asyncio.run(index.get_indexed_files("nb"))
+    asyncio.run(index.restore_vectors("nb", indexed))
+    assert asyncio.run(retrieval.get_vector_files("nb")) == set(SOURCES)
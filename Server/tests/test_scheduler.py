@@ -0,0 +1,107 @@
+import asyncio
+
+import pytest
+from cachetools import TTLCache
+from fastapi import HTTPException
+
+from models import scheduler
+
+
+@pytest.fixture(autouse=True)
+def fresh_scheduler(monkeypatch):
+    monkeypatch.setattr(scheduler, "wait_queue", [])
+    monkeypatch.setattr(scheduler, "last_finish", {})
+    monkeypatch.setattr(scheduler, "queued_by_user", {})
+    monkeypatch.setattr(scheduler, "buckets", TTLCache(maxsize=100, ttl=60))
+    monkeypatch.setattr(scheduler, "virtual_time", 0.0)
+    monkeypatch.setattr(scheduler, "in_use", 0)
+    monkeypatch.setattr(scheduler, "waiting", 0)
+    monkeypatch.setattr(scheduler, "capacity", 1)
+
+
+async def call(user: str, name: str, order: list, timeout: float = 5):
+    scheduler.current_user.set(user)
+    await scheduler.acquire(timeout)
+    order.append(name)
+    await asyncio.sleep(0)
+    scheduler.release(0.0)
+
+
+async def run_queued(calls: list) -> list:
+    """
+    Queue calls behind a held slot, then let them through one at a time.
+    """
+    order = []
+    await scheduler.acquire(1)
+    tasks = []
+    for user, name in calls:
+        tasks.append(asyncio.ensure_future(call(user, name, order)))
+        await asyncio.sleep(0)
+    scheduler.release(0.0)
+    await asyncio.gather(*tasks)
+    return order
+
+
+def test_slots_alternate_between_users(monkeypatch):
+    calls = [("a", f"a{index}") for index in range(4)] + [("b", "b0"), ("b", "b1")]
+    order = asyncio.run(run_queued(calls))
+    # b queued last but is not starved behind a's backlog
+    assert order == ["a0", "b0", "a1", "b1", "a2", "a3"]
+
+    monkeypatch.setattr(scheduler, "SCHEDULER_USER_WEIGHTS", {"b": 2.0})
+    calls = [("a", f"a{index}") for index in range(3)] + [
+        ("b", f"b{index}") for index in range(4)
+    ]
+    order = asyncio.run(run_queued(calls))
+    assert order == ["b0", "a0", "b1", "b2", "a1", "b3", "a2"]
+    assert scheduler.in_use == 0 and scheduler.waiting == 0
+
+
+def test_admission_is_rate_limited_per_user(monkeypatch):
+    monkeypatch.setattr(scheduler, "SCHEDULER_BURST", 2)
+    scheduler.admit("a")
+    scheduler.admit("a")
+    with pytest.raises(HTTPException) as refused:
+        scheduler.admit("a")
+    assert refused.value.status_code == 429
+    assert int(refused.value.headers["Retry-After"]) >= 1
+    # Other users have their own bucket
+    scheduler.admit("b")
+
+
+def test_full_queue_is_refused(monkeypatch):
+    monkeypatch.setattr(scheduler, "SCHEDULER_USER_MAX_QUEUE", 1)
+
+    async def queue_two():
+        order = []
+        await scheduler.acquire(1)
+        first = asyncio.ensure_future(call("a", "first", order))
+        await asyncio.sleep(0)
+        with pytest.raises(HTTPException) as refused:
+            await call("a", "second", order)
+        scheduler.release(0.0)
+        await first
+        return order, refused.value
+
+    order, refused = asyncio.run(queue_two())
+    assert refused.status_code == 429
+    assert "Retry-After" in refused.headers
+    assert order == ["first"]
+
+
+def test_timed_out_waits_are_cleaned_up():
+    async def time_out():
+        order = []
+        await scheduler.acquire(1)
+        with pytest.raises(asyncio.TimeoutError):
+            await call("a", "late", order, timeout=0.01)
+        assert scheduler.waiting == 0
+        assert scheduler.queued_by_user == {}
+        scheduler.release(0.0)
+        # The abandoned wait does not hold on to the freed slot
+        assert scheduler.in_use == 0
+        await call("b", "next", order)
+        return order
+
+    assert asyncio.run(time_out()) == ["next"]
+    assert scheduler.in_use == 0
@@ -0,0 +1,100 @@
+import asyncio
+import hashlib
+import os
+
+import httpx
+from fastapi import FastAPI
+
+from models import localStorage, storage
+from routes.storageRoutes import router as storage_router
+
+
+def test_spooled_buffer_stays_in_memory_while_small():
+    spool = storage.SpooledBuffer(max_memory=16)
+    spool.write(b"0123456789")
+    spool.write(b"abcdef")
+    spool.finish()
+    assert spool.path is None
+    assert spool.source == b"0123456789abcdef"
+    assert spool.size == 16
+    assert spool.content_hash == hashlib.sha256(b"0123456789abcdef").hexdigest()
+    spool.close()
+
+
+def test_spooled_buffer_rolls_over_to_disk():
+    chunks = [bytes([index]) * 10 for index in range(5)]
+    spool = storage.SpooledBuffer(max_memory=25)
+    for chunk in chunks:
+        spool.write(chunk)
+    spool.finish()
+    content = b"".join(chunks)
+    assert spool.path is not None
+    assert spool.source == spool.path
+    with open(spool.path, "rb") as spooled:
+        assert spooled.read() == content
+    assert spool.size == len(content)
+    assert spool.content_hash == hashlib.sha256(content).hexdigest()
+
+    async def read_back():
+        return b"".join([chunk async for chunk in spool.iter_chunks(7)])
+
+    assert asyncio.run(read_back()) == content
+    path = spool.path
+    spool.close()
+    assert not os.path.exists(path)
+
+
+def test_filesystem_backend_round_trip(monkeypatch, tmp_path):
+    monkeypatch.setattr(storage, "STORAGE_BACKEND", "filesystem")
+    monkeypatch.setattr(localStorage, "STORAGE_DIR", str(tmp_path))
+    content = b"stored content\n" * 1000
+
+    async def round_trip():
+        url = await storage.upload_stream(
+            storage.iterate_bytes(content), "nb/a.txt", "files"
+        )
+        assert url == localStorage.get_public_url("nb/a.txt", "files")
+        assert await storage.get_file_size("nb/a.txt", "files") == len(content)
+        # Existing objects are only replaced with upsert
+        assert (
+            await storage.upload_stream(
+                storage.iterate_bytes(b"other"), "nb/a.txt", "files"
+            )
+            is None
+        )
+        assert await storage.copy_file("nb/a.txt", "blobs/a", "files") == "blobs/a"
+        download = await storage.download_file("blobs/a", "files")
+        assert download.content_hash == hashlib.sha256(content).hexdigest()
+        with open(download.source, "rb") as downloaded:
+            assert downloaded.read() == content
+        download.close()
+        assert await storage.delete_file("nb/a.txt", "files")
+        assert await storage.get_file_size("nb/a.txt", "files") is None
+        assert await storage.get_file_size("../../etc/passwd", "files") is None
+
+    asyncio.run(round_trip())
+
+
+def test_filesystem_signed_upload(monkeypatch, tmp_path):
+    monkeypatch.setattr(storage, "STORAGE_BACKEND", "filesystem")
+    monkeypatch.setattr(localStorage, "STORAGE_DIR", str(tmp_path))
+    app = FastAPI()
+    app.include_router(storage_router)
+
+    async def upload():
+        signed = await storage.create_signed_upload_url("nb/b.txt", "files")
+        transport = httpx.ASGITransport(app=app)
+        async with httpx.AsyncClient(
+            transport=transport, base_url=localStorage.STORAGE_PUBLIC_URL
+        ) as client:
+            forged = signed["signed_url"].replace("nb/b.txt", "nb/c.txt")
+            assert (await client.put(forged, content=b"x")).status_code == 403
+            response = await client.put(signed["signed_url"], content=b"uploaded")
+            assert response.status_code == 200
+            again = await client.put(signed["signed_url"], content=b"again")
+            assert again.status_code == 409
+            public = await client.get(storage.get_public_url("nb/b.txt", "files"))
+            assert public.content == b"uploaded"
+
+    asyncio.run(upload())
+    assert (tmp_path / "files" / "nb" / "b.txt").read_bytes() == b"uploaded"
@@ -0,0 +1,109 @@
+import asyncio
+
+import httpx
+from fastapi import FastAPI, HTTPException
+
+from routes import notebookRoutes
+
+
+def test_partial_upload_reports_each_file(monkeypatch):
+    inserted = []
+
+    async def stream_upload_file(notebook_id, file):
+        if file.filename == "big.bin":
+            raise HTTPException(status_code=413, detail="big.bin is too large")
+        return {"file_name": file.filename}
+
+    async def insert_many_file_metadata(records):
+        inserted.extend(records)
+
+    async def invalidate_source_context(notebook_id):
+        pass
+
+    monkeypatch.setattr(notebookRoutes, "stream_upload_file", stream_upload_file)
+    monkeypatch.setattr(
+        notebookRoutes, "insert_many_file_metadata", insert_many_file_metadata
+    )
+    monkeypatch.setattr(
+        notebookRoutes, "invalidate_source_context", invalidate_source_context
+    )
+    monkeypatch.setattr(
+        notebookRoutes, "schedule_briefing_update", lambda tasks, notebook_id: None
+    )
+    app = FastAPI()
+    app.include_router(notebookRoutes.router, prefix="/api")
+
+    async def upload(names):
+        transport = httpx.ASGITransport(app=app)
+        async with httpx.AsyncClient(
+            transport=transport, base_url="http://t"
+        ) as client:
+            return await client.post(
+                "/api/upload",
+                data={"notebookID": "nb"},
+                files=[("files", (name, b"content")) for name in names],
+            )
+
+    response = asyncio.run(upload(["a.txt", "big.bin"]))
+    assert response.status_code == 207
+    assert [file["status_code"] for file in response.json()["files"]] == [200, 413]
+    assert inserted == [{"file_name": "a.txt"}]
+
+    response = asyncio.run(upload(["big.bin"]))
+    assert response.status_code == 413
+
+
+def test_archive_counts_the_members_it_registered(monkeypatch):
+    inserts = []
+    released = []
+    updates = []
+
+    async def process_archive(source, archive_name, handle_member):
+        for index in range(5):
+            await handle_member(f"src/{index}.py", b"print()", "text/x-python")
+        return {"members": 5, "skipped": 0, "failed": 0, "truncated": False}
+
+    async def ingest_spooled_source(notebook_id, spool, file_name, *args):
+        return {"file_name": file_name}, "print()"
+
+    async def index_sources(notebook_id, sources):
+        pass
+
+    async def insert_many_file_metadata(records):
+        inserts.append(records)
+        if len(inserts) == 2:
+            raise HTTPException(status_code=500, detail="write failed")
+
+    async def release_unregistered(notebook_id, records):
+        released.extend(records)
+        return len(records)
+
+    async def update_notebook_metadata(notebook_id, source=None):
+        updates.append(source)
+
+    async def nothing(*args):
+        pass
+
+    monkeypatch.setattr(notebookRoutes, "ARCHIVE_BATCH_SIZE", 2)
+    monkeypatch.setattr(notebookRoutes, "process_archive", process_archive)
+    monkeypatch.setattr(notebookRoutes, "ingest_spooled_source", ingest_spooled_source)
+    monkeypatch.setattr(notebookRoutes, "index_sources", index_sources)
+    monkeypatch.setattr(
+        notebookRoutes, "insert_many_file_metadata", insert_many_file_metadata
+    )
+    monkeypatch.setattr(notebookRoutes, "release_unregistered", release_unregistered)
+    monkeypatch.setattr(
+        notebookRoutes, "update_notebook_metadata", update_notebook_metadata
+    )
+    monkeypatch.setattr(notebookRoutes, "invalidate_source_context", nothing)
+    monkeypatch.setattr(notebookRoutes, "refresh_briefing", nothing)
+    spool = notebookRoutes.SpooledBuffer()
+    spool.finish()
+
+    stats = asyncio.run(notebookRoutes.ingest_archive("nb", spool, "repo.zip"))
+    assert [len(records) for records in inserts] == [2, 2, 1]
+    assert released == inserts[1]
+    assert stats["inserted"] == 3
+    assert stats["unregistered"] == 2
+    assert stats["failed_batches"] == 1
+    assert updates == [3]
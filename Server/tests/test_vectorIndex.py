@@ -0,0 +1,67 @@
+import numpy as np
+import pytest
+
+from models import vectorIndex
+
+
+@pytest.fixture(autouse=True)
+def index_dir(monkeypatch, tmp_path):
+    monkeypatch.setattr(vectorIndex, "VECTOR_INDEX_DIR", str(tmp_path))
+
+
+def chunks(*texts):
+    return [{"chunk_index": index, "text": text} for index, text in enumerate(texts)]
+
+
+def live_frequencies(index: dict):
+    frequencies = np.zeros(vectorIndex.VECTOR_DIMENSIONS, dtype=np.int64)
+    for _, segment, deleted in index["segments"]:
+        live = np.asarray(segment["vectors"])[vectorIndex.live_mask(segment, deleted)]
+        frequencies += (live != 0).sum(axis=0)
+    return frequencies
+
+
+def test_updates_append_segments_and_tombstone_old_rows():
+    topics = ["kafka consumers", "redis streams", "postgres vacuum", "nginx caching"]
+    vectorIndex.replace_rows(
+        "nb",
+        {
+            "docs.md": chunks(*(f"Notes on {topic} tuning." for topic in topics * 2)),
+            "faq.md": chunks("How do I rotate the api keys?"),
+        },
+    )
+    vectorIndex.replace_rows(
+        "nb", {"faq.md": chunks("How do I renew the tls certificates?")}
+    )
+
+    index = vectorIndex.load_index("nb")
+    assert len(index["segments"]) == 2
+    assert [len(deleted) for _, _, deleted in index["segments"]] == [1, 0]
+    assert index["rows"] == 9
+    assert (index["frequencies"] == live_frequencies(index)).all()
+    found = vectorIndex.search_rows("nb", "renew tls certificates", ["faq.md"], 3)
+    assert [(row["file_name"], row["chunk_index"]) for row in found] == [("faq.md", 0)]
+    assert vectorIndex.search_rows("nb", "rotate api keys", ["faq.md"], 3) == []
+    found = vectorIndex.search_rows("nb", "redis streams", ["docs.md", "faq.md"], 2)
+    assert {row["chunk_index"] for row in found} == {1, 5}
+
+
+def test_deleted_rows_are_compacted_away():
+    vectorIndex.replace_rows(
+        "nb",
+        {
+            "a.md": chunks("alpha one", "alpha two"),
+            "b.md": chunks("beta one", "beta two"),
+        },
+    )
+    vectorIndex.replace_rows("nb", {"a.md": []})
+
+    index = vectorIndex.load_index("nb")
+    # Half the rows were deleted, past VECTOR_COMPACT_RATIO
+    assert len(index["segments"]) == 1
+    _, segment, deleted = index["segments"][0]
+    assert len(deleted) == 0
+    assert segment["ids"] == [["b.md", 0], ["b.md", 1]]
+    assert (index["frequencies"] == live_frequencies(index)).all()
+    assert vectorIndex.indexed_rows_files("nb") == {"b.md"}
+    assert vectorIndex.search_rows("nb", "alpha", ["a.md", "b.md"], 2) == []